@@ -1,11 +1,12 @@
 #!/usr/bin/python3
 
 import logging
+import multiprocessing
 import os
 from pathlib import Path
 import pdb
 
-from typing import List, Mapping, Tuple
+from typing import List, Mapping, Optional, Tuple
 
 import cv2
 import imageio
@@ -13,6 +14,8 @@ import numpy as np
 import torch
 
 from src.vision.avg_meter import AverageMeter, SegmentationAverageMeter
+from src.vision.background_writer import BackgroundWriter
+from src.vision.confusion_matrix_renderer import ConfusionMatrixRenderer
 from src.vision.utils import get_logger, get_dataloader_id_to_classname_map, cv2_imread_rgb
 from src.vision.mask_utils import write_six_img_grid_w_embedded_names
 
@@ -21,7 +24,6 @@ from src.vision.mask_utils import write_six_img_grid_w_embedded_names
 #     
 # )
 # from mseg.utils.mask_utils_detectron2 import Visualizer
-# from mseg_semantic.utils.confusion_matrix_renderer import ConfusionMatrixRenderer
 
 """
 Given a set of inference results (inferred label maps saved as grayscale images),
@@ -47,6 +49,7 @@ class AccuracyCalculator:
         num_eval_classes: int,
         excluded_ids: int,
         render_confusion_matrix: bool = False,
+        sam: Optional[SegmentationAverageMeter] = None,
     ) -> None:
         """
         Args:
@@ -57,6 +60,8 @@ class AccuracyCalculator:
             save_folder:
             num_eval_classes:
             render_confusion_matrix:
+            sam: statistics already accumulated during inference (see `InferenceTask.update_metrics()`).
+                If provided, predictions are not re-read from disk, except those visualized.
         """
         assert isinstance(eval_taxonomy, str)
         self.args = args
@@ -72,7 +77,8 @@ class AccuracyCalculator:
 
         if self.render_confusion_matrix:
             self.cmr = ConfusionMatrixRenderer(self.save_folder, class_names, self.dataset_name)
-        self.sam = SegmentationAverageMeter()
+        self.precomputed = sam is not None
+        self.sam = sam if self.precomputed else SegmentationAverageMeter()
 
         # can handle the `universal` taxonomy scenario just fine, since we pass in the classes manually
         self.id_to_class_name_map = get_dataloader_id_to_classname_map(
@@ -87,7 +93,13 @@ class AccuracyCalculator:
         Args:
         -   save_vis: whether to save visualize examplars
         """
-        self.evaluate_predictions(save_vis)
+        if not self.precomputed:
+            if getattr(self.args, "eval_workers", 0) > 1:
+                self.evaluate_predictions_parallel(save_vis)
+            else:
+                self.evaluate_predictions(save_vis)
+        elif save_vis:
+            self.save_visualizations()
         self.print_results()
         self.dump_acc_results_to_file()
 
@@ -98,25 +110,72 @@ class AccuracyCalculator:
             save_vis: whether to save visualizations on predictions vs. ground truth
         """
         pred_folder = self.gray_folder
-        for i, (image_path, target_path) in enumerate(self.data_list):
+        # visualizations are rendered & written by background threads
+        writer = BackgroundWriter(
+            getattr(self.args, "writer_threads", 0), getattr(self.args, "writer_queue_size", 16)
+        )
+        with writer:
+            for i, (image_path, target_path) in enumerate(self.data_list):
 
-            image_name = Path(image_path).stem
-            pred = cv2.imread(os.path.join(pred_folder, image_name + ".png"), cv2.IMREAD_GRAYSCALE)
+                image_name, pred, target_img = load_pred_and_target(pred_folder, image_path, target_path)
 
-            target_img = imageio.imread(target_path)
-            target_img = target_img.astype(np.int64)
+                self.sam.update_metrics_cpu(pred, target_img, self.num_eval_classes)
 
-            self.sam.update_metrics_cpu(pred, target_img, self.num_eval_classes)
+                if (i + 1) % self.args.vis_freq == 0:
+                    print_str = (
+                        f'Evaluating {i + 1}/{len(self.data_list)} on image {image_name+".png"},'
+                        + f" accuracy {self.sam.accuracy:.4f}."
+                    )
+                    logger.info(print_str)
 
-            if (i + 1) % self.args.vis_freq == 0:
-                print_str = (
-                    f'Evaluating {i + 1}/{len(self.data_list)} on image {image_name+".png"},'
-                    + f" accuracy {self.sam.accuracy:.4f}."
-                )
-                logger.info(print_str)
+                if save_vis and ((i + 1) % self.args.vis_freq == 0):
+                    writer.submit(
+                        save_prediction_visualization,
+                        pred_folder, image_path, image_name, pred, target_img, self.id_to_class_name_map
+                    )
 
-            if save_vis and ((i + 1) % self.args.vis_freq == 0):
-                save_prediction_visualization(
+    def evaluate_predictions_parallel(self, save_vis: bool = True) -> None:
+        """Calculate accuracy exactly as `evaluate_predictions()`, over `args.eval_workers` processes.
+
+        `data_list` is split into contiguous shards; each worker accumulates the confusion
+        matrix of a shard, and the parent sums them up in order, logging progress every
+        `vis_freq` images as the shards complete.
+
+        Args:
+            save_vis: whether to save visualizations on predictions vs. ground truth
+        """
+        num_workers = self.args.eval_workers
+        # a few shards per worker, to balance load while keeping the progress log moving
+        shard_size = max(1, int(np.ceil(len(self.data_list) / (4 * num_workers))))
+        shards = [
+            (self.gray_folder, i, self.data_list[i : i + shard_size], self.num_eval_classes, self.args.vis_freq)
+            for i in range(0, len(self.data_list), shard_size)
+        ]
+        with multiprocessing.Pool(num_workers) as pool:
+            for shard_sam, vis_log in pool.imap(evaluate_shard, shards):
+                self.sam.merge(shard_sam)
+                for i, image_name, accuracy in vis_log:
+                    print_str = (
+                        f'Evaluating {i + 1}/{len(self.data_list)} on image {image_name+".png"},'
+                        + f" accuracy {accuracy:.4f}."
+                    )
+                    logger.info(print_str)
+
+        if save_vis:
+            self.save_visualizations()
+
+    def save_visualizations(self) -> None:
+        """Save the visualizations `evaluate_predictions()` would, without re-scoring every prediction."""
+        pred_folder = self.gray_folder
+        writer = BackgroundWriter(
+            getattr(self.args, "writer_threads", 0), getattr(self.args, "writer_queue_size", 16)
+        )
+        with writer:
+            for i in range(self.args.vis_freq - 1, len(self.data_list), self.args.vis_freq):
+                image_path, target_path = self.data_list[i]
+                image_name, pred, target_img = load_pred_and_target(pred_folder, image_path, target_path)
+                writer.submit(
+                    save_prediction_visualization,
                     pred_folder, image_path, image_name, pred, target_img, self.id_to_class_name_map
                 )
 
@@ -127,7 +186,7 @@ class AccuracyCalculator:
         iou_class, accuracy_class, mIoU, mAcc, allAcc = self.sam.get_metrics()
 
         if self.render_confusion_matrix:
-            self.cmr.render()
+            self.cmr.render(self.sam.confusion_matrix())
         logger.info(self.dataset_name + " " + self.args.model_path)
         logger.info("Eval result: mIoU/mAcc/allAcc {:.4f}/{:.4f}/{:.4f}.".format(mIoU, mAcc, allAcc))
 
@@ -172,6 +231,50 @@ class AccuracyCalculator:
         result.close()
 
 
+def load_pred_and_target(pred_folder: str, image_path: str, target_path: str) -> Tuple[str, np.ndarray, np.ndarray]:
+    """
+    Args:
+        pred_folder: folder of grayscale label map predictions
+        image_path: path to RGB image
+        target_path: path to ground truth label map
+
+    Returns:
+        image_name: file name stem of the image
+        pred: predicted label map
+        target_img: ground truth label map, as int64
+    """
+    image_name = Path(image_path).stem
+    pred = cv2.imread(os.path.join(pred_folder, image_name + ".png"), cv2.IMREAD_GRAYSCALE)
+
+    target_img = imageio.imread(target_path)
+    target_img = target_img.astype(np.int64)
+    return image_name, pred, target_img
+
+
+def evaluate_shard(
+    shard: Tuple[str, int, List[Tuple[str, str]], int, int]
+) -> Tuple[SegmentationAverageMeter, List[Tuple[int, str, float]]]:
+    """Worker process of `AccuracyCalculator.evaluate_predictions_parallel()`.
+
+    Args:
+        shard: (pred_folder, index of the shard's first image in data_list, shard's data_list,
+            num_eval_classes, vis_freq)
+
+    Returns:
+        sam: meter accumulated over the shard
+        vis_log: (index, image name, accuracy) of each image whose progress should be logged
+    """
+    pred_folder, start, data_list, num_eval_classes, vis_freq = shard
+    sam = SegmentationAverageMeter()
+    vis_log = []
+    for i, (image_path, target_path) in enumerate(data_list, start=start):
+        image_name, pred, target_img = load_pred_and_target(pred_folder, image_path, target_path)
+        sam.update_metrics_cpu(pred, target_img, num_eval_classes)
+        if (i + 1) % vis_freq == 0:
+            vis_log.append((i, image_name, sam.accuracy))
+    return sam, vis_log
+
+
 def save_prediction_visualization(
     pred_folder: str,
     image_path: str,
@@ -5,7 +5,7 @@ import torch
 import torch.distributed as dist
 from typing import List
 
-from src.vision.iou import intersectionAndUnion, intersectionAndUnionGPU
+from src.vision.iou import confusionMatrix
 
 """
 Source: https://github.com/mseg-dataset/mseg-semantic/blob/master/mseg_semantic/utils/avg_meter.py
@@ -28,18 +28,129 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+class ConfusionMatrixMeter(object):
+    """
+    Accumulates a confusion matrix over a sequence of (prediction, ground truth) label
+    maps, with one bincount per update, and derives the segmentation metrics from it.
+
+    The matrix lives wherever the first update came from: a Numpy array for Numpy
+    inputs, or a tensor on the inputs' device for Pytorch inputs, so that no
+    host-device copies are needed until the metrics are requested.
+    """
+    def __init__(self, num_classes: int, ignore_index: int = 255) -> None:
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+        self.reset()
+
+    def reset(self) -> None:
+        # (K+1)x(K+1), see `confusionMatrix()` for the extra out-of-range row & column
+        self.mat = None
+        self.last_mat = None
+
+    def update(self, pred, target, is_distributed: bool = False) -> None:
+        """
+            Args:
+            -   pred: Numpy array or Pytorch tensor of predicted class indices
+            -   target: Numpy array or Pytorch tensor of ground truth class indices
+            -   is_distributed: whether to sum the batch's matrix across processes
+
+            Returns:
+            -   None
+        """
+        mat = confusionMatrix(pred, target, self.num_classes, self.ignore_index)
+        if is_distributed:
+            dist.all_reduce(mat)
+        self.last_mat = mat
+        self.mat = mat if self.mat is None else self.mat + mat
+
+    def merge(self, other: "ConfusionMatrixMeter") -> None:
+        """ Add the counts of another meter, e.g. one accumulated by a worker process. """
+        if other.mat is None:
+            return
+        self.last_mat = other.last_mat
+        self.mat = other.mat if self.mat is None else self.mat + other.mat
+
+    def confusion_matrix(self) -> np.ndarray:
+        """
+            Returns:
+            -   KxK Numpy array, where entry (i,j) counts pixels of class i predicted as class j
+        """
+        return _to_numpy(self.mat)[: self.num_classes, : self.num_classes]
+
+    def get_areas(self, mat=None):
+        """
+            Returns:
+            -   area_intersection: 1d array of length (K,)
+            -   area_union: 1d array of length (K,)
+            -   area_target: 1d array of length (K,)
+        """
+        mat = self.mat if mat is None else mat
+        K = self.num_classes
+        area_intersection = mat.diagonal()[:K]
+        area_output = mat[:, :K].sum(0)
+        area_target = mat[:K, :].sum(1)
+        area_union = area_output + area_target - area_intersection
+        return area_intersection, area_union, area_target
+
+    @property
+    def accuracy(self) -> float:
+        """ Pixel accuracy of the most recent update. """
+        area_intersection, _, area_target = self.get_areas(self.last_mat)
+        return float(area_intersection.sum()) / (float(area_target.sum()) + 1e-10)
+
+    def get_metrics(self, exclude: bool = False, exclude_ids: List[int] = None):
+        """
+            Returns:
+            -   iou_class: Array
+            -   accuracy_class: Array
+            -   mIoU: float
+            -   mAcc: float
+            -   allAcc: float
+        """
+        area_intersection, area_union, area_target = [
+            _to_numpy(area).astype(np.float64) for area in self.get_areas()
+        ]
+        iou_class = area_intersection / (area_union + 1e-10)
+        accuracy_class = area_intersection / (area_target + 1e-10)
+
+        if exclude:
+            mIoU = np.mean(exclusion(iou_class, exclude_ids))
+            mAcc = np.mean(exclusion(accuracy_class, exclude_ids))
+        else:
+            mIoU = np.mean(iou_class)
+            mAcc = np.mean(accuracy_class)
+        allAcc = sum(area_intersection) / (sum(area_target) + 1e-10)
+        return iou_class, accuracy_class, mIoU, mAcc, allAcc
+
+
 class SegmentationAverageMeter(AverageMeter):
     """ 
     An AverageMeter designed specifically for evaluating segmentation results.
+
+    Backed by a `ConfusionMatrixMeter`, created on the first update, once the number
+    of classes is known.
     """
     def __init__(self) -> None:
         """ Initialize object. """
-        self.intersection_meter = AverageMeter()
-        self.union_meter = AverageMeter()
-        self.target_meter = AverageMeter()
-        self.accuracy = 0
+        self.cmm = None
 
-    def update_metrics_cpu(self, pred, target, num_classes) -> None:
+    def _get_cmm(self, num_classes: int, ignore_idx: int) -> ConfusionMatrixMeter:
+        if self.cmm is None:
+            self.cmm = ConfusionMatrixMeter(num_classes, ignore_idx)
+        return self.cmm
+
+    def _updated_cmm(self) -> ConfusionMatrixMeter:
+        # before the first update, the number of classes (and so the metrics' shape) is unknown
+        if self.cmm is None:
+            raise ValueError("SegmentationAverageMeter has no metrics before its first update")
+        return self.cmm
+
+    @property
+    def accuracy(self) -> float:
+        """ Pixel accuracy of the most recent update. """
+        return 0 if self.cmm is None else self.cmm.accuracy
+
+    def update_metrics_cpu(self, pred, target, num_classes, ignore_idx: int = 255) -> None:
         """
             Args:
             -   pred
@@ -49,12 +160,7 @@ class SegmentationAverageMeter(AverageMeter):
             Returns:
             -   None
         """
-        intersection, union, target = intersectionAndUnion(pred, target, num_classes)
-        self.intersection_meter.update(intersection)
-        self.union_meter.update(union)
-        self.target_meter.update(target)
-        self.accuracy = sum(self.intersection_meter.val) / (sum(self.target_meter.val) + 1e-10)
-        self.intersection = 0.
+        self._get_cmm(num_classes, ignore_idx).update(pred, target)
 
     def update_metrics_gpu(
         self,
@@ -73,16 +179,17 @@ class SegmentationAverageMeter(AverageMeter):
             Returns:
             -   None
         """
-        intersection, union, target = intersectionAndUnionGPU(pred, target, num_classes, ignore_idx)
-        if is_distributed:
-            dist.all_reduce(intersection), dist.all_reduce(union), dist.all_reduce(target)
-        self.intersection = intersection.cpu().numpy()
-        union, target = union.cpu().numpy(), target.cpu().numpy()
-        
-        self.intersection_meter.update(self.intersection)
-        self.union_meter.update(union)
-        self.target_meter.update(target)
-        self.accuracy = sum(self.intersection_meter.val) / (sum(self.target_meter.val) + 1e-10)
+        self._get_cmm(num_classes, ignore_idx).update(pred, target, is_distributed)
+
+    def merge(self, other: "SegmentationAverageMeter") -> None:
+        """ Add the statistics of another meter, e.g. one accumulated by a worker process. """
+        if other.cmm is None:
+            return
+        self._get_cmm(other.cmm.num_classes, other.cmm.ignore_index).merge(other.cmm)
+
+    def confusion_matrix(self) -> np.ndarray:
+        """ KxK confusion matrix accumulated so far. """
+        return self._updated_cmm().confusion_matrix()
 
     def get_metrics(self, exclude: bool = False, exclude_ids: List[int] = None):
         """
@@ -96,19 +203,14 @@ class SegmentationAverageMeter(AverageMeter):
             -   mAcc: float
             -   allAcc: float
         """
-        iou_class = self.intersection_meter.sum / (self.union_meter.sum + 1e-10)
-        accuracy_class = self.intersection_meter.sum / (self.target_meter.sum + 1e-10)
+        return self._updated_cmm().get_metrics(exclude, exclude_ids)
 
-        if exclude:
-            mIoU = np.mean(exclusion(iou_class, exclude_ids))
-            mAcc = np.mean(exclusion(accuracy_class, exclude_ids))
 
-            #print('original miou is:, ', np.mean(iou_class))
-        else:
-            mIoU = np.mean(iou_class)
-            mAcc = np.mean(accuracy_class)
-        allAcc = sum(self.intersection_meter.sum) / (sum(self.target_meter.sum) + 1e-10)
-        return iou_class, accuracy_class, mIoU, mAcc, allAcc
+def _to_numpy(array) -> np.ndarray:
+    """ Bring a Numpy array or a (possibly on-device) Pytorch tensor to a Numpy array. """
+    if isinstance(array, torch.Tensor):
+        return array.cpu().numpy()
+    return array
 
 
 def exclusion(array: np.ndarray, excluded_ids: List[int]) -> np.ndarray:
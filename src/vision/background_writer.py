@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+import queue
+import threading
+from typing import Callable, Optional
+
+import cv2
+import numpy as np
+
+from src.vision.utils import get_logger
+
+"""
+A small pool of background threads that writes results to disk (PNG encoding, grid
+rendering), so that the main loop can move on to the next forward pass. OpenCV
+releases the GIL while encoding, so threads are enough.
+"""
+
+
+logger = get_logger()
+
+
+def imwrite(fpath: str, img: np.ndarray) -> None:
+    """`cv2.imwrite()`, raising instead of returning False on failure."""
+    if not cv2.imwrite(fpath, img):
+        raise IOError(f"Could not write {fpath}")
+
+
+class BackgroundWriter:
+    def __init__(self, num_threads: int = 2, max_queue_size: int = 16) -> None:
+        """
+        Args:
+            num_threads: number of writer threads. If 0, every job runs inline on the caller's thread.
+            max_queue_size: maximum number of pending jobs; `submit()` blocks once the queue is full,
+                which bounds the memory held by queued arrays (backpressure).
+        """
+        self.num_threads = num_threads
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error: Optional[BaseException] = None
+        self.threads = []
+        for _ in range(num_threads):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker(self) -> None:
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            fn, args, kwargs = job
+            try:
+                # once a job failed, skip the remaining ones; the error is re-raised by the main thread
+                if self.error is None:
+                    fn(*args, **kwargs)
+            except BaseException as e:
+                logger.exception("Background write failed")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("A background write failed") from error
+
+    def submit(self, fn: Callable, *args, **kwargs) -> None:
+        """Queue `fn(*args, **kwargs)` for a writer thread, blocking while the queue is full.
+
+        The caller must not modify the arguments afterwards. Raises the error of any
+        previously failed job.
+        """
+        self._raise_error()
+        if self.num_threads == 0:
+            fn(*args, **kwargs)
+            return
+        self.queue.put((fn, args, kwargs))
+
+    def flush(self) -> None:
+        """Wait until all queued jobs are written, and raise the error of any failed job."""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        """Flush, then stop the writer threads."""
+        try:
+            self.flush()
+        finally:
+            self._stop_threads()
+
+    def _stop_threads(self) -> None:
+        """Let the writer threads finish the queued jobs, then stop them."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+            return
+        # the exception of the `with` body propagates; a failed write must not replace it
+        self._stop_threads()
+        if self.error is not None:
+            logger.error(f"A background write also failed: {self.error!r}")
+            self.error = None
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+import random
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import src.vision.cv2_transforms as transform
+
+"""
+Batched counterparts of the data augmentations in `cv2_transforms`, built on Pytorch
+tensor ops so that they run over a whole collated batch on the consumer side of the
+DataLoader (and on the GPU, if the batch lives there), instead of once per sample
+inside the DataLoader workers.
+
+Every transform takes and returns an (N,C,H,W) float image batch and an (N,H,W)
+int64 label batch. Random parameters are still drawn independently per sample.
+"""
+
+
+class Compose(object):
+    # Composes batch transforms, as cv2_transforms.Compose does for per-sample transforms.
+    def __init__(self, batchtransform: List) -> None:
+        self.batchtransform = batchtransform
+
+    def __call__(self, images: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        for t in self.batchtransform:
+            images, labels = t(images, labels)
+        return images, labels
+
+
+class RandomHorizontalFlip(object):
+    def __init__(self, p: float = 0.5) -> None:
+        self.p = p
+
+    def __call__(self, images: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """With probability p, horizontally flip each (image, label map) pair of the batch.
+
+        Args:
+            images: tensor of shape (N,C,H,W) representing a batch of RGB images
+            labels: tensor of shape (N,H,W) representing a batch of ground truth label maps
+        Returns:
+            images: tensor of shape (N,C,H,W), with a random subset of the images hflipped
+            labels: tensor of shape (N,H,W), with the same subset of label maps hflipped
+        """
+        flip = torch.tensor([random.random() < self.p for _ in range(images.shape[0])], device=images.device)
+        images = torch.where(flip.view(-1, 1, 1, 1), images.flip(-1), images)
+        labels = torch.where(flip.view(-1, 1, 1), labels.flip(-1), labels)
+        return images, labels
+
+
+class RandomGaussianBlur(object):
+    def __init__(self, radius: int = 5) -> None:
+        self.radius = radius
+        # identical kernel to cv2.GaussianBlur(image, (radius, radius), 0)
+        self.kernel = torch.from_numpy(cv2.getGaussianKernel(radius, 0).astype(np.float32)).view(-1)
+
+    def __call__(self, images: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """With probability 0.5, blur each image of the batch with a (radius x radius) Gaussian kernel.
+
+        The separable kernel is applied as two depthwise convolutions, with the same
+        reflect-101 border handling as OpenCV.
+
+        Args:
+            images: tensor of shape (N,C,H,W) representing a batch of RGB images
+            labels: tensor of shape (N,H,W) representing a batch of ground truth label maps
+        Returns:
+            images: tensor of shape (N,C,H,W), with a random subset of the images blurred
+            labels: the unmodified label maps
+        """
+        blur = torch.tensor([random.random() < 0.5 for _ in range(images.shape[0])], device=images.device)
+        if not blur.any():
+            return images, labels
+
+        c = images.shape[1]
+        half = self.radius // 2
+        kernel = self.kernel.to(device=images.device, dtype=images.dtype)
+        blurred = F.pad(images, (half, half, half, half), mode="reflect")
+        blurred = F.conv2d(blurred, kernel.view(1, 1, 1, -1).repeat(c, 1, 1, 1), groups=c)
+        blurred = F.conv2d(blurred, kernel.view(1, 1, -1, 1).repeat(c, 1, 1, 1), groups=c)
+        images = torch.where(blur.view(-1, 1, 1, 1), blurred, images)
+        return images, labels
+
+
+def _pixel_to_normalized(h: int, w: int) -> np.ndarray:
+    """3x3 matrix from pixel coordinates to grid_sample() coordinates in [-1,1], with align_corners=False."""
+    return np.array([[2 / w, 0, 1 / w - 1], [0, 2 / h, 1 / h - 1], [0, 0, 1]])
+
+
+class RandRotateScaleCrop(object):
+    """Batched equivalent of RandRotate -> RandScale -> Crop (and optionally ResizeShort and
+    RandomHorizontalFlip), where each sample's random parameters are composed into a single affine
+    matrix exactly as in `cv2_transforms.FusedAffineCrop`, and all crops are resampled at once with
+    `affine_grid` / `grid_sample`.
+
+    Random scaling changes each sample's size, so it can only be batched together with the crop
+    back to a common (crop_h, crop_w).
+    """
+
+    def __init__(
+        self,
+        size,
+        scale,
+        rotate: Tuple[float, float],
+        padding,
+        ignore_label: int = 255,
+        crop_type: str = "rand",
+        short_size: int = None,
+        flip_p: float = 0.0,
+        rotate_p: float = 0.5,
+    ) -> None:
+        """
+        Args:
+            size: (crop_h, crop_w) output size
+            scale: [scale_min, scale_max] random scale range
+            rotate: [rotate_min, rotate_max] random rotation range, in degrees
+            padding: per-channel fill value for the image, in the units of the image batch
+                (i.e. zeros if the batch is already normalized by the padding mean)
+            ignore_label: fill value for the label maps
+            crop_type: 'rand' or 'center'
+            short_size: if given, also resize the short side to this size first
+            flip_p: probability of a horizontal flip; 0 if RandomHorizontalFlip is applied separately
+            rotate_p: probability of a rotation
+        """
+        self.short_size = short_size
+        self.fused = transform.FusedAffineCrop(
+            short_size=short_size if short_size is not None else 1,
+            size=size,
+            scale=scale,
+            rotate=rotate,
+            padding=list(padding),
+            ignore_label=ignore_label,
+            crop_type=crop_type,
+            flip_p=flip_p,
+            rotate_p=rotate_p,
+        )
+
+    def __call__(self, images: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Randomly rotate, scale and crop each (image, label map) pair of the batch.
+
+        Args:
+            images: tensor of shape (N,C,H,W) representing a batch of RGB images
+            labels: tensor of shape (N,H,W) representing a batch of ground truth label maps
+        Returns:
+            images: tensor of shape (N,C,crop_h,crop_w)
+            labels: tensor of shape (N,crop_h,crop_w)
+        """
+        n, c, h, w = images.shape
+        crop_h, crop_w = self.fused.crop.crop_h, self.fused.crop.crop_w
+        if self.short_size is None:
+            # leave the resolution alone: ResizeShort to the current short side is the identity
+            self.fused.resize_short.size = min(h, w)
+
+        to_src = _pixel_to_normalized(h, w)
+        from_dst = np.linalg.inv(_pixel_to_normalized(crop_h, crop_w))
+        thetas = []
+        valid = torch.zeros((n, crop_h, crop_w), dtype=torch.bool)
+        for i in range(n):
+            matrix, (top, bottom, left, right) = self.fused.get_matrix(h, w)
+            # affine_grid() maps output coordinates back to input coordinates
+            inverse = np.linalg.inv(np.vstack([matrix, [0, 0, 1]]))
+            thetas.append((to_src @ inverse @ from_dst)[:2])
+            valid[i, top:bottom, left:right] = True
+
+        theta = torch.tensor(np.stack(thetas), dtype=images.dtype, device=images.device)
+        grid = F.affine_grid(theta, [n, c, crop_h, crop_w], align_corners=False)
+        valid = valid.to(images.device)
+
+        padding = torch.tensor(self.fused.crop.padding, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+        images = F.grid_sample(images - padding, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+        images = torch.where(valid.unsqueeze(1), images + padding, padding)
+
+        # shift labels by one, so that the zero fill of grid_sample() marks out-of-bounds pixels
+        labels = F.grid_sample(
+            (labels.unsqueeze(1) + 1).to(images.dtype), grid, mode="nearest", padding_mode="zeros", align_corners=False
+        )
+        labels = labels.squeeze(1).round().long() - 1
+        ignore_label = self.fused.crop.ignore_label
+        labels = torch.where(valid & (labels >= 0), labels, torch.full_like(labels, ignore_label))
+        return images, labels
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+import glob
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+import torch
+from torch import nn
+
+from src.vision.background_writer import BackgroundWriter
+from src.vision.utils import get_logger
+
+"""
+Asynchronous, crash-safe saving of training checkpoints.
+
+`save()` only snapshots the model and optimizer state to the CPU; serialization runs
+on a background thread, so training resumes right away. Each checkpoint is written to
+a temporary file and atomically renamed into place, so a `train_epoch_N.pth` is always
+complete, even if the process dies mid-write. Older checkpoints in the directory are
+then pruned, keeping the last k epochs and/or the k best by a metric; the metrics are
+recorded in `checkpoints.json` next to the checkpoints, so that the policy survives
+restarts. Checkpoints without a recorded metric only count towards the last k.
+"""
+
+
+logger = get_logger()
+
+
+CHECKPOINT_PATTERN = re.compile(r"train_epoch_(\d+)\.pth$")
+INDEX_FNAME = "checkpoints.json"
+
+
+def snapshot_to_cpu(obj: Any) -> Any:
+    """Copy every tensor in a (nested) state dict to the CPU, so that training can keep updating the originals."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value) for value in obj)
+    return obj
+
+
+def state_dict_matches(model: nn.Module, state_dict: Dict[str, torch.Tensor]) -> bool:
+    """Whether `state_dict` holds exactly the tensor names and shapes of `model`, i.e. whether
+    it can be loaded strictly, e.g. not from a model with a different number of classes."""
+    model_state_dict = model.state_dict()
+    return model_state_dict.keys() == state_dict.keys() and all(
+        tensor.shape == state_dict[name].shape for name, tensor in model_state_dict.items()
+    )
+
+
+def atomic_save(obj: Any, fpath: str) -> None:
+    """`torch.save()` to a temporary file, then rename it to `fpath` in a single step."""
+    tmp_fpath = fpath + ".tmp"
+    with open(tmp_fpath, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fpath, fpath)
+
+
+class CheckpointManager:
+    def __init__(
+        self, save_dir: str, keep_last: int = 2, keep_best: int = 0, async_save: bool = True
+    ) -> None:
+        """
+        Args:
+            save_dir: directory of the `train_epoch_N.pth` checkpoints
+            keep_last: number of most recent checkpoints to keep, 0 for none
+            keep_best: number of checkpoints with the highest metric to keep, 0 for none.
+                If both are 0, every checkpoint is kept.
+            async_save: write checkpoints on a background thread; otherwise `save()` blocks until written
+        """
+        self.save_dir = save_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        # a single thread keeps the writes (and pruning) in order; a queue of one bounds the
+        # number of snapshots held in memory, if writing is slower than training
+        self.writer = BackgroundWriter(num_threads=1 if async_save else 0, max_queue_size=1)
+
+        self.index_fpath = os.path.join(save_dir, INDEX_FNAME)
+        self.index: Dict[str, Dict[str, Optional[float]]] = {}
+        if os.path.isfile(self.index_fpath):
+            with open(self.index_fpath, "r") as f:
+                self.index = json.load(f)
+
+    def checkpoint_fpath(self, epoch: int) -> str:
+        return os.path.join(self.save_dir, f"train_epoch_{epoch}.pth")
+
+    def save(
+        self,
+        epoch: int,
+        model: nn.Module,
+        optimizer: torch.optim.Optimizer,
+        metric: Optional[float] = None,
+        extra: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Snapshot the training state, and queue it to be written as `train_epoch_{epoch}.pth`.
+
+        Args:
+            epoch: number of completed epochs
+            model: model being trained
+            optimizer: its optimizer
+            metric: score of this checkpoint for `keep_best`, higher is better, e.g. val mIoU
+            extra: other entries of the checkpoint, e.g. the training history
+        """
+        checkpoint = {
+            "epoch": epoch,
+            "state_dict": snapshot_to_cpu(model.state_dict()),
+            "optimizer": snapshot_to_cpu(optimizer.state_dict()),
+            "metric": metric,
+            **(extra or {}),
+        }
+        self.writer.submit(self._write, checkpoint)
+
+    def _write(self, checkpoint: Dict[str, Any]) -> None:
+        fpath = self.checkpoint_fpath(checkpoint["epoch"])
+        logger.info("Saving checkpoint to: " + fpath)
+        atomic_save(checkpoint, fpath)
+        self.index[os.path.basename(fpath)] = {"epoch": checkpoint["epoch"], "metric": checkpoint["metric"]}
+        self._prune(os.path.basename(fpath))
+
+    def _prune(self, latest: str) -> None:
+        """Delete the checkpoints in `save_dir` that the retention policy does not keep, and
+        update the index. The index only provides the metrics, so that checkpoints missing
+        from it (e.g. from before it existed) are pruned too.
+
+        Args:
+            latest: file name of the checkpoint just written, which is always kept, even
+                if e.g. the directory holds later epochs from another run
+        """
+        fnames = [os.path.basename(fpath) for fpath in self.checkpoints()]
+        if self.keep_last > 0 or self.keep_best > 0:
+            metrics = {fname: self.index.get(fname, {}).get("metric") for fname in fnames}
+            with_metric = [fname for fname in fnames if metrics[fname] is not None]
+            by_metric = sorted(with_metric, key=lambda fname: metrics[fname], reverse=True)
+            keep = set(fnames[: self.keep_last]) | set(by_metric[: self.keep_best]) | {latest}
+            for fname in fnames:
+                if fname not in keep:
+                    os.remove(os.path.join(self.save_dir, fname))
+            fnames = [fname for fname in fnames if fname in keep]
+        self.index = {fname: entry for fname, entry in self.index.items() if fname in fnames}
+
+        tmp_fpath = self.index_fpath + ".tmp"
+        with open(tmp_fpath, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_fpath, self.index_fpath)
+
+    def checkpoints(self) -> List[str]:
+        """Paths of the complete checkpoints in `save_dir`, newest first."""
+        fpaths = [fpath for fpath in glob.glob(os.path.join(self.save_dir, "train_epoch_*.pth"))]
+        fpaths = [fpath for fpath in fpaths if CHECKPOINT_PATTERN.search(fpath)]
+        return sorted(fpaths, key=lambda fpath: int(CHECKPOINT_PATTERN.search(fpath).group(1)), reverse=True)
+
+    def load_latest(self, max_epoch: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Load the newest readable checkpoint, optionally of at most `max_epoch` epochs.
+
+        Returns:
+            checkpoint: on the CPU, or None if there is none
+        """
+        for fpath in self.checkpoints():
+            epoch = int(CHECKPOINT_PATTERN.search(fpath).group(1))
+            if max_epoch is not None and epoch > max_epoch:
+                continue
+            try:
+                checkpoint = torch.load(fpath, map_location="cpu")
+            except Exception:
+                logger.exception(f"Skipping unreadable checkpoint {fpath}")
+                continue
+            logger.info(f"=> loaded checkpoint '{fpath}'")
+            return checkpoint
+        return None
+
+    def flush(self) -> None:
+        """Wait until every queued checkpoint is written."""
+        self.writer.flush()
+
+    def close(self) -> None:
+        self.writer.close()
+
+    def __enter__(self) -> "CheckpointManager":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.writer.__exit__(exc_type, exc_value, traceback)
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import torch
+from torch import nn
+
+from src.vision.part5_pspnet import PSPNet
+from src.vision.utils import get_logger
+
+"""
+Measure the memory-vs-compute trade-off of activation checkpointing in PSPNet's dilated
+layer3 and layer4, i.e. of the `checkpoint_segments` argument.
+
+Each setting runs a few SGD training steps on random data, and reports the mean step
+time and the peak memory: on GPU, the peak allocated CUDA memory; on CPU, the peak
+resident set size, for which every setting runs in a fresh subprocess.
+
+Usage:
+    python -m src.vision.checkpointing_benchmark --segments 0 1 3 6 --batch_size 8 --crop_size 201
+"""
+
+
+logger = get_logger()
+
+
+def benchmark_training_step(
+    checkpoint_segments: int, batch_size: int, crop_size: int, num_steps: int, device: str
+) -> Dict[str, float]:
+    """Time PSPNet training steps with the given checkpointing setting.
+
+    Args:
+        checkpoint_segments: see `PSPNet`
+        batch_size: number of crops per step
+        crop_size: H and W of each crop; (crop_size-1) must be a multiple of 8
+        num_steps: number of timed steps, after one warm-up step
+        device: "cuda" or "cpu"
+
+    Returns:
+        result: dictionary with the mean step time in seconds, and the peak memory in MB
+    """
+    torch.manual_seed(0)
+    model = PSPNet(
+        num_classes=11,
+        criterion=nn.CrossEntropyLoss(ignore_index=255),
+        pretrained=False,
+        checkpoint_segments=checkpoint_segments,
+    ).to(device)
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+
+    x = torch.rand(batch_size, 3, crop_size, crop_size, device=device)
+    y = torch.randint(0, 11, (batch_size, crop_size, crop_size), device=device)
+
+    def step() -> None:
+        _, _, main_loss, aux_loss = model(x, y)
+        optimizer.zero_grad()
+        (main_loss + 0.4 * aux_loss).backward()
+        optimizer.step()
+
+    step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    step_time = (time.perf_counter() - start) / num_steps
+
+    if device == "cuda":
+        peak_memory_mb = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        # ru_maxrss is in KB on Linux
+        peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    return {"checkpoint_segments": checkpoint_segments, "step_time": step_time, "peak_memory_mb": peak_memory_mb}
+
+
+def run_benchmark(segments: List[int], batch_size: int, crop_size: int, num_steps: int) -> List[Dict[str, float]]:
+    """Benchmark every checkpointing setting in `segments`, and log a comparison table."""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    results = []
+    for checkpoint_segments in segments:
+        if device == "cuda":
+            result = benchmark_training_step(checkpoint_segments, batch_size, crop_size, num_steps, device)
+            torch.cuda.empty_cache()
+        else:
+            # the peak RSS of a process never goes down, so isolate each setting
+            cmd = [
+                sys.executable, "-m", "src.vision.checkpointing_benchmark", "--single",
+                "--segments", str(checkpoint_segments),
+                "--batch_size", str(batch_size),
+                "--crop_size", str(crop_size),
+                "--num_steps", str(num_steps),
+            ]
+            output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+
+    logger.info(f"PSPNet training step on {device}, batch size {batch_size}, {crop_size}x{crop_size} crops")
+    for result in results:
+        logger.info(
+            f"checkpoint_segments={result['checkpoint_segments']}: "
+            f"step {result['step_time']:.3f} s ({result['step_time'] / results[0]['step_time']:.2f}x), "
+            f"peak memory {result['peak_memory_mb']:.0f} MB ({result['peak_memory_mb'] / results[0]['peak_memory_mb']:.2f}x)"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark activation checkpointing in PSPNet training.")
+    parser.add_argument("--segments", type=int, nargs="+", default=[0, 1, 3, 6])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--crop_size", type=int, default=201)
+    parser.add_argument("--num_steps", type=int, default=3)
+    parser.add_argument("--single", action="store_true", help="run one CPU setting and print it as JSON")
+    opts = parser.parse_args()
+
+    if opts.single:
+        result = benchmark_training_step(opts.segments[0], opts.batch_size, opts.crop_size, opts.num_steps, "cpu")
+        print(json.dumps(result))
+    else:
+        run_benchmark(opts.segments, opts.batch_size, opts.crop_size, opts.num_steps)
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+import os
+from typing import List
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+"""
+Render the confusion matrix accumulated by a `ConfusionMatrixMeter` to an image file.
+
+Modified from:
+    https://github.com/mseg-dataset/mseg-semantic/blob/master/mseg_semantic/utils/confusion_matrix_renderer.py
+"""
+
+
+class ConfusionMatrixRenderer:
+    def __init__(self, save_folder: str, class_names: List[str], dataset_name: str) -> None:
+        """
+        Args:
+            save_folder: directory where the rendered matrix is saved
+            class_names: names of the K evaluated classes, in class index order
+            dataset_name: name of the evaluated dataset, used in the file name
+        """
+        self.save_folder = save_folder
+        self.class_names = class_names
+        self.dataset_name = dataset_name
+
+    def render(self, confusion_matrix: np.ndarray) -> None:
+        """Save the row-normalized confusion matrix, i.e. the fraction of each ground truth
+        class (rows) that was predicted as each class (columns).
+
+        Args:
+            confusion_matrix: KxK array of pixel counts
+        """
+        row_sums = confusion_matrix.sum(axis=1, keepdims=True)
+        normalized = confusion_matrix / np.maximum(row_sums, 1)
+
+        num_classes = len(self.class_names)
+        fig, ax = plt.subplots(figsize=(max(6, num_classes * 0.6), max(6, num_classes * 0.6)))
+        im = ax.imshow(normalized, cmap="Blues", vmin=0, vmax=1)
+        fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+        ax.set_xticks(np.arange(num_classes))
+        ax.set_yticks(np.arange(num_classes))
+        ax.set_xticklabels(self.class_names, rotation=90)
+        ax.set_yticklabels(self.class_names)
+        ax.set_xlabel("Predicted class")
+        ax.set_ylabel("Ground truth class")
+        ax.set_title(f"{self.dataset_name} confusion matrix")
+        fig.tight_layout()
+
+        os.makedirs(self.save_folder, exist_ok=True)
+        fig.savefig(os.path.join(self.save_folder, f"{self.dataset_name}_confusion_matrix.png"))
+        plt.close(fig)
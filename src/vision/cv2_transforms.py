@@ -34,6 +34,10 @@ class Compose(object):
 
 class ToTensor(object):
     # Converts numpy.ndarray (H x W x C) to a torch.FloatTensor of shape (C x H x W).
+    # With keep_uint8=True a uint8 image stays a torch.ByteTensor, to be converted later by normalize_uint8().
+    def __init__(self, keep_uint8: bool = False) -> None:
+        self.keep_uint8 = keep_uint8
+
     def __call__(self, image, label):
         if not isinstance(image, np.ndarray) or not isinstance(label, np.ndarray):
             raise (
@@ -47,7 +51,9 @@ class ToTensor(object):
             raise (RuntimeError("segtransform.ToTensor() only handle np.ndarray labellabel with 2 dims.\n"))
 
         image = torch.from_numpy(image.transpose((2, 0, 1)))
-        if not isinstance(image, torch.FloatTensor):
+        if self.keep_uint8 and image.dtype == torch.uint8:
+            image = image.contiguous()
+        elif not isinstance(image, torch.FloatTensor):
             image = image.float()
         label = torch.from_numpy(label)
         if not isinstance(label, torch.LongTensor):
@@ -76,6 +82,27 @@ class Normalize(object):
         return image, label
 
 
+def normalize_uint8(image: torch.Tensor, mean, std=None) -> torch.Tensor:
+    """Convert a uint8 image to float and normalize it along channel, in a single fused step.
+
+    Equivalent to ToTensor() followed by Normalize(), but applied once, at the very end of
+    the pipeline, e.g. on a collated batch after it has been moved to its device.
+
+    Args:
+        image: uint8 tensor of shape (C,H,W) or (N,C,H,W)
+        mean: mean values for each RGB channel
+        std: standard deviation values for each RGB channel
+    Returns:
+        image: float32 tensor of the same shape, equal to (image - mean) / std
+    """
+    mean = torch.tensor(mean, dtype=torch.float32, device=image.device).view(-1, 1, 1)
+    image = image.float().sub_(mean)
+    if std is not None:
+        std = torch.tensor(std, dtype=torch.float32, device=image.device).view(-1, 1, 1)
+        image = image.div_(std)
+    return image
+
+
 class Resize(object):
     # Resize the input to the given size, 'size' is a 2-element tuple or list in the order of (h, w).
     def __init__(self, size):
@@ -353,3 +380,139 @@ class RandomGaussianBlur(object):
         if random.random() < 0.5:
             image = cv2.GaussianBlur(image, (self.radius, self.radius), 0)
         return image, label
+
+
+def _pixel_scale_matrix(scale_x: float, scale_y: float) -> np.ndarray:
+    """3x3 matrix mapping pixel centers as cv2.resize() does: x' = (x + 0.5) * scale_x - 0.5"""
+    return np.array([[scale_x, 0, 0.5 * (scale_x - 1)], [0, scale_y, 0.5 * (scale_y - 1)], [0, 0, 1]])
+
+
+class FusedAffineCrop(object):
+    """Equivalent of ResizeShort -> RandomHorizontalFlip -> RandRotate -> RandScale -> Crop, fused into
+    a single 2x3 affine matrix, so that only the final crop is ever resampled.
+
+    The image is warped once with bilinear interpolation and the label once with nearest neighbour.
+    Regions that the sequential pipeline would have filled (corners exposed by the rotation, and the
+    border added when the scaled image is smaller than the crop) receive `padding` in the image and
+    `ignore_label` in the label map.
+
+    Note: the label map is sampled at pixel centers, like the image, so it may differ by up to half a
+    pixel along class boundaries from the chain of INTER_NEAREST resizes in the sequential pipeline.
+    """
+
+    def __init__(
+        self,
+        short_size: int,
+        size,
+        scale,
+        rotate: Tuple[float, float],
+        padding,
+        ignore_label: int = 255,
+        crop_type: str = "rand",
+        flip_p: float = 0.5,
+        rotate_p: float = 0.5,
+    ) -> None:
+        # reuse the argument checking of the sequential transforms
+        self.resize_short = ResizeShort(short_size)
+        self.rand_scale = RandScale(scale)
+        self.rand_rotate = RandRotate(rotate, padding=padding, ignore_label=ignore_label, p=rotate_p)
+        self.crop = Crop(size, crop_type=crop_type, padding=padding, ignore_label=ignore_label)
+        self.flip_p = flip_p
+
+    def get_matrix(self, h: int, w: int) -> Tuple[np.ndarray, Tuple[int, int, int, int]]:
+        """Draw the random augmentation parameters and compose them into a single matrix.
+
+        Args:
+            h: height of the input image
+            w: width of the input image
+        Returns:
+            matrix: array of shape (2,3) mapping input pixel coordinates to crop pixel coordinates
+            frame: (top, bottom, left, right) bounds of the transformed image inside the crop,
+                outside of which the sequential pipeline would have produced padding
+        """
+        # ResizeShort
+        if min(h, w) == h:
+            new_h = self.resize_short.size
+            new_w = int(w * (new_h / float(h)))
+        else:
+            new_w = self.resize_short.size
+            new_h = int(h * (new_w / float(w)))
+        matrix = _pixel_scale_matrix(new_w / w, new_h / h)
+
+        # RandomHorizontalFlip
+        if random.random() < self.flip_p:
+            matrix = np.array([[-1, 0, new_w - 1], [0, 1, 0], [0, 0, 1]]) @ matrix
+
+        # RandRotate, about the center of the resized image, keeping its frame size
+        if random.random() < self.rand_rotate.p:
+            rotate = self.rand_rotate.rotate
+            angle = rotate[0] + (rotate[1] - rotate[0]) * random.random()
+            rotation = cv2.getRotationMatrix2D((new_w / 2, new_h / 2), angle, 1)
+            matrix = np.vstack([rotation, [0, 0, 1]]) @ matrix
+
+        # RandScale
+        scale = self.rand_scale.scale
+        temp_scale = scale[0] + (scale[1] - scale[0]) * random.random()
+        scaled_h = int(round(new_h * temp_scale))
+        scaled_w = int(round(new_w * temp_scale))
+        matrix = _pixel_scale_matrix(temp_scale, temp_scale) @ matrix
+
+        # Crop, with centered padding if the scaled image is smaller than the crop
+        crop_h, crop_w = self.crop.crop_h, self.crop.crop_w
+        pad_h_half = int(max(crop_h - scaled_h, 0) / 2)
+        pad_w_half = int(max(crop_w - scaled_w, 0) / 2)
+        padded_h = max(scaled_h, crop_h)
+        padded_w = max(scaled_w, crop_w)
+        if self.crop.crop_type == "rand":
+            h_off = random.randint(0, padded_h - crop_h)
+            w_off = random.randint(0, padded_w - crop_w)
+        else:
+            h_off = int((padded_h - crop_h) / 2)
+            w_off = int((padded_w - crop_w) / 2)
+        t_y = pad_h_half - h_off
+        t_x = pad_w_half - w_off
+        matrix = np.array([[1, 0, t_x], [0, 1, t_y], [0, 0, 1]]) @ matrix
+
+        frame = (max(t_y, 0), min(t_y + scaled_h, crop_h), max(t_x, 0), min(t_x + scaled_w, crop_w))
+        return matrix[:2], frame
+
+    def __call__(self, image: np.ndarray, label: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Randomly flip, rotate, scale and crop an RGB image and label map identically, with one warp each.
+
+        Args:
+            image: array of shape (H,W,C) representing RGB image
+            label: array of shape (H,W) representing ground truth label map
+        Returns:
+            image: array of shape (crop_h,crop_w,C) representing the augmented RGB image crop
+            label: array of shape (crop_h,crop_w) representing the augmented ground truth label map crop
+        """
+        h, w = label.shape
+        matrix, (top, bottom, left, right) = self.get_matrix(h, w)
+        dsize = (self.crop.crop_w, self.crop.crop_h)
+        image = cv2.warpAffine(
+            image, matrix, dsize, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=self.crop.padding
+        )
+        label = cv2.warpAffine(
+            label,
+            matrix,
+            dsize,
+            flags=cv2.INTER_NEAREST,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=self.crop.ignore_label,
+        )
+
+        # anything outside the resized & rotated frame was padding in the sequential pipeline
+        padding = np.array(self.crop.padding)
+        if np.issubdtype(image.dtype, np.integer):
+            # round like OpenCV's border fill (and `Crop`), instead of truncating, e.g. 123.675 -> 124
+            padding = np.round(padding)
+        padding = padding.astype(image.dtype)
+        for rows, cols in [
+            (slice(0, top), slice(None)),
+            (slice(bottom, None), slice(None)),
+            (slice(None), slice(0, left)),
+            (slice(None), slice(right, None)),
+        ]:
+            image[rows, cols] = padding
+            label[rows, cols] = self.crop.ignore_label
+        return image, label
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+
+import json
+import os
+import shutil
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.utils.data
+from torch import nn
+
+import src.vision.cv2_transforms as transform
+from src.vision.part5_pspnet import PSPNet
+from src.vision.utils import get_imagenet_mean_std, get_logger
+
+"""
+Feature cache for head-only transfer learning with a frozen ResNet backbone.
+
+The backbone (layer0-layer4) of PSPNet holds nearly all of its FLOPs, and does not
+change when only the PPM, the classifier and the aux head are trained. So it is run
+once over the dataset, and the outputs of layer3 and layer4 are stored in a
+memory-mapped float16 array; every epoch then only runs the heads on the cached
+features. Since the layer3 and layer4 outputs have the same (dilated) resolution,
+they are stored concatenated along the channels, as one (N,C3+C4,h,w) array.
+
+A cache directory holds:
+    features.npy: float16 array of shape (N,C3+C4,h,w)
+    labels.npy: uint8 array of shape (N,H,W), the ground truth of the cached crops
+    meta.json: shapes and provenance, written last, so that its presence marks a complete cache
+"""
+
+
+logger = get_logger()
+
+
+FEATURES_FNAME = "features.npy"
+LABELS_FNAME = "labels.npy"
+META_FNAME = "meta.json"
+
+
+def build_feature_cache(
+    model: PSPNet,
+    dataset: torch.utils.data.Dataset,
+    cache_dir: str,
+    batch_size: int,
+    use_cuda: bool,
+    source: dict,
+) -> None:
+    """Run the backbone of `model` once over `dataset`, and store its features in `cache_dir`.
+
+    Every sample must have the same size, e.g. a fixed-size crop.
+
+    Args:
+        model: PSPNet whose backbone is frozen; it is run in eval mode, with the BatchNorm running statistics
+        dataset: yields (image tensor, label tensor) pairs, normalized or uint8 (see `uint8_pipeline`)
+        cache_dir: directory to write the cache to; an existing cache there is replaced
+        batch_size: number of images per backbone forward pass
+        use_cuda: whether to run the backbone on the GPU
+        source: description of the model and data, stored in the metadata to check that the cache is current
+    """
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir)
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    mean, std = get_imagenet_mean_std()
+    was_training = model.training
+    model.eval()
+
+    features, labels = None, None
+    start = 0
+    with torch.no_grad():
+        for input, target in loader:
+            if use_cuda:
+                input = input.cuda(non_blocking=True)
+            if input.dtype == torch.uint8:
+                input = transform.normalize_uint8(input, mean, std)
+            aux3, out = model.extract_features(input)
+            batch_features = torch.cat([aux3, out], dim=1).half().cpu().numpy()
+
+            if features is None:
+                # the array shapes are only known after the first batch
+                features = np.lib.format.open_memmap(
+                    os.path.join(cache_dir, FEATURES_FNAME),
+                    mode="w+",
+                    dtype=np.float16,
+                    shape=(len(dataset),) + batch_features.shape[1:],
+                )
+                labels = np.lib.format.open_memmap(
+                    os.path.join(cache_dir, LABELS_FNAME),
+                    mode="w+",
+                    dtype=np.uint8,
+                    shape=(len(dataset),) + tuple(target.shape[1:]),
+                )
+                meta = {
+                    "num_samples": len(dataset),
+                    "input_size": list(input.shape[2:]),
+                    "layer3_channels": aux3.shape[1],
+                    "source": source,
+                }
+
+            end = start + input.shape[0]
+            features[start:end] = batch_features
+            labels[start:end] = target.numpy().astype(np.uint8)
+            start = end
+
+    features.flush()
+    labels.flush()
+    del features, labels
+    with open(os.path.join(cache_dir, META_FNAME), "w") as f:
+        json.dump(meta, f)
+    model.train(was_training)
+
+
+def load_feature_cache_meta(cache_dir: str) -> dict:
+    """Metadata of a complete cache, or an empty dict if there is none in `cache_dir`."""
+    meta_fpath = os.path.join(cache_dir, META_FNAME)
+    if not os.path.isfile(meta_fpath):
+        return {}
+    with open(meta_fpath, "r") as f:
+        return json.load(f)
+
+
+class FeatureCacheData(torch.utils.data.Dataset):
+    """Dataset over a feature cache, yielding (float16 features, int64 label) pairs.
+
+    The arrays are memory-mapped, so only the samples being read are paged in. They are
+    opened on first access, so that dataloader workers each map them, instead of
+    receiving a pickled copy.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        self.meta = load_feature_cache_meta(cache_dir)
+        if not self.meta:
+            raise RuntimeError(f"No complete feature cache at {cache_dir}")
+        self.features = None
+        self.labels = None
+
+    def __len__(self) -> int:
+        return self.meta["num_samples"]
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.features is None:
+            self.features = np.load(os.path.join(self.cache_dir, FEATURES_FNAME), mmap_mode="r")
+            self.labels = np.load(os.path.join(self.cache_dir, LABELS_FNAME), mmap_mode="r")
+        features = torch.from_numpy(np.array(self.features[index]))
+        label = torch.from_numpy(self.labels[index].astype(np.int64))
+        return features, label
+
+
+class CachedFeatureHead(nn.Module):
+    """Runs the heads of a PSPNet on cached backbone features, with the interface of
+    `PSPNet.forward()`, so that it can be trained and evaluated by `run_epoch()`."""
+
+    def __init__(self, model: PSPNet, layer3_channels: int, input_size: Tuple[int, int]) -> None:
+        """
+        Args:
+            model: PSPNet whose PPM, classifier and aux head are run (and trained), sharing their parameters
+            layer3_channels: number of leading channels of the cached features that hold the layer3 output
+            input_size: (H,W) of the images the features were extracted from
+        """
+        super().__init__()
+        self.model = model
+        self.layer3_channels = layer3_channels
+        self.input_size = tuple(input_size)
+
+    def forward(self, x: torch.Tensor, y: torch.Tensor = None):
+        x = x.float()
+        aux3, features = x[:, : self.layer3_channels], x[:, self.layer3_channels :]
+        return self.model.forward_from_features(aux3, features, self.input_size, y)
+
+
+def get_feature_cache(
+    model: PSPNet,
+    dataset: torch.utils.data.Dataset,
+    cache_dir: str,
+    batch_size: int,
+    use_cuda: bool,
+    source: dict,
+) -> FeatureCacheData:
+    """Open the feature cache in `cache_dir`, first (re)building it if it is missing, incomplete,
+    or was built from a different `source`. See `build_feature_cache()` for the arguments."""
+    # round-trip through JSON, so that e.g. tuples compare equal to the stored lists
+    source = json.loads(json.dumps(source))
+    if load_feature_cache_meta(cache_dir).get("source") != source:
+        logger.info(f"Building feature cache of {len(dataset)} samples in {cache_dir}")
+        build_feature_cache(model, dataset, cache_dir, batch_size, use_cuda, source)
+    else:
+        logger.info(f"Reusing feature cache in {cache_dir}")
+    return FeatureCacheData(cache_dir)
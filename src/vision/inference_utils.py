@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+from typing import List, Tuple
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_weights
+
+from src.vision.resnet import BasicBlock, Bottleneck
+
+"""
+Graph-level rewrites of a trained segmentation network, applied once before
+inference to cut per-forward latency. They only hold for a model in eval mode.
+"""
+
+
+def fold_conv_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> None:
+    """Fold an eval-mode BatchNorm into the weights of the conv that precedes it, in place.
+
+    The conv gains a bias if it had none; the BatchNorm must then be removed from the graph.
+
+    Args:
+        conv: convolution whose output feeds `bn`
+        bn: batch norm, using its running statistics
+    """
+    conv.weight, conv.bias = fuse_conv_bn_weights(
+        conv.weight, conv.bias, bn.running_mean, bn.running_var, bn.eps, bn.weight, bn.bias
+    )
+
+
+def _conv_bn_pairs(model: nn.Module) -> List[Tuple[nn.Module, str, nn.Conv2d, nn.BatchNorm2d]]:
+    """Find every Conv2d immediately followed by a BatchNorm2d.
+
+    Returns:
+        pairs: list of (parent module, attribute name of the BatchNorm in the parent, conv, bn)
+    """
+    pairs = []
+    for module in model.modules():
+        if isinstance(module, nn.Sequential):
+            # e.g. `layer0`, `downsample`, the PPM branches and the `cls`/`aux` heads
+            for i in range(len(module) - 1):
+                if isinstance(module[i], nn.Conv2d) and isinstance(module[i + 1], nn.BatchNorm2d):
+                    pairs.append((module, str(i + 1), module[i], module[i + 1]))
+        elif isinstance(module, (BasicBlock, Bottleneck)):
+            for k in [1, 2, 3]:
+                conv, bn = getattr(module, f"conv{k}", None), getattr(module, f"bn{k}", None)
+                if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                    pairs.append((module, f"bn{k}", conv, bn))
+    return pairs
+
+
+def freeze_for_inference(model: nn.Module) -> nn.Module:
+    """Prepare a trained PSPNet or SimpleSegmentationNet for inference, in place.
+
+    Every BatchNorm is folded into the convolution before it (in the Bottlenecks, the
+    deep-base stem, the PPM branches and the classifier), Dropout2d is removed, and
+    the aux head is dropped. The logits of `forward_logits()` stay numerically
+    equivalent; `forward()` with ground truth no longer works, since there is no aux loss.
+
+    Args:
+        model: trained network
+
+    Returns:
+        model: the same network, in eval mode, without gradients
+    """
+    model.eval()
+    with torch.no_grad():
+        for parent, bn_name, conv, bn in _conv_bn_pairs(model):
+            fold_conv_bn(conv, bn)
+            setattr(parent, bn_name, nn.Identity())
+
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            for i, layer in enumerate(module):
+                if isinstance(layer, nn.Dropout2d):
+                    module[i] = nn.Identity()
+
+    if getattr(model, "aux", None) is not None:
+        model.aux = None
+
+    for param in model.parameters():
+        param.requires_grad = False
+    return model
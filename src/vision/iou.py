@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 
-from typing import Tuple
+from typing import Tuple, Union
 
 import numpy as np
 import torch
@@ -90,3 +90,49 @@ def intersectionAndUnionGPU(
     area_union = area_output + area_target - area_intersection
 
     return area_intersection, area_union, area_target
+
+
+def confusionMatrix(
+    output: Union[np.ndarray, torch.Tensor], target: Union[np.ndarray, torch.Tensor], K: int, ignore_index: int = 255
+) -> Union[np.ndarray, torch.Tensor]:
+    """Compute a confusion matrix with a single bincount, in Numpy or in Pytorch
+    (on the device of the given tensors).
+
+    Entry (i,j) counts the pixels with ground truth class i that were predicted
+    as class j. Pixels whose target is `ignore_index` are dropped. An extra last
+    row and column collect target and predicted values that lie outside [0,K),
+    so that the per-class areas derived from the matrix are identical to those
+    of `intersectionAndUnion()`.
+
+    Note output and target sizes are N or N * L or N * H * W
+
+    Args:
+        output: array or tensor representing predicted label map,
+            each value in range 0 to K - 1.
+        target: array or tensor representing ground truth label map,
+            each value in range 0 to K - 1.
+        K: integer number of possible classes
+        ignore_index: integer representing class index to ignore
+
+    Returns:
+        confusion_matrix: int64 array or tensor of shape (K+1,K+1)
+    """
+    assert output.shape == target.shape
+    if isinstance(output, torch.Tensor):
+        output = output.reshape(-1).long()
+        target = target.reshape(-1).long()
+        output = torch.where((output >= 0) & (output < K), output, K)
+        index = torch.where((target >= 0) & (target < K), target, K) * (K + 1) + output
+        # send ignored pixels to an extra, discarded bin, rather than masking them out,
+        # since boolean masking (and bincount on CUDA) would force a host-device sync
+        index = torch.where(target != ignore_index, index, (K + 1) ** 2)
+        counts = torch.zeros((K + 1) ** 2 + 1, dtype=torch.long, device=index.device)
+        counts = counts.scatter_add_(0, index, torch.ones_like(index))[:-1]
+    else:
+        output = output.reshape(-1).astype(np.int64)
+        target = target.reshape(-1).astype(np.int64)
+        valid = target != ignore_index
+        output = np.where((output >= 0) & (output < K), output, K)[valid]
+        target = np.where((target >= 0) & (target < K), target, K)[valid]
+        counts = np.bincount(target * (K + 1) + output, minlength=(K + 1) ** 2)
+    return counts.reshape(K + 1, K + 1)
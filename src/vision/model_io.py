@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import itertools
+import json
+import struct
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+
+from src.vision.utils import get_logger
+
+"""
+Fast construction of a network whose weights all come from a checkpoint.
+
+Building PSPNet normally allocates every parameter and runs Kaiming init over every
+conv, only for `load_state_dict()` to overwrite all of it. Instead, the network is
+built on the meta device (shapes only, no storage) with `torch.nn.init` disabled,
+and the checkpoint's tensors are assigned to it directly. The checkpoint itself is
+memory-mapped, so its tensors are only paged in as they are used.
+
+For deployment, `export_inference_checkpoint()` turns a training checkpoint
+({"epoch", "state_dict", "optimizer"}, pickled) into a compact inference checkpoint:
+the weights only, without the optimizer state and the aux head, optionally in half
+precision, in a flat tensor file laid out as a .safetensors file (8-byte header size,
+JSON header, raw little-endian tensor data). Reading it needs no pickle, and every
+tensor is a zero-copy view of the memory-mapped file.
+
+Usage:
+    python -m src.vision.model_io --model_path exp/camvid/pspnet50/model/train_epoch_100.pth \
+        --output_path exp/camvid/pspnet50/model/train_epoch_100.safetensors --dtype float16
+"""
+
+
+logger = get_logger()
+
+
+TENSOR_FILE_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+
+INIT_FNS = [
+    "uniform_",
+    "normal_",
+    "trunc_normal_",
+    "constant_",
+    "ones_",
+    "zeros_",
+    "xavier_uniform_",
+    "xavier_normal_",
+    "kaiming_uniform_",
+    "kaiming_normal_",
+    "orthogonal_",
+]
+
+
+@contextlib.contextmanager
+def skip_init():
+    """Turn the `torch.nn.init` functions into no-ops, while constructing a network whose
+    weights are overwritten anyway. Even on the meta device this matters: the first
+    `normal_()` on a meta tensor imports all of `torch._dynamo`, which takes seconds."""
+    saved = {name: getattr(nn.init, name) for name in INIT_FNS}
+    for name in saved:
+        setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        for name, fn in saved.items():
+            setattr(nn.init, name, fn)
+
+
+def load_checkpoint(fpath: str) -> dict:
+    """`torch.load()` a checkpoint to the CPU, memory-mapped if its format allows it.
+
+    Checkpoints in the legacy (pre-zipfile) serialization format cannot be mapped, and
+    are read in full instead.
+    """
+    try:
+        return torch.load(fpath, map_location="cpu", mmap=True)
+    except RuntimeError:
+        return torch.load(fpath, map_location="cpu")
+
+
+def build_from_state_dict(
+    build_fn: Callable[[], nn.Module], state_dict: Dict[str, torch.Tensor], device: str = "cpu"
+) -> nn.Module:
+    """Build a network on the meta device, and materialize it from a state dict.
+
+    As with `load_state_dict(strict=False)`, unexpected keys are ignored, and modules
+    whose weights are all missing from the state dict keep a fresh random init. Other
+    missing tensors (e.g. BatchNorm's `num_batches_tracked` in old checkpoints) are zeroed.
+
+    Args:
+        build_fn: constructs the network, e.g. `lambda: PSPNet(pretrained=False, ...)`
+        state_dict: weights of the network, e.g. from `load_checkpoint()`
+        device: device to put the network on
+
+    Returns:
+        model: the network, on `device`
+    """
+    with torch.device("meta"), skip_init():
+        model = build_fn()
+    model.load_state_dict(state_dict, strict=False, assign=True)
+
+    missing = []
+    for module_name, module in model.named_modules():
+        tensors = list(itertools.chain(module.named_parameters(recurse=False), module.named_buffers(recurse=False)))
+        meta_names = [name for name, tensor in tensors if tensor.is_meta]
+        if not meta_names:
+            continue
+        missing += [f"{module_name}.{name}" if module_name else name for name in meta_names]
+
+        if len(meta_names) == len(tensors) and hasattr(module, "reset_parameters"):
+            module.to_empty(device=device, recurse=False)
+            module.reset_parameters()
+        else:
+            for name in meta_names:
+                tensor = getattr(module, name)
+                materialized = torch.zeros_like(tensor, device=device)
+                if isinstance(tensor, nn.Parameter):
+                    materialized = nn.Parameter(materialized, requires_grad=tensor.requires_grad)
+                setattr(module, name, materialized)
+    if missing:
+        logger.warning(f"{len(missing)} tensors missing from the checkpoint, e.g. {missing[:5]}")
+
+    return model.to(device)
+
+
+def save_tensor_file(
+    tensors: Dict[str, torch.Tensor], fpath: str, metadata: Optional[Dict[str, str]] = None
+) -> None:
+    """Write tensors to a flat, memory-mappable file, in the .safetensors layout.
+
+    Args:
+        tensors: tensors to write, by name
+        fpath: where to write the file
+        metadata: strings to store in the header
+    """
+    header = {}
+    offset = 0
+    data = []
+    for name, tensor in tensors.items():
+        tensor = tensor.detach().cpu().contiguous()
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": TENSOR_FILE_DTYPES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        data.append(tensor.reshape(-1).view(torch.uint8).numpy())
+        offset += nbytes
+    if metadata:
+        header["__metadata__"] = metadata
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # pad with spaces, so that the tensor data starts 8-byte aligned
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    with open(fpath, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for array in data:
+            f.write(array.tobytes())
+
+
+def load_tensor_file(fpath: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """Read a file written by `save_tensor_file()`, without copying: each tensor is a view
+    of the (copy-on-write) memory-mapped file, paged in when first used.
+
+    Returns:
+        tensors: tensors by name
+        metadata: strings stored in the header
+    """
+    with open(fpath, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", {})
+    buffer = np.memmap(fpath, dtype=np.uint8, mode="c")
+
+    dtypes = {code: dtype for dtype, code in TENSOR_FILE_DTYPES.items()}
+    tensors = {}
+    for name, info in header.items():
+        dtype = dtypes[info["dtype"]]
+        start, end = info["data_offsets"]
+        if start == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        count = (end - start) // torch.empty(0, dtype=dtype).element_size()
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=8 + header_size + start)
+        tensors[name] = tensor.reshape(info["shape"])
+    return tensors, metadata
+
+
+def export_inference_checkpoint(checkpoint: dict, fpath: str, dtype: Optional[torch.dtype] = None) -> None:
+    """Write the weights of a training checkpoint as a compact inference checkpoint.
+
+    The optimizer state and the aux head, which only contributes to the training loss,
+    are left out, as are duplicates: PSPNet's state dict lists the backbone twice, under
+    `resnet.` and under `layer0`-`layer4`, which share their storage. The latter are kept;
+    loading them restores both, since they are the same modules.
+
+    Args:
+        checkpoint: training checkpoint, as saved by the trainer
+        fpath: where to write the inference checkpoint, e.g. "train_epoch_100.safetensors"
+        dtype: if set, e.g. torch.float16 or torch.bfloat16, floating point weights are cast to it
+    """
+    state_dict = {}
+    seen = set()
+    for name in sorted(checkpoint["state_dict"], key=lambda name: name.startswith("resnet.")):
+        tensor = checkpoint["state_dict"][name]
+        view = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape))
+        if name.startswith("aux.") or view in seen:
+            continue
+        seen.add(view)
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        state_dict[name] = tensor
+    metadata = {"epoch": str(checkpoint.get("epoch")), "dtype": str(dtype or "unchanged")}
+    save_tensor_file(state_dict, fpath, metadata)
+
+
+def load_state_dict_file(fpath: str) -> Dict[str, torch.Tensor]:
+    """Load the weights of a training checkpoint (.pth), or of an inference checkpoint
+    (.safetensors) from `export_inference_checkpoint()`, on the CPU.
+
+    Half precision weights are cast back to float32, for CPU inference and for
+    fine-tuning; float32 weights stay memory-mapped views of the file.
+    """
+    if fpath.endswith(".safetensors"):
+        state_dict, _ = load_tensor_file(fpath)
+        return {
+            name: tensor.float() if tensor.is_floating_point() else tensor for name, tensor in state_dict.items()
+        }
+    return load_checkpoint(fpath)["state_dict"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a training checkpoint as a compact inference checkpoint.")
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--output_path", type=str, required=True)
+    parser.add_argument("--dtype", type=str, default=None, choices=["float16", "bfloat16"])
+    opts = parser.parse_args()
+
+    dtype = getattr(torch, opts.dtype) if opts.dtype is not None else None
+    export_inference_checkpoint(load_checkpoint(opts.model_path), opts.output_path, dtype)
+    logger.info(f"Exported {opts.model_path} to {opts.output_path}")
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+import argparse
+import copy
+from typing import Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from src.vision.inference_utils import freeze_for_inference
+from src.vision.part4_segmentation_net import SimpleSegmentationNet
+from src.vision.part5_pspnet import PSPNet
+from src.vision.trainer import DEFAULT_ARGS
+from src.vision.utils import get_logger
+
+"""
+Export a trained PSPNet or SimpleSegmentationNet to ONNX, with dynamic batch size,
+height and width, for `OnnxRuntimeBackend` in `test.py`.
+
+The exported graph computes `forward_logits()` of the network after
+`freeze_for_inference()`, i.e. BatchNorm folded, without dropout and aux head.
+
+Requires the optional `onnx` and `onnxscript` packages.
+
+Usage:
+    python -m src.vision.onnx_export --model_path exp/camvid/pspnet50/model/train_epoch_100.pth \
+        --onnx_path exp/camvid/pspnet50/model/train_epoch_100.onnx
+"""
+
+
+logger = get_logger()
+
+
+def adaptive_avg_pool_1d(x: torch.Tensor, dim: int, bins: int) -> torch.Tensor:
+    """`adaptive_avg_pool` along one dimension, with the same bin boundaries as Pytorch's,
+    computed from a cumulative sum so that they follow the input size symbolically.
+
+    Args:
+        x: input tensor
+        dim: dimension to pool
+        bins: number of output bins along `dim`
+
+    Returns:
+        pooled: x, with size `bins` along `dim`
+    """
+    size = x.shape[dim]
+    i = torch.arange(bins, device=x.device)
+    starts = (i * size) // bins
+    ends = ((i + 1) * size + bins - 1) // bins
+
+    # prepend a zero, so that csum[j] is the sum of the first j entries
+    csum = F.pad(torch.cumsum(x, dim), [0, 0] * (x.dim() - 1 - dim) + [1, 0])
+    sums = csum.index_select(dim, ends) - csum.index_select(dim, starts)
+    shape = [1] * x.dim()
+    shape[dim] = bins
+    return sums / (ends - starts).to(x.dtype).view(shape)
+
+
+class ExportableAdaptiveAvgPool2d(nn.Module):
+    """Drop-in for nn.AdaptiveAvgPool2d. ONNX has no adaptive pooling op, so exporting
+    the original bakes in the kernel sizes of the example input's resolution."""
+
+    def __init__(self, output_size) -> None:
+        super().__init__()
+        if isinstance(output_size, int):
+            output_size = (output_size, output_size)
+        self.output_size = output_size
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = adaptive_avg_pool_1d(x, 2, self.output_size[0])
+        return adaptive_avg_pool_1d(x, 3, self.output_size[1])
+
+
+class LogitsWrapper(nn.Module):
+    """Exposes `forward_logits()` of a segmentation network as `forward()`, for export."""
+
+    def __init__(self, model: nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.model.forward_logits(x)
+
+
+def export_onnx(model: nn.Module, onnx_fpath: str, example_hw: Tuple[int, int] = (201, 201)) -> None:
+    """Export a copy of a trained network to ONNX, with input "input" of shape (N,3,H,W)
+    and output "logits" of shape (N,num_classes,H',W'), where N, H and W are dynamic.
+
+    Args:
+        model: trained PSPNet or SimpleSegmentationNet
+        onnx_fpath: where to save the .onnx file
+        example_hw: (H,W) of the example input to trace with; for PSPNet, (H-1) and (W-1)
+            must be multiples of 8
+    """
+    model = freeze_for_inference(copy.deepcopy(model).cpu())
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            for i, layer in enumerate(module):
+                if isinstance(layer, nn.AdaptiveAvgPool2d):
+                    module[i] = ExportableAdaptiveAvgPool2d(layer.output_size)
+
+    example_input = torch.rand(1, 3, *example_hw)
+    dim = torch.export.Dim.DYNAMIC
+    torch.onnx.export(
+        LogitsWrapper(model).eval(),
+        (example_input,),
+        onnx_fpath,
+        input_names=["input"],
+        output_names=["logits"],
+        dynamo=True,
+        dynamic_shapes={"x": {0: dim, 2: dim, 3: dim}},
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a trained segmentation network to ONNX.")
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--onnx_path", type=str, required=True)
+    opts = parser.parse_args()
+
+    args = DEFAULT_ARGS
+    if args.arch == "PSPNet":
+        model = PSPNet(
+            layers=args.layers,
+            num_classes=args.classes,
+            zoom_factor=args.zoom_factor,
+            pretrained=False,
+            use_ppm=args.use_ppm
+        )
+    elif args.arch == "SimpleSegmentationNet":
+        model = SimpleSegmentationNet(pretrained=False, num_classes=args.classes)
+
+    checkpoint = torch.load(opts.model_path, map_location="cpu")
+    model.load_state_dict(checkpoint["state_dict"], strict=False)
+    export_onnx(model, opts.onnx_path, example_hw=(args.test_h, args.test_w))
+    logger.info(f"Exported {opts.model_path} to {opts.onnx_path}")
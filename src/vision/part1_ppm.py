@@ -86,10 +86,17 @@ class PPM(nn.Module):
         #######################################################################
         _, _, H, W = x.shape
         upsample = nn.Upsample(size=(H, W))        
-        output = x.clone()
+        # keep every branch in the input's memory format, since upsampling the 1x1 bin
+        # always gives NCHW, and a single mismatched input makes torch.cat fall back to NCHW
+        if x.is_contiguous(memory_format=torch.channels_last):
+            memory_format = torch.channels_last
+        else:
+            memory_format = torch.contiguous_format
+        outputs = [x]
         for feature in self.features:
             y = upsample(feature(x))
-            output = torch.cat((output, y), dim = 1)
+            outputs.append(y.contiguous(memory_format=memory_format))
+        output = torch.cat(outputs, dim = 1)
 
         #######################################################################
         #                             END OF YOUR CODE                        #
@@ -1,5 +1,7 @@
 #!/usr/bin/python3
 
+import argparse
+import json
 import os
 import os.path
 import re
@@ -57,7 +59,9 @@ def make_dataset(split: str, data_root: str, data_list_fpath: str) -> List[Tuple
 
 
 class SemData(Dataset):
-    def __init__(self, split: str, data_root: str, data_list_fpath: str, transform=None) -> None:
+    def __init__(
+        self, split: str, data_root: str, data_list_fpath: str, transform=None, keep_uint8: bool = False
+    ) -> None:
         """
         Dataloader class for semantic segmentation datasets.
 
@@ -68,10 +72,13 @@ class SemData(Dataset):
                 are relative to
             data_list_fpath: path to .txt file with relative image paths
             transform: Pytorch torchvision transform
+            keep_uint8: hand the transform a uint8 image and label map, instead
+                of float32 and int64, so that all geometric ops run on uint8
         """
         self.split = split
         self.data_list = make_dataset(split, data_root, data_list_fpath)
         self.transform = transform
+        self.keep_uint8 = keep_uint8
 
     def __len__(self) -> int:
         return len(self.data_list)
@@ -98,10 +105,10 @@ class SemData(Dataset):
         image_path, label_path = self.data_list[index]
         image = cv2.imread(image_path, cv2.IMREAD_COLOR)  # BGR 3 channel ndarray wiht shape H * W * 3
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # convert cv2 read image from BGR order to RGB order
-        image = np.float32(image)
-
         label = imageio.imread(label_path)  # # GRAY 1 channel ndarray with shape H * W
-        label = label.astype(np.int64)
+        if not self.keep_uint8:
+            image = np.float32(image)
+            label = label.astype(np.int64)
 
         if image.shape[0] != label.shape[0] or image.shape[1] != label.shape[1]:
             raise (RuntimeError("Image & label shape mismatch: " + image_path + " " + label_path + "\n"))
@@ -115,6 +122,124 @@ class SemData(Dataset):
         return image, label
 
 
+
+def pack_dataset(split: str, data_root: str, data_list_fpath: str, pack_fpath: str) -> None:
+    """
+    Decode every (image, label) pair of a split once, and write them into a single
+    contiguous uint8 file that `PackedSemData` can memory-map.
+
+    Two files are written: `pack_fpath` holds the raw bytes of every RGB image
+    followed by its label map, and `pack_fpath + ".json"` holds the data list and
+    the byte offset and shape of every array.
+
+    Args:
+        split: string representing split of data set to use, must be either
+            'train','val','test'
+        data_root: path to where data lives, and where relative image paths are
+            relative to
+        data_list_fpath: path to .txt file with relative image paths and their
+            corresponding GT path
+        pack_fpath: path of the packed binary file to create
+    """
+    data_list = make_dataset(split, data_root, data_list_fpath)
+
+    index = {"data_list": data_list, "images": [], "labels": []}
+    offset = 0
+    with open(pack_fpath, "wb") as f:
+        for image_path, label_path in data_list:
+            image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            label = imageio.imread(label_path)
+            if image.shape[0] != label.shape[0] or image.shape[1] != label.shape[1]:
+                raise (RuntimeError("Image & label shape mismatch: " + image_path + " " + label_path + "\n"))
+            if label.dtype != np.uint8:
+                raise (RuntimeError("Only uint8 label maps can be packed: " + label_path + "\n"))
+
+            for key, arr in [("images", image), ("labels", label)]:
+                arr = np.ascontiguousarray(arr)
+                f.write(arr.tobytes())
+                index[key].append([offset, list(arr.shape)])
+                offset += arr.nbytes
+
+    with open(pack_fpath + ".json", "w") as f:
+        json.dump(index, f)
+    print(f"Packed {len(data_list)} {split} (image,label) pairs into {pack_fpath}")
+
+
+class PackedSemData(Dataset):
+    def __init__(self, split: str, pack_fpath: str, transform=None, keep_uint8: bool = False) -> None:
+        """
+        Drop-in replacement for `SemData` that reads pre-decoded images and labels
+        from a file written by `pack_dataset()`, instead of decoding PNGs.
+
+        The packed file is memory-mapped lazily, so that each DataLoader worker
+        opens its own read-only map after being forked.
+
+        Args:
+            split: string representing split of data set to use, must be either
+                'train','val','test'
+            pack_fpath: path to the packed binary file
+            transform: Pytorch torchvision transform
+            keep_uint8: hand the transform uint8 arrays, as in `SemData`
+        """
+        self.split = split
+        self.pack_fpath = pack_fpath
+        self.transform = transform
+        self.keep_uint8 = keep_uint8
+
+        with open(pack_fpath + ".json") as f:
+            index = json.load(f)
+        self.data_list = [tuple(pair) for pair in index["data_list"]]
+        self.image_index = index["images"]
+        self.label_index = index["labels"]
+        self.buffer = None
+
+    def __len__(self) -> int:
+        return len(self.data_list)
+
+    def __getstate__(self):
+        # memory maps are not shared across worker processes
+        state = self.__dict__.copy()
+        state["buffer"] = None
+        return state
+
+    def _view(self, entry) -> np.ndarray:
+        """Return a zero-copy view of one packed array."""
+        if self.buffer is None:
+            self.buffer = np.memmap(self.pack_fpath, dtype=np.uint8, mode="r")
+        offset, shape = entry
+        return self.buffer[offset : offset + int(np.prod(shape))].reshape(shape)
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Retrieve the transformed RGB image and ground truth, exactly as
+        `SemData.__getitem__()` would, but without any image decoding.
+
+        Args:
+            index: index of the example to retrieve within the dataset
+
+        Returns:
+            image: tensor of shape (C,H,W), with type torch.float32
+            label: tensor of shape (H,W), with type torch.long (64-bit integer)
+        """
+        image = self._view(self.image_index[index])
+        label = self._view(self.label_index[index])
+        if self.keep_uint8:
+            # the transform must not write into the read-only map
+            image, label = np.array(image), np.array(label)
+        else:
+            image = np.float32(image)
+            label = label.astype(np.int64)
+
+        if self.transform is not None:
+            if self.split != "test":
+                image, label = self.transform(image, label)
+            else:
+                # use dummy label in transform, since label unknown for test
+                image, label = self.transform(image, image[:, :, 0])
+
+        return image, label
+
 def get_label_paths(label_path):
     """
     Args:
@@ -129,6 +254,72 @@ def get_label_paths(label_path):
                    for path in glob.glob(os.path.join(label_path, '*_road_*.png'))}
     return label_paths
 
+
+def _dir_mtime_ns(dirpath: str) -> int:
+    """Modification time of a directory, or -1 if it does not exist.
+
+    A directory's mtime changes whenever an entry is added, removed or renamed,
+    so it is a cheap signal that the sample index has gone stale.
+    """
+    try:
+        return os.stat(dirpath).st_mtime_ns
+    except FileNotFoundError:
+        return -1
+
+
+KITTI_INDEX_VERSION = 2  # 1 stored label paths, which break when the data root is reached through another path
+
+
+def load_kitti_index(train_path: str, label_path: str, manifest_fpath: str) -> List[Tuple[str, str]]:
+    """
+    Build a sorted list of (image file name, label file name) pairs, reusing an
+    on-disk manifest when neither directory has changed since it was written.
+
+    The manifest is a JSON file recording the mtimes of `train_path` and
+    `label_path` alongside the index. If either mtime differs, the index is
+    rebuilt with `get_label_paths()` and the manifest is rewritten. Only file
+    names are stored, so that the manifest stays valid however the directories
+    are reached (a different relative data root or working directory, a copy). Failure to
+    write the manifest (e.g. a read-only data root) is not an error.
+
+    Args:
+        train_path: directory containing the RGB images
+        label_path: directory containing the ground truth label maps
+        manifest_fpath: path to the JSON manifest file
+
+    Returns:
+        samples: list of 2-tuples (image file name relative to train_path,
+            label file name relative to label_path), sorted by image file name
+    """
+    mtimes = {
+        "version": KITTI_INDEX_VERSION,
+        "train_mtime": _dir_mtime_ns(train_path),
+        "label_mtime": _dir_mtime_ns(label_path),
+    }
+
+    if os.path.isfile(manifest_fpath):
+        try:
+            with open(manifest_fpath) as f:
+                manifest = json.load(f)
+            if all(manifest.get(k) == v for k, v in mtimes.items()):
+                return [tuple(sample) for sample in manifest["samples"]]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    label_paths = get_label_paths(label_path)
+    samples = [(image_name, os.path.basename(label_paths[image_name])) for image_name in sorted(label_paths)]
+
+    manifest = {**mtimes, "samples": samples}
+    try:
+        tmp_fpath = manifest_fpath + ".tmp"
+        with open(tmp_fpath, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_fpath, manifest_fpath)
+    except OSError:
+        pass
+    return samples
+
+
 class KittiData(Dataset):
     """
     Dataloader class for kitti road segmentation datasets.
@@ -138,12 +329,16 @@ class KittiData(Dataset):
             are relative to
         transform: Pytorch torchvision transform
     """
-    def __init__(self, split:str, data_root: str, transform=None):
+    def __init__(self, split:str, data_root: str, transform=None, keep_uint8: bool = False):
         """
         For convenience we are using train_path can be path to the training
         dataset or test dataset depending on the value of split variable.
+
+        If keep_uint8 is set, the transform receives a uint8 image and label map,
+        as in `SemData`.
         """
         self.transform = transform
+        self.keep_uint8 = keep_uint8
         if split == "train":
             self.train_path = data_root + "/training/image_2"
             self.label_path = data_root + "/training/gt_image_2"
@@ -151,9 +346,11 @@ class KittiData(Dataset):
             self.train_path = data_root + "/testing/image_2"
             self.label_path = data_root + "/testing/gt_image_2"
 
+        manifest_fpath = os.path.join(data_root, f".kitti_{split}_index.json")
+        self.samples = load_kitti_index(self.train_path, self.label_path, manifest_fpath)
+
     def __len__(self):
-        path, dirs, files = next(os.walk(self.train_path))
-        return len(files)
+        return len(self.samples)
 
     def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
         """
@@ -172,21 +369,23 @@ class KittiData(Dataset):
         Resize the image and label so that H=256, W=256. Consider using cv2.resize()
         """
 
-        label_paths = get_label_paths(self.label_path)
-        image_path = list(label_paths)[index]
+        image_path, label_path = self.samples[index]
 
         image = cv2.imread(os.path.join(self.train_path, image_path), cv2.IMREAD_COLOR) # BGR 3 channel ndarray wiht shape H * W * 3
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # convert cv2 read image from BGR order to RGB order
         image = cv2.resize(image, (256, 256))
-        image = np.float32(image)
 
-        label_path = label_paths[image_path]
-        label = imageio.imread(label_path)
+        label = imageio.imread(os.path.join(self.label_path, label_path))
         label = cv2.resize(label, (256, 256))
         label = label[:,:,2]
         truth_table = label == 255
         label = np.invert(truth_table)
-        label = label.astype(np.int64)
+
+        if self.keep_uint8:
+            label = label.astype(np.uint8)
+        else:
+            image = np.float32(image)
+            label = label.astype(np.int64)
 
         if image.shape[0] != label.shape[0] or image.shape[1] != label.shape[1]:
             raise (RuntimeError("Image & label shape mismatch: " + image_path + " " + label_path + "\n"))
@@ -195,3 +394,13 @@ class KittiData(Dataset):
             image, label = self.transform(image, label)
 
         return image, label
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack a semantic segmentation split for PackedSemData.")
+    parser.add_argument("--split", type=str, required=True, choices=["train", "val", "test"])
+    parser.add_argument("--data_root", type=str, required=True)
+    parser.add_argument("--data_list", type=str, required=True)
+    parser.add_argument("--pack_fpath", type=str, required=True)
+    opts = parser.parse_args()
+    pack_dataset(opts.split, opts.data_root, opts.data_list, opts.pack_fpath)
@@ -3,6 +3,7 @@ from typing import Tuple
 import torch
 from torch import nn
 
+import src.vision.batch_transforms as batch_transform
 import src.vision.cv2_transforms as transform
 from src.vision.part5_pspnet import PSPNet
 from src.vision.part4_segmentation_net import SimpleSegmentationNet
@@ -51,7 +52,8 @@ def get_model_and_optimizer(args) -> Tuple[nn.Module, torch.optim.Optimizer]:
         model = PSPNet(
             pretrained=args.pretrained,
             num_classes=args.classes,
-            zoom_factor=args.zoom_factor
+            zoom_factor=args.zoom_factor,
+            checkpoint_segments=getattr(args, "checkpoint_segments", 0)
         )
         
         optimizer = torch.optim.SGD([
@@ -124,6 +126,11 @@ def get_train_transform(args) -> transform.Compose:
     Note that your scaling should be confined to the [scale_min,scale_max] params in the
     args. Also, your rotation should be confined to the [rotate_min,rotate_max] params.
 
+    If `args.fused_augmentation` is set, the flip, rotation, scaling and crop are
+    fused into a single `transform.FusedAffineCrop` warp instead. If
+    `args.batch_augmentation` is set, only the short side is resized here, and
+    the augmentation runs per batch, see `get_batch_train_transform()`.
+
     To prevent black artifacts after a rotation or a random crop, specify the paddings
     to be equal to the Imagenet mean to pad any black regions.
 
@@ -150,18 +157,31 @@ def get_train_transform(args) -> transform.Compose:
 # namespace(short_size=240, train_h=201, train_w=201, scale_min=0.5, 
 #           scale_max=2.0, rotate_min=-10, rotate_max=10, ignore_label=255)
 
-    segtransform = [
-        transform.ResizeShort(args.short_size),
-        transform.RandomHorizontalFlip(),
-        transform.RandomGaussianBlur(),
-        transform.RandRotate(rotate=(args.rotate_min, args.rotate_max),
-                             padding=mean, ignore_label=args.ignore_label),
-        transform.RandScale(scale=(args.scale_min, args.scale_max)),
-        transform.Crop(size=(args.train_h, args.train_w),
-                       crop_type='rand', padding=mean),
-        transform.ToTensor(),
-        transform.Normalize(mean, std)
-    ]
+    if getattr(args, "batch_augmentation", False):
+        # every sample must have the same size to be collated
+        segtransform = [transform.ResizeShort(args.short_size)]
+    elif getattr(args, "fused_augmentation", False):
+        # one warp per sample; blurring the final crop is cheaper than the full frame
+        segtransform = [
+            transform.FusedAffineCrop(short_size=args.short_size,
+                                      size=(args.train_h, args.train_w),
+                                      scale=(args.scale_min, args.scale_max),
+                                      rotate=(args.rotate_min, args.rotate_max),
+                                      padding=mean, ignore_label=args.ignore_label),
+            transform.RandomGaussianBlur(),
+        ]
+    else:
+        segtransform = [
+            transform.ResizeShort(args.short_size),
+            transform.RandomHorizontalFlip(),
+            transform.RandomGaussianBlur(),
+            transform.RandRotate(rotate=(args.rotate_min, args.rotate_max),
+                                 padding=mean, ignore_label=args.ignore_label),
+            transform.RandScale(scale=(args.scale_min, args.scale_max)),
+            transform.Crop(size=(args.train_h, args.train_w),
+                           crop_type='rand', padding=mean),
+        ]
+    segtransform += get_tensor_transform(args, mean, std)
     train_transform = transform.Compose(segtransform)
 
     ###########################################################################
@@ -200,12 +220,57 @@ def get_val_transform(args) -> transform.Compose:
     segtransform = [
         transform.ResizeShort(args.short_size),
         transform.Crop(size=(args.train_h, args.train_w), padding=mean),
-        transform.ToTensor(),
-        transform.Normalize(mean, std)
     ]
+    segtransform += get_tensor_transform(args, mean, std)
     val_transform = transform.Compose(segtransform)
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
     return val_transform
+
+
+def get_tensor_transform(args, mean, std) -> list:
+    """
+    Final conversion of the augmented Numpy arrays into Pytorch tensors.
+
+    If `args.uint8_pipeline` is set, the dataset hands uint8 arrays to the transform
+    and they stay uint8 here too; `run_epoch` then converts and normalizes the whole
+    batch at once with `transform.normalize_uint8()`, after it reaches its device.
+
+    Args:
+        args: object containing specified hyperparameters
+        mean: mean values for each RGB channel
+        std: standard deviation values for each RGB channel
+
+    Returns:
+        list of transforms
+    """
+    if getattr(args, "uint8_pipeline", False):
+        return [transform.ToTensor(keep_uint8=True)]
+    return [transform.ToTensor(), transform.Normalize(mean, std)]
+
+
+def get_batch_train_transform(args) -> batch_transform.Compose:
+    """
+    Compose the data augmentation of `get_train_transform()` as batched tensor ops,
+    applied by `run_epoch` to each collated, normalized training batch.
+
+    Since the batch is already normalized, padding with the Imagenet mean becomes
+    padding with zeros.
+
+    Args:
+        args: object containing specified hyperparameters
+
+    Returns:
+        train_batch_transform
+    """
+    batchtransform = [
+        batch_transform.RandomHorizontalFlip(),
+        batch_transform.RandRotateScaleCrop(size=(args.train_h, args.train_w),
+                                            scale=(args.scale_min, args.scale_max),
+                                            rotate=(args.rotate_min, args.rotate_max),
+                                            padding=[0.0, 0.0, 0.0], ignore_label=args.ignore_label),
+        batch_transform.RandomGaussianBlur(),
+    ]
+    return batch_transform.Compose(batchtransform)
@@ -67,13 +67,7 @@ class SimpleSegmentationNet(nn.Module):
         """
         _, _, H, W = x.shape
 
-        x = self.layer0(x)
-        x = self.resnet.layer1(x)
-        x = self.resnet.layer2(x)
-        x = self.resnet.layer3(x)
-        x = self.resnet.layer4(x)
-
-        x = self.cls(x)
+        x = self.__features(x)
 
         aux_loss = torch.Tensor([0])
 
@@ -98,4 +92,28 @@ class SimpleSegmentationNet(nn.Module):
         #######################################################################
         return logits, yhat, main_loss, aux_loss
 
+    def __features(self, x: torch.Tensor) -> torch.Tensor:
+        """Backbone and classifier, at the backbone's output resolution."""
+        x = self.layer0(x)
+        x = self.resnet.layer1(x)
+        x = self.resnet.layer2(x)
+        x = self.resnet.layer3(x)
+        x = self.resnet.layer4(x)
+
+        x = self.cls(x)
+        return x
+
+    def forward_logits(self, x: torch.Tensor) -> torch.Tensor:
+        """Lean inference entry point: only compute the upsampled logits, skipping the
+        argmax and the losses.
+
+        Args:
+            x: tensor of shape (N,C,H,W) representing batch of normalized input image
+
+        Returns:
+            logits: tensor of shape (N,num_classes,H,W), identical to `forward()`'s
+        """
+        _, _, H, W = x.shape
+        return F.interpolate(self.__features(x), size=(H, W), mode='bilinear')
+
 
@@ -1,7 +1,9 @@
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
+import contextlib
 import math
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch import nn
 
 from src.vision.resnet import resnet50
@@ -27,6 +29,7 @@ class PSPNet(nn.Module):
         criterion=nn.CrossEntropyLoss(ignore_index=255),
         pretrained: bool = True,
         deep_base: bool = True,
+        checkpoint_segments: int = 0,
     ) -> None:
         """
         Args:
@@ -38,6 +41,11 @@ class PSPNet(nn.Module):
             use_ppm: boolean representing whether to use the Pyramid Pooling Module
             criterion: loss function module
             pretrained: boolean representing ...
+            checkpoint_segments: memory-vs-compute knob for activation checkpointing of the dilated
+                layer3 and layer4 during training. Each layer is split into this many segments, and
+                only the segments' inputs are kept for backward; everything in between is recomputed.
+                0 disables checkpointing, 1 keeps only each layer's input (least memory), and 6
+                checkpoints every Bottleneck (3 for layer4, which has 3 blocks).
         """
         super().__init__()
         assert layers == 50
@@ -48,6 +56,9 @@ class PSPNet(nn.Module):
         self.zoom_factor = zoom_factor
         self.use_ppm = use_ppm
         self.criterion = criterion
+        self.checkpoint_segments = checkpoint_segments
+        # names of frozen layers, e.g. ["layer0", "layer1"], whose BatchNorm stays in eval mode (see `train()`)
+        self.frozen_layers: List[str] = []
 
         self.layer0 = None
         self.layer1 = None
@@ -114,6 +125,17 @@ class PSPNet(nn.Module):
         self.cls = self.__create_classifier(in_feats=fea_dim, out_feats=512, num_classes=num_classes)
         self.aux = self.__create_classifier(in_feats=1024, out_feats=256, num_classes=num_classes)
 
+    def train(self, mode: bool = True) -> "PSPNet":
+        """Set training mode, except for the BatchNorm of `self.frozen_layers`: it keeps
+        normalizing with, and no longer updates, its running statistics, which belong to
+        the frozen weights as much as the convolutions do."""
+        super().train(mode)
+        for name in self.frozen_layers:
+            for module in getattr(self, name).modules():
+                if isinstance(module, nn.modules.batchnorm._BatchNorm):
+                    module.eval()
+        return self
+
     def __replace_conv_with_dilated_conv(self):
         """Increase the receptive field by reducing stride and increasing dilation.
         In Layer3, in every `Bottleneck`, we will change the 3x3 `conv2`, we will
@@ -244,32 +266,144 @@ class PSPNet(nn.Module):
         h = int(math.ceil(x_size[2]/8*self.zoom_factor))
         w = int(math.ceil(x_size[3]/8*self.zoom_factor))
 
-        out = self.layer0(x)
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = self.layer3(out)
+        logits, aux3 = self.__main_branch(x, (h, w))
 
-        aux3 = out
-        
-        out = self.layer4(out)
-        aux3 = self.aux(aux3)
-        aux3 = F.interpolate(aux3, size=(h,w), mode='bilinear')
+        #######################################################################
+        #                             END OF YOUR CODE                        #
+        #######################################################################
+        return self.__outputs(logits, aux3, (h, w), y)
 
-        out = self.ppm(out)
-        logits = self.cls(out)
-        logits = F.interpolate(logits, size=(h,w), mode='bilinear')
+    def __outputs(
+        self, logits: torch.Tensor, aux3: torch.Tensor, size: Tuple[int, int], y: Optional[torch.Tensor]
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """Predicted labels, and if ground truth is given, the main and aux losses, as returned by `forward()`."""
         yhat = torch.argmax(logits, dim=1)
-        
-        
-        if y == None:
+
+        if y is None:
+            # the aux head only contributes to the loss
             main_loss = None
             aux_loss = None
         else:
+            aux3 = self.aux(aux3)
+            aux3 = F.interpolate(aux3, size=size, mode='bilinear')
             main_loss = self.criterion(logits, y)
-            aux_loss = self.criterion(aux3, y)        
-        
-
-        #######################################################################
-        #                             END OF YOUR CODE                        #
-        #######################################################################
+            aux_loss = self.criterion(aux3, y)
         return logits, yhat, main_loss, aux_loss
+
+    def __main_branch(self, x: torch.Tensor, size: Tuple[int, int]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Run the backbone, PPM and main classifier, i.e. everything but the aux head.
+
+        Args:
+            x: tensor of shape (N,C,H,W) representing batch of normalized input image
+            size: (h,w) resolution to upsample the logits to
+
+        Returns:
+            logits: tensor of shape (N,num_classes,h,w)
+            aux3: output of layer3, the input of the aux head
+        """
+        aux3, out = self.extract_features(x)
+        return self.__classify(out, size), aux3
+
+    def __classify(self, features: torch.Tensor, size: Tuple[int, int]) -> torch.Tensor:
+        """Run the PPM and main classifier on the output of layer4, and upsample the logits to `size`."""
+        out = self.ppm(features)
+        logits = self.cls(out)
+        return F.interpolate(logits, size=size, mode='bilinear')
+
+    def extract_features(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Run the ResNet backbone only, i.e. layer0 through layer4.
+
+        Args:
+            x: tensor of shape (N,C,H,W) representing batch of normalized input image
+
+        Returns:
+            aux3: output of layer3, the input of the aux head
+            features: output of layer4, the input of the PPM
+        """
+        out = self.layer0(x)
+        out = self.layer1(out)
+        out = self.layer2(out)
+        out = self.__run_dilated_layer(self.layer3, out)
+
+        aux3 = out
+
+        out = self.__run_dilated_layer(self.layer4, out)
+        return aux3, out
+
+    def forward_from_features(
+        self,
+        aux3: torch.Tensor,
+        features: torch.Tensor,
+        input_size: Tuple[int, int],
+        y: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """`forward()`, starting from the outputs of `extract_features()`, e.g. precomputed
+        with a frozen backbone. Only the PPM, the classifier and the aux head are run.
+
+        Args:
+            aux3: output of layer3
+            features: output of layer4
+            input_size: (H,W) of the input image the features were extracted from
+            y: as in `forward()`
+
+        Returns:
+            logits, yhat, main_loss, aux_loss: as in `forward()`
+        """
+        h = (input_size[0] * self.zoom_factor + 7) // 8
+        w = (input_size[1] * self.zoom_factor + 7) // 8
+        logits = self.__classify(features, (h, w))
+        return self.__outputs(logits, aux3, (h, w), y)
+
+    def __run_dilated_layer(self, layer: nn.Sequential, x: torch.Tensor) -> torch.Tensor:
+        """Run layer3 or layer4, with activation checkpointing of `checkpoint_segments` segments if training."""
+        if self.checkpoint_segments <= 0 or not (self.training and torch.is_grad_enabled()):
+            return layer(x)
+
+        blocks = list(layer)
+        num_segments = min(self.checkpoint_segments, len(blocks))
+        bounds = [round(i * len(blocks) / num_segments) for i in range(num_segments + 1)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            segment = nn.Sequential(*blocks[start:end])
+            x = torch.utils.checkpoint.checkpoint(
+                segment,
+                x,
+                use_reentrant=False,
+                context_fn=lambda segment=segment: (contextlib.nullcontext(), frozen_batch_norm_stats(segment)),
+            )
+        return x
+
+    def forward_logits(self, x: torch.Tensor) -> torch.Tensor:
+        """Lean inference entry point: only compute the upsampled logits of the main
+        classifier, skipping the aux head, the argmax and the losses.
+
+        Args:
+            x: tensor of shape (N,C,H,W) representing batch of normalized input image
+
+        Returns:
+            logits: tensor of shape (N,num_classes,H/zoom_factor,W/zoom_factor), identical to `forward()`'s
+        """
+        x_size = x.size()
+        assert (x_size[2] - 1) % 8 == 0 and (x_size[3] - 1) % 8 == 0
+        # same as ceil(H/8*zoom_factor), in integer arithmetic, so that the output size
+        # stays symbolic in the input size when the model is exported (see `onnx_export`)
+        h = (x_size[2] * self.zoom_factor + 7) // 8
+        w = (x_size[3] * self.zoom_factor + 7) // 8
+
+        logits, _ = self.__main_branch(x, (h, w))
+        return logits
+
+
+@contextlib.contextmanager
+def frozen_batch_norm_stats(module: nn.Module):
+    """While recomputing a checkpointed segment, BatchNorm must normalize with the batch
+    statistics again, without updating its running statistics a second time."""
+    batch_norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    saved = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in batch_norms]
+    for bn in batch_norms:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, (momentum, num_batches_tracked) in zip(batch_norms, saved):
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(num_batches_tracked)
@@ -13,6 +13,7 @@ import torch.nn as nn
 import torch.backends.cudnn as cudnn
 import torch.utils.data
 
+from src.vision.model_io import build_from_state_dict, load_state_dict_file
 from src.vision.part5_pspnet import PSPNet
 from src.vision.utils import load_class_names, get_imagenet_mean_std, get_logger, normalize_img
 
@@ -22,6 +23,10 @@ _ROOT = Path(__file__).resolve().parent.parent.parent
 logger = get_logger()
 
 
+KITTI_NUM_CLASSES = 2
+BACKBONE_LAYERS = ["layer0", "layer1", "layer2", "layer3", "layer4"]
+
+
 def load_pretrained_model(args, use_cuda: bool):
     """Load Pytorch pre-trained PSPNet model from disk of type torch.nn.DataParallel.
 
@@ -36,27 +41,30 @@ def load_pretrained_model(args, use_cuda: bool):
     """
     criterion = nn.CrossEntropyLoss(ignore_index=args.ignore_label)
 
-    model = PSPNet(
-        layers=args.layers,
-        num_classes=args.classes,
-        zoom_factor=args.zoom_factor,
-        criterion=criterion,
-        pretrained=False
-    )
-
-    # logger.info(model)
-    if use_cuda:
-        model = model.cuda()
+    def build_model() -> PSPNet:
+        return PSPNet(
+            layers=args.layers,
+            num_classes=args.classes,
+            zoom_factor=args.zoom_factor,
+            criterion=criterion,
+            pretrained=False
+        )
+
+    device = "cuda" if use_cuda else "cpu"
     cudnn.benchmark = True
 
     if os.path.isfile(args.model_path):
         logger.info(f"=> loading checkpoint '{args.model_path}'")
-        if use_cuda:
-            checkpoint = torch.load(args.model_path)
+        start = time.perf_counter()
+        # a training checkpoint (.pth), or a compact inference checkpoint (.safetensors) without the aux head
+        state_dict = load_state_dict_file(args.model_path)
+        if getattr(args, "fast_model_init", False):
+            # build on the meta device, skipping random init, since the checkpoint overwrites every weight
+            model = build_from_state_dict(build_model, state_dict, device)
         else:
-            checkpoint = torch.load(args.model_path, map_location="cpu")
-        model.load_state_dict(checkpoint["state_dict"], strict=False)
-        logger.info(f"=> loaded checkpoint '{args.model_path}'")
+            model = build_model().to(device)
+            model.load_state_dict(state_dict, strict=False)
+        logger.info(f"=> loaded checkpoint '{args.model_path}' in {time.perf_counter() - start:.3f} s")
     else:
         raise RuntimeError(f"=> no checkpoint found at '{args.model_path}'")
 
@@ -72,6 +80,14 @@ def model_and_optimizer(args, model) -> Tuple[nn.Module, torch.optim.Optimizer]:
     output classes number to 2 (the number of classes for Kitti).
     Refer to Part 3 for optimizer initialization.
 
+    The loaded model is reused in place: only the final 1x1 convs of `cls` and
+    `aux` are swapped for freshly initialized 2-class ones. The modules named in
+    `args.frozen_layers` (e.g. ["layer0", "layer1"]), and the whole backbone if
+    `args.feature_cache` is set, are frozen: their parameters stop requiring
+    gradients, and are left out of the optimizer, and their BatchNorm stays in
+    eval mode (see `PSPNet.train()`). Their param groups stay, empty,
+    so that `update_learning_rate` still finds the heads at the same positions.
+
     Args:
         args: object containing specified hyperparameters
         model: pre-trained model on Camvid
@@ -82,22 +98,28 @@ def model_and_optimizer(args, model) -> Tuple[nn.Module, torch.optim.Optimizer]:
     # TODO: YOUR CODE HERE                                                    #
     ###########################################################################
 
-    model = PSPNet(
-        pretrained=True,
-        num_classes=2,
-        zoom_factor=args.zoom_factor
-    )
-        
-    optimizer = torch.optim.SGD([
-        {'params': model.layer0.parameters(), 'lr': args.base_lr, 'momentum': args.momentum, 'weight_decay': args.weight_decay}, 
-        {'params': model.layer1.parameters(), 'lr': args.base_lr, 'momentum': args.momentum, 'weight_decay': args.weight_decay}, 
-        {'params': model.layer2.parameters(), 'lr': args.base_lr, 'momentum': args.momentum, 'weight_decay': args.weight_decay}, 
-        {'params': model.layer3.parameters(), 'lr': args.base_lr, 'momentum': args.momentum, 'weight_decay': args.weight_decay}, 
-        {'params': model.layer4.parameters(), 'lr': args.base_lr, 'momentum': args.momentum, 'weight_decay': args.weight_decay}, 
-        {'params': model.ppm.parameters(), 'lr': args.base_lr*10.0, 'momentum': args.momentum, 'weight_decay': args.weight_decay}, 
-        {'params': model.cls.parameters(), 'lr': args.base_lr*10.0, 'momentum': args.momentum, 'weight_decay': args.weight_decay}, 
-        {'params': model.aux.parameters(), 'lr': args.base_lr*10.0, 'momentum': args.momentum, 'weight_decay': args.weight_decay}
-    ])        
+    for head in [model.cls, model.aux]:
+        final_conv = head[-1]
+        head[-1] = nn.Conv2d(final_conv.in_channels, KITTI_NUM_CLASSES, kernel_size=1).to(final_conv.weight.device)
+    model.zoom_factor = args.zoom_factor
+
+    frozen_layers = set(getattr(args, "frozen_layers", []))
+    if getattr(args, "feature_cache", False):
+        # the backbone only runs once, to fill the cache
+        frozen_layers.update(BACKBONE_LAYERS)
+    for name in frozen_layers:
+        for param in getattr(model, name).parameters():
+            param.requires_grad = False
+    # their BatchNorm running statistics are frozen too, from now on and after every `model.train()`
+    model.frozen_layers = sorted(frozen_layers)
+    model.train(model.training)
+
+    param_groups = []
+    for name in BACKBONE_LAYERS + ["ppm", "cls", "aux"]:
+        lr = args.base_lr if name in BACKBONE_LAYERS else args.base_lr * 10.0
+        params = [param for param in getattr(model, name).parameters() if param.requires_grad]
+        param_groups.append({'params': params, 'lr': lr, 'momentum': args.momentum, 'weight_decay': args.weight_decay})
+    optimizer = torch.optim.SGD(param_groups)
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
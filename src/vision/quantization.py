@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+
+import argparse
+import copy
+import warnings
+from typing import Dict, Iterable, Tuple
+
+import torch
+import torch.nn as nn
+import torch.utils.data
+
+from src.vision.avg_meter import SegmentationAverageMeter
+from src.vision.part2_dataset import SemData
+from src.vision.part3_training_utils import get_val_transform
+from src.vision.part5_pspnet import PSPNet
+from src.vision.trainer import DEFAULT_ARGS
+from src.vision.utils import get_logger
+
+with warnings.catch_warnings():
+    # torch.ao.quantization is deprecated in favor of torchao, which we do not depend on
+    warnings.simplefilter("ignore", DeprecationWarning)
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+"""
+Post-training static int8 quantization of PSPNet, for CPU inference.
+
+The ResNet backbone (layer0-layer4, incl. the dilated layer3 & layer4) and the main
+classifier `cls` hold nearly all of the FLOPs. Each is quantized separately with FX
+graph mode quantization, which fuses conv-bn-relu, inserts observers, and after a
+calibration pass, swaps in quantized kernels. The cheap PPM, whose forward pass builds
+modules on the fly and cannot be traced, stays in float; activations are dequantized
+before it and re-quantized after it. The aux head is dropped.
+
+Usage:
+    python -m src.vision.quantization --model_path exp/camvid/pspnet50/model/train_epoch_100.pth \
+        --quantized_model_path exp/camvid/pspnet50/model/train_epoch_100_int8.pth
+"""
+
+
+logger = get_logger()
+
+
+QUANTIZED_SUBMODULES = ["layer0", "layer1", "layer2", "layer3", "layer4", "cls"]
+
+
+def get_quantization_backend() -> str:
+    """Pick the best quantized kernel library available on this CPU."""
+    supported_engines = torch.backends.quantized.supported_engines
+    for backend in ["x86", "fbgemm", "qnnpack"]:
+        if backend in supported_engines:
+            return backend
+    raise RuntimeError(f"No quantized engine available, only {supported_engines}")
+
+
+def prepare_pspnet(model: PSPNet, example_input: torch.Tensor) -> PSPNet:
+    """Fuse conv-bn-relu and insert observers into a float PSPNet, in place.
+
+    Args:
+        model: float PSPNet, on the CPU
+        example_input: tensor of shape (N,C,H,W) representing batch of normalized input image
+
+    Returns:
+        model: PSPNet whose quantized submodules record activation ranges when run
+    """
+    backend = get_quantization_backend()
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+
+    model.eval()
+    model.aux = None
+
+    # capture the input of each submodule, which FX needs as an example
+    example_inputs: Dict[str, tuple] = {}
+    hooks = [
+        getattr(model, name).register_forward_pre_hook(
+            lambda module, inputs, name=name: example_inputs.__setitem__(name, inputs)
+        )
+        for name in QUANTIZED_SUBMODULES
+    ]
+    with torch.no_grad():
+        model.forward_logits(example_input)
+    for hook in hooks:
+        hook.remove()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for name in QUANTIZED_SUBMODULES:
+            setattr(model, name, prepare_fx(getattr(model, name), qconfig_mapping, example_inputs[name]))
+    return model
+
+
+def convert_pspnet(model: PSPNet) -> PSPNet:
+    """Swap the observed submodules of a `prepare_pspnet()` model for quantized ones, in place."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for name in QUANTIZED_SUBMODULES:
+            setattr(model, name, convert_fx(getattr(model, name)))
+    return model
+
+
+def calibrate(model: PSPNet, calibration_loader: Iterable[Tuple[torch.Tensor, torch.Tensor]]) -> None:
+    """Feed calibration images through a `prepare_pspnet()` model, so its observers record activation ranges.
+
+    Args:
+        model: prepared PSPNet
+        calibration_loader: yields (batch of normalized images, labels) pairs; labels are unused
+    """
+    with torch.no_grad():
+        for input, _ in calibration_loader:
+            model.forward_logits(input)
+
+
+def quantize_pspnet(model: PSPNet, calibration_loader: Iterable[Tuple[torch.Tensor, torch.Tensor]]) -> PSPNet:
+    """Quantize a copy of a trained PSPNet to int8.
+
+    Args:
+        model: trained float PSPNet
+        calibration_loader: yields (batch of normalized images, labels) pairs, representative of the
+            inference data; labels are unused
+
+    Returns:
+        quantized_model: quantized PSPNet, for CPU inference through `forward_logits()`
+    """
+    example_input, _ = next(iter(calibration_loader))
+    quantized_model = prepare_pspnet(copy.deepcopy(model).cpu(), example_input)
+    calibrate(quantized_model, calibration_loader)
+    return convert_pspnet(quantized_model)
+
+
+def load_quantized_pspnet(model: PSPNet, state_dict: Dict[str, torch.Tensor]) -> PSPNet:
+    """Rebuild a quantized PSPNet from the state dict of a `quantize_pspnet()` model.
+
+    The quantized graph is recreated from the float architecture, with placeholder
+    activation ranges, which the state dict then overwrites.
+
+    Args:
+        model: float PSPNet with the same architecture as the quantized one, on the CPU
+        state_dict: state dict of the quantized model
+
+    Returns:
+        model: the quantized PSPNet
+    """
+    model = prepare_pspnet(model, torch.zeros(1, 3, 33, 33))
+    model = convert_pspnet(model)
+    model.load_state_dict(state_dict)
+    return model
+
+
+def evaluate_miou(model: nn.Module, loader: torch.utils.data.DataLoader, num_classes: int) -> SegmentationAverageMeter:
+    """Score the argmax of `model.forward_logits()` against a dataloader's labels.
+
+    Returns:
+        sam: meter accumulated over the whole dataloader
+    """
+    sam = SegmentationAverageMeter()
+    with torch.no_grad():
+        for input, target in loader:
+            yhat = torch.argmax(model.forward_logits(input), dim=1)
+            sam.update_metrics_cpu(yhat.numpy(), target.numpy(), num_classes)
+    return sam
+
+
+def main(args, quantized_model_path: str, num_calibration_images: int) -> None:
+    """Quantize a trained PSPNet with images from the train split, save it, and compare
+    its mIoU on the val split against the float model.
+
+    Args:
+        args: experiment configuration arguments, as in `DEFAULT_ARGS`
+        quantized_model_path: where to save the quantized checkpoint
+        num_calibration_images: number of train images to calibrate on
+    """
+    model = PSPNet(
+        layers=args.layers,
+        num_classes=args.classes,
+        zoom_factor=args.zoom_factor,
+        pretrained=False,
+        use_ppm=args.use_ppm,
+    )
+    checkpoint = torch.load(args.model_path, map_location="cpu")
+    model.load_state_dict(checkpoint["state_dict"], strict=False)
+    model.eval()
+
+    # calibrate on a random subset of the train split, without augmentation
+    train_data = SemData(
+        split="train", data_root=args.data_root, data_list_fpath=args.train_list, transform=get_val_transform(args)
+    )
+    generator = torch.Generator().manual_seed(args.manual_seed)
+    indices = torch.randperm(len(train_data), generator=generator)[:num_calibration_images].tolist()
+    calibration_loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(train_data, indices), batch_size=args.batch_size_val, num_workers=args.workers
+    )
+
+    logger.info(f"Calibrating on {len(indices)} images")
+    quantized_model = quantize_pspnet(model, calibration_loader)
+    torch.save({"epoch": checkpoint.get("epoch"), "state_dict": quantized_model.state_dict()}, quantized_model_path)
+    logger.info(f"Saved quantized model to {quantized_model_path}")
+
+    val_data = SemData(
+        split="val", data_root=args.data_root, data_list_fpath=args.val_list, transform=get_val_transform(args)
+    )
+    val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batch_size_val, num_workers=args.workers)
+    for name, m in [("float", model), ("int8", quantized_model)]:
+        _, _, mIoU, mAcc, allAcc = evaluate_miou(m, val_loader, args.classes).get_metrics()
+        logger.info(f"{name} val result: mIoU/mAcc/allAcc {mIoU:.4f}/{mAcc:.4f}/{allAcc:.4f}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post-training static int8 quantization of a trained PSPNet.")
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--quantized_model_path", type=str, required=True)
+    parser.add_argument("--num_calibration_images", type=int, default=300)
+    opts = parser.parse_args()
+
+    args = DEFAULT_ARGS
+    args.model_path = opts.model_path
+    main(args, opts.quantized_model_path, opts.num_calibration_images)
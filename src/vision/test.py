@@ -1,11 +1,12 @@
 #!/usr/bin/python3
 
+import abc
 import logging
 import os
 import pdb
 import time
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 import cv2
 import imageio
@@ -24,12 +25,23 @@ import torch.utils.data
 # from mseg_semantic.utils import dataset, transform, config
 
 import src.vision.cv2_transforms as transform
-from src.vision.avg_meter import AverageMeter
+from src.vision.avg_meter import AverageMeter, SegmentationAverageMeter
+from src.vision.background_writer import BackgroundWriter, imwrite
+from src.vision.inference_utils import freeze_for_inference
+from src.vision.model_io import build_from_state_dict, load_state_dict_file
 from src.vision.part2_dataset import SemData
+from src.vision.quantization import load_quantized_pspnet
 from src.vision.part5_pspnet import PSPNet
 from src.vision.part4_segmentation_net import SimpleSegmentationNet
 from src.vision.trainer import DEFAULT_ARGS
-from src.vision.utils import load_class_names, get_imagenet_mean_std, get_logger, normalize_img
+from src.vision.utils import (
+    get_autocast,
+    get_imagenet_mean_std,
+    get_logger,
+    get_memory_format,
+    load_class_names,
+    normalize_img,
+)
 from src.vision.accuracy_calculator import AccuracyCalculator
 
 """
@@ -54,25 +66,44 @@ logger = get_logger()
 
 
 
-def create_test_loader(args) -> Tuple[torch.utils.data.dataloader.DataLoader, List[Tuple[str,str]]]:
+def create_test_loader(
+    args, use_batched_inference: bool = False
+) -> Tuple[torch.utils.data.dataloader.DataLoader, List[Tuple[str,str]]]:
     """Create a Pytorch dataloader from a dataroot and list of relative paths.
     
     Args:
         args: CfgNode object
-        use_batched_inference: whether to process images in batch mode
+        use_batched_inference: whether to process images in batch mode, i.e.
+            resize them to `args.base_size` in the workers, and return batches of
+            `args.test_batch_size` images bucketed by shape (see `BaseSizeTestData`)
     
     Returns:
         test_loader
         data_list: list of 2-tuples (relative rgb path, relative label path)
     """
-    # no resizing on the fly using OpenCV and also normalize images on the fly
-    test_transform = transform.Compose([transform.ToTensor()])
+    if use_batched_inference:
+        test_data = SemData(
+            split=args.split,
+            data_root=args.data_root,
+            data_list_fpath=args.test_list,
+            transform=None
+        )
+        test_loader = torch.utils.data.DataLoader(
+            BaseSizeTestData(test_data, args.base_size, args.scales[0]),
+            batch_size=args.test_batch_size,
+            shuffle=False,
+            num_workers=args.workers,
+            pin_memory=True,
+            collate_fn=collate_by_shape
+        )
+        return test_loader, test_data.data_list
 
+    # no resizing on the fly using OpenCV and also normalize images on the fly
     test_data = SemData(
         split=args.split,
         data_root=args.data_root,
         data_list_fpath=args.test_list,
-        transform=test_transform
+        transform=None
     )
 
     data_list = test_data.data_list
@@ -81,7 +112,7 @@ def create_test_loader(args) -> Tuple[torch.utils.data.dataloader.DataLoader, Li
     batch_size = 1
     
     test_loader = torch.utils.data.DataLoader(
-        test_data,
+        TensorTestData(test_data),
         batch_size=batch_size,
         shuffle=False,
         num_workers=args.workers,
@@ -113,6 +144,90 @@ def resize_by_scaled_short_side(image: np.ndarray, base_size: int, scale: float)
     return image_scaled
 
 
+class TensorTestData(torch.utils.data.Dataset):
+    def __init__(self, dataset: SemData) -> None:
+        """
+        Wraps a `SemData` (without transform), converting each image to a tensor.
+
+        On the test split, a `SemData` transform is given a dummy label (the image's
+        first channel) instead of the ground truth; here, the ground truth label is
+        kept, so that predictions can be scored against it (see `inline_metrics`).
+
+        Args:
+            dataset: SemData with `transform=None`
+        """
+        self.dataset = dataset
+        self.to_tensor = transform.ToTensor()
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns:
+            image: float32 tensor of shape (C,H,W), at raw resolution
+            label: int64 tensor of shape (H,W), the ground truth label map
+        """
+        image, label = self.dataset[index]
+        return self.to_tensor(image, label)
+
+
+class BaseSizeTestData(torch.utils.data.Dataset):
+    def __init__(self, dataset: SemData, base_size: int, scale: float) -> None:
+        """
+        Wraps a `SemData` (without transform), so that DataLoader workers already
+        resize each image such that its short side is scale * base_size.
+
+        Args:
+            dataset: SemData with `transform=None`
+            base_size: shorter side of image
+            scale: scaling factor for image
+        """
+        self.dataset = dataset
+        self.base_size = base_size
+        self.scale = scale
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, index: int) -> Tuple[int, np.ndarray, np.ndarray]:
+        """
+        Returns:
+            index: index of the example within the dataset
+            image_scaled: float32 RGB image with short side scale * base_size
+            label: ground truth label map, at raw resolution
+        """
+        image, label = self.dataset[index]
+        image_scaled = resize_by_scaled_short_side(image, self.base_size, self.scale)
+        return index, image_scaled, label
+
+
+def collate_by_shape(
+    samples: List[Tuple[int, np.ndarray, np.ndarray]]
+) -> List[Tuple[List[int], torch.Tensor, List[np.ndarray]]]:
+    """Group the samples of a batch into buckets of identically shaped images, so that
+    each bucket can be stacked and fed through the network together.
+
+    Args:
+        samples: list of (index, image_scaled, label) from `BaseSizeTestData`
+
+    Returns:
+        buckets: list of (indices, images, labels), where images is a tensor of
+            shape (N,H,W,C), and labels is a list of N raw resolution label maps
+    """
+    buckets = {}
+    for index, image, label in samples:
+        buckets.setdefault(image.shape, []).append((index, image, label))
+    return [
+        (
+            [index for index, _, _ in bucket],
+            torch.from_numpy(np.stack([image for _, image, _ in bucket])),
+            [label for _, _, label in bucket],
+        )
+        for bucket in buckets.values()
+    ]
+
+
 def pad_to_crop_sz(
     image: np.ndarray, crop_h: int, crop_w: int, mean: Tuple[float, float, float]
 ) -> Tuple[np.ndarray, int, int]:
@@ -165,6 +280,120 @@ def imread_rgb(img_fpath: str) -> np.ndarray:
     return rgb_img
 
 
+class InferenceBackend(abc.ABC):
+    """Computes the logits of a batch of normalized crops, for `InferenceTask`'s
+    sliding-window and multi-scale logic, independently of the runtime executing the network."""
+
+    @abc.abstractmethod
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            input: tensor of shape (B,C,H,W) representing normalized crops
+
+        Returns:
+            logits: tensor of shape (B,num_classes,H',W'), on the same device as the input
+        """
+
+
+class TorchBackend(InferenceBackend):
+    def __init__(self, model: nn.Module) -> None:
+        """
+        Args:
+            model: PSPNet or SimpleSegmentationNet, in eval mode
+        """
+        self.model = model
+
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            # predictions & losses are not needed, only the logits
+            return self.model.forward_logits(input)
+
+
+class CompiledTorchBackend(TorchBackend):
+    def __init__(
+        self,
+        model: nn.Module,
+        batch_buckets: List[int],
+        compile_backend: str = "inductor",
+        memory_format: torch.memory_format = torch.contiguous_format,
+    ) -> None:
+        """Run `forward_logits()` compiled with `torch.compile`, for static input shapes.
+
+        Sliding window crops always have the crop size, so only the batch size varies (e.g. the
+        last micro-batch of an image). Each batch is zero-padded up to the smallest of a few
+        batch size buckets, so that compilation only happens once per bucket, at warm-up.
+
+        Args:
+            model: PSPNet or SimpleSegmentationNet, in eval mode
+            batch_buckets: batch sizes to compile for; larger batches are compiled on demand
+            compile_backend: `torch.compile` backend
+            memory_format: memory format of the inputs, which the compiled graphs are specialized for
+        """
+        super().__init__(model)
+        self.memory_format = memory_format
+        self.batch_buckets = sorted(batch_buckets)
+        self.compiled_forward = torch.compile(model.forward_logits, dynamic=False, backend=compile_backend)
+
+    def warm_up(self, crop_h: int, crop_w: int, device: torch.device, num_steady_calls: int = 3) -> None:
+        """Compile every batch size bucket, and log first-call (i.e. compilation) vs. steady-state latency.
+
+        Args:
+            crop_h: height of the sliding window crops
+            crop_w: width of the sliding window crops
+            device: device of the model
+            num_steady_calls: number of calls to average steady-state latency over
+        """
+        for batch_size in self.batch_buckets:
+            input = torch.zeros((batch_size, 3, crop_h, crop_w), device=device)
+            start = time.time()
+            self(input)
+            first_call_latency = time.time() - start
+
+            start = time.time()
+            for _ in range(num_steady_calls):
+                self(input)
+            steady_latency = (time.time() - start) / num_steady_calls
+            logger.info(
+                f"Compiled batch {batch_size}x3x{crop_h}x{crop_w}: first call {first_call_latency:.3f}s, "
+                f"steady state {steady_latency:.3f}s"
+            )
+
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        batch_size = input.shape[0]
+        bucket = next((bucket for bucket in self.batch_buckets if bucket >= batch_size), batch_size)
+        if bucket > batch_size:
+            padding = input.new_zeros((bucket - batch_size, *input.shape[1:]))
+            input = torch.cat([input, padding], 0)
+        input = input.contiguous(memory_format=self.memory_format)
+        with torch.no_grad():
+            return self.compiled_forward(input)[:batch_size]
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    def __init__(self, onnx_fpath: str, num_threads: int = 0) -> None:
+        """Run a model exported by `src.vision.onnx_export` on ONNX Runtime's CPU execution provider.
+
+        Args:
+            onnx_fpath: path to .onnx file
+            num_threads: number of intra-op threads, or 0 for ONNX Runtime's default
+        """
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnxruntime backend requires the `onnxruntime` package") from None
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_fpath, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, input: torch.Tensor) -> torch.Tensor:
+        input_np = input.detach().cpu().numpy()
+        logits = self.session.run(None, {self.input_name: input_np})[0]
+        return torch.from_numpy(logits).to(input.device)
+
+
 class InferenceTask:
     def __init__(
         self,
@@ -215,13 +444,25 @@ class InferenceTask:
         self.eval_taxonomy = eval_taxonomy
         self.scales = scales
         self.use_gpu = use_gpu
+        # number of sliding window crops fed through the network at once
+        self.tile_batch_size = getattr(args, "tile_batch_size", 1)
+        # number of images per dataloader batch; batching requires single-scale inference
+        self.test_batch_size = getattr(args, "test_batch_size", 1)
+        # predictions are encoded & written to disk by background threads
+        self.writer_threads = getattr(args, "writer_threads", 0)
+        self.writer_queue_size = getattr(args, "writer_queue_size", 16)
+        # memory format of the network input, see `utils.get_memory_format()`
+        self.memory_format = get_memory_format(args)
 
         self.mean, self.std = get_imagenet_mean_std()
-        self.model = self.load_model(args)
+        self.model = None
+        self.backend = self.load_backend(args)
         self.softmax = nn.Softmax(dim=1)
 
         self.gray_folder = None  # optional, intended for dataloader use
         self.data_list = None  # optional, intended for dataloader use
+        # optional, accumulates IoU statistics vs. the dataloader's labels as predictions are made
+        self.sam = SegmentationAverageMeter() if getattr(args, "inline_metrics", False) else None
 
         if model_taxonomy == "universal" and eval_taxonomy == "universal":
             # See note above.
@@ -242,6 +483,38 @@ class InferenceTask:
         # (multi-scale vs. single-scale)
         self.scales_str = "ms" if len(args.scales) > 1 else "ss"
 
+    def load_backend(self, args) -> InferenceBackend:
+        """Set up the runtime executing the network, selected by `args.inference_backend`.
+
+        Args:
+            args:
+
+        Returns:
+            backend
+        """
+        backend = getattr(args, "inference_backend", "torch")
+        if backend == "torch":
+            self.model = self.load_model(args)
+            if not getattr(args, "compile", False):
+                return TorchBackend(self.model)
+
+            self.model.eval()
+            # crops are fed in micro-batches of `tile_batch_size`, doubled by flipping
+            compiled_backend = CompiledTorchBackend(
+                self.model,
+                [2 * self.tile_batch_size],
+                getattr(args, "compile_backend", "inductor"),
+                self.memory_format,
+            )
+            compiled_backend.warm_up(self.crop_h, self.crop_w, next(self.model.parameters()).device)
+            return compiled_backend
+        elif backend == "onnxruntime":
+            # ONNX Runtime's CPU execution provider
+            self.use_gpu = False
+            logger.info(f"=> loading ONNX model '{args.onnx_path}'")
+            return OnnxRuntimeBackend(args.onnx_path, getattr(args, "onnx_num_threads", 0))
+        raise ValueError(f"Unknown inference backend '{backend}'")
+
     def load_model(self, args):
         """Load Pytorch pre-trained model from disk of type torch.nn.DataParallel.
 
@@ -254,39 +527,63 @@ class InferenceTask:
             model
         """
         criterion = nn.CrossEntropyLoss(ignore_index=args.ignore_label)
-        if args.arch == "PSPNet":
-            model = PSPNet(
-                layers=args.layers,
-                num_classes=args.classes,
-                zoom_factor=args.zoom_factor,
-                criterion=criterion,
-                pretrained=False,
-                use_ppm=args.use_ppm
-            )
-        elif args.arch == "SimpleSegmentationNet":
-            model = SimpleSegmentationNet(
-                pretrained=True,
-                num_classes=args.classes,
-                criterion=criterion
-            )
-        
+        quantized = getattr(args, "quantized", False)
+        # build on the meta device, skipping random init, since the checkpoint overwrites every weight
+        fast_model_init = getattr(args, "fast_model_init", False) and not quantized
+
+        def build_model(has_aux: bool) -> nn.Module:
+            if args.arch == "PSPNet":
+                model = PSPNet(
+                    layers=args.layers,
+                    num_classes=args.classes,
+                    zoom_factor=args.zoom_factor,
+                    criterion=criterion,
+                    pretrained=False,
+                    use_ppm=args.use_ppm
+                )
+                if not has_aux:
+                    # inference checkpoint from `src.vision.model_io`, without the aux head, which is unused here
+                    model.aux = None
+                return model
+            elif args.arch == "SimpleSegmentationNet":
+                return SimpleSegmentationNet(
+                    # the ImageNet weights would be overwritten by the checkpoint anyway
+                    pretrained=not fast_model_init,
+                    num_classes=args.classes,
+                    criterion=criterion
+                )
 
-        # logger.info(model)
-        if self.use_gpu:
-            model = model.cuda()
+        if quantized and self.use_gpu:
+            # quantized kernels only exist for the CPU
+            logger.info("=> int8 model, running inference on the CPU")
+            self.use_gpu = False
+        device = "cuda" if self.use_gpu else "cpu"
         cudnn.benchmark = True
 
         if os.path.isfile(args.model_path):
             logger.info(f"=> loading checkpoint '{args.model_path}'")
-            if self.use_gpu:
-                checkpoint = torch.load(args.model_path)
+            start = time.perf_counter()
+            # a training checkpoint (.pth), or a compact inference checkpoint (.safetensors)
+            state_dict = load_state_dict_file(args.model_path)
+            has_aux = any(name.startswith("aux.") for name in state_dict)
+            if quantized:
+                # checkpoint saved by `src.vision.quantization`
+                model = load_quantized_pspnet(build_model(has_aux), state_dict)
+            elif fast_model_init:
+                model = build_from_state_dict(lambda: build_model(has_aux), state_dict, device)
             else:
-                checkpoint = torch.load(args.model_path, map_location="cpu")
-            model.load_state_dict(checkpoint["state_dict"], strict=False)
-            logger.info(f"=> loaded checkpoint '{args.model_path}'")
+                model = build_model(has_aux).to(device)
+                model.load_state_dict(state_dict, strict=False)
+            logger.info(f"=> loaded checkpoint '{args.model_path}' in {time.perf_counter() - start:.3f} s")
         else:
             raise RuntimeError(f"=> no checkpoint found at '{args.model_path}'")
 
+        if getattr(args, "freeze_for_inference", False) and not quantized:
+            # fold BatchNorm into convs, drop dropout & the aux head
+            model = freeze_for_inference(model)
+
+        model = model.to(memory_format=self.memory_format)
+
         return model
 
     def execute(self) -> None:
@@ -296,12 +593,17 @@ class InferenceTask:
         or video file (.mp4, etc), or directory input.
         """
         logger.info(">>>>>>>>>>>>>> Start inference task >>>>>>>>>>>>>")
-        self.model.eval()
+        if self.model is not None:
+            self.model.eval()
 
         if self.input_file is None and self.args.dataset != "default":
             # evaluate on a train or test dataset
-            test_loader, self.data_list = create_test_loader(self.args)
-            self.execute_on_dataloader(test_loader)
+            use_batched_inference = self.test_batch_size > 1 and len(self.scales) == 1
+            test_loader, self.data_list = create_test_loader(self.args, use_batched_inference)
+            if use_batched_inference:
+                self.execute_on_batched_dataloader(test_loader)
+            else:
+                self.execute_on_dataloader(test_loader)
             logger.info("<<<<<<<<< Inference task completed <<<<<<<<<")
             return
 
@@ -388,6 +690,66 @@ class InferenceTask:
         Args:
              test_loader:
         """
+        self.make_gray_folder()
+
+        data_time = AverageMeter()
+        batch_time = AverageMeter()
+        end = time.time()
+
+        with self.make_writer() as writer:
+            for i, (input, target) in enumerate(test_loader):
+                logger.info(f"On image {i}")
+                data_time.update(time.time() - end)
+
+                # determine path for grayscale label map
+                image_path, _ = self.data_list[i]
+                image_name = Path(image_path).stem
+
+                gray_path = os.path.join(self.gray_folder, image_name + ".png")
+                if Path(gray_path).exists():
+                    self.update_metrics(gray_path, target.squeeze(0).numpy())
+                    continue
+
+                # convert Pytorch tensor -> Numpy, then feedforward
+                input = np.squeeze(input.numpy(), axis=0)
+                image = np.transpose(input, (1, 2, 0))
+                gray_img = self.execute_on_img(image)
+                self.update_metrics(gray_img, target.squeeze(0).numpy())
+
+                batch_time.update(time.time() - end)
+                end = time.time()
+                writer.submit(imwrite, gray_path, gray_img)
+
+                # todo: update to time remaining.
+                if ((i + 1) % self.args.print_freq == 0) or (i + 1 == len(test_loader)):
+                    logger.info(
+                        "Test: [{}/{}] "
+                        "Data {data_time.val:.3f} ({data_time.avg:.3f}) "
+                        "Batch {batch_time.val:.3f} ({batch_time.avg:.3f}).".format(
+                            i + 1, len(test_loader), data_time=data_time, batch_time=batch_time
+                        )
+                    )
+
+    def update_metrics(self, gray_img: Union[np.ndarray, str], target: np.ndarray) -> None:
+        """If inline metrics are enabled, accumulate the IoU statistics of a prediction.
+
+        Args:
+            gray_img: predicted label map, or path to a previously saved one
+            target: ground truth label map, as loaded by the dataloader
+        """
+        if self.sam is None:
+            return
+        if isinstance(gray_img, str):
+            gray_img = cv2.imread(gray_img, cv2.IMREAD_GRAYSCALE)
+        self.sam.update_metrics_cpu(gray_img, target.astype(np.int64), self.num_eval_classes)
+
+    def make_writer(self) -> BackgroundWriter:
+        """Create the pool of background threads writing predictions to disk. Exiting its
+        context waits for all pending writes, and re-raises any write error."""
+        return BackgroundWriter(self.writer_threads, self.writer_queue_size)
+
+    def make_gray_folder(self) -> None:
+        """Create the folder where grayscale label map predictions are saved."""
         if self.args.save_folder == "default":
             self.args.save_folder = f"{_ROOT}/temp_files/{self.args.model_name}_{self.args.dataset}_universal_{self.scales_str}/{self.args.base_size}"
 
@@ -395,42 +757,64 @@ class InferenceTask:
         gray_folder = os.path.join(self.args.save_folder, "gray")
         self.gray_folder = gray_folder
 
+        os.makedirs(self.gray_folder, exist_ok=True)
+
+    def execute_on_batched_dataloader(self, test_loader: torch.utils.data.dataloader.DataLoader) -> None:
+        """Run a pretrained model over a dataloader from `create_test_loader(args, use_batched_inference=True)`.
+
+        Images arrive already resized to the base size and bucketed by shape; each
+        bucket goes through the sliding window together, and each prediction is then
+        un-padded and resized back to its raw resolution. Single-scale only.
+
+        Args:
+             test_loader:
+        """
+        assert len(self.scales) == 1
+        self.make_gray_folder()
+
         data_time = AverageMeter()
         batch_time = AverageMeter()
         end = time.time()
 
-        os.makedirs(self.gray_folder, exist_ok=True)
-
-        for i, (input, _) in enumerate(test_loader):
-            logger.info(f"On image {i}")
-            data_time.update(time.time() - end)
-
-            # determine path for grayscale label map
-            image_path, _ = self.data_list[i]
-            image_name = Path(image_path).stem
-
-            gray_path = os.path.join(self.gray_folder, image_name + ".png")
-            if Path(gray_path).exists():
-                continue
-
-            # convert Pytorch tensor -> Numpy, then feedforward
-            input = np.squeeze(input.numpy(), axis=0)
-            image = np.transpose(input, (1, 2, 0))
-            gray_img = self.execute_on_img(image)
-
-            batch_time.update(time.time() - end)
-            end = time.time()
-            cv2.imwrite(gray_path, gray_img)
-
-            # todo: update to time remaining.
-            if ((i + 1) % self.args.print_freq == 0) or (i + 1 == len(test_loader)):
-                logger.info(
-                    "Test: [{}/{}] "
-                    "Data {data_time.val:.3f} ({data_time.avg:.3f}) "
-                    "Batch {batch_time.val:.3f} ({batch_time.avg:.3f}).".format(
-                        i + 1, len(test_loader), data_time=data_time, batch_time=batch_time
+        with self.make_writer() as writer:
+            for i, buckets in enumerate(test_loader):
+                data_time.update(time.time() - end)
+
+                for indices, images, labels in buckets:
+                    # determine paths for grayscale label maps, and skip those already computed
+                    gray_paths = [
+                        os.path.join(self.gray_folder, Path(self.data_list[index][0]).stem + ".png") for index in indices
+                    ]
+                    todo = []
+                    for j, gray_path in enumerate(gray_paths):
+                        if Path(gray_path).exists():
+                            self.update_metrics(gray_path, labels[j])
+                        else:
+                            todo.append(j)
+                    if len(todo) == 0:
+                        continue
+
+                    raw_sizes = [labels[j].shape[:2] for j in todo]
+                    predictions = self.scale_process_batch(images[todo].numpy(), raw_sizes)
+                    for j, prediction in zip(todo, predictions):
+                        prediction = torch.Tensor(prediction)
+                        prediction /= len(self.scales)
+                        prediction = torch.argmax(prediction, axis=2)
+                        gray_img = np.uint8(prediction.data.cpu().numpy())
+                        self.update_metrics(gray_img, labels[j])
+                        writer.submit(imwrite, gray_paths[j], gray_img)
+
+                batch_time.update(time.time() - end)
+                end = time.time()
+
+                if ((i + 1) % self.args.print_freq == 0) or (i + 1 == len(test_loader)):
+                    logger.info(
+                        "Test: [{}/{}] "
+                        "Data {data_time.val:.3f} ({data_time.avg:.3f}) "
+                        "Batch {batch_time.val:.3f} ({batch_time.avg:.3f}).".format(
+                            i + 1, len(test_loader), data_time=data_time, batch_time=batch_time
+                        )
                     )
-                )
 
     def scale_process_cuda(self, image: np.ndarray, raw_h: int, raw_w: int, stride_rate: float = 2 / 3) -> np.ndarray:
         """First, pad the image. If input is (384x512), then we must pad it up to shape
@@ -451,50 +835,91 @@ class InferenceTask:
         Returns:
             prediction: Numpy array representing predictions with shorter side equal to self.base_size
         """
-        resized_h, resized_w, _ = image.shape
-        padded_image, pad_h_half, pad_w_half = pad_to_crop_sz(image, self.crop_h, self.crop_w, self.mean)
-        new_h, new_w, _ = padded_image.shape
+        return self.scale_process_batch(image[np.newaxis], [(raw_h, raw_w)], stride_rate)[0]
+
+    def scale_process_batch(
+        self, images: np.ndarray, raw_sizes: List[Tuple[int, int]], stride_rate: float = 2 / 3
+    ) -> List[np.ndarray]:
+        """Batched `scale_process_cuda()`: run the sliding window over several identically
+        shaped images at once, so that crops from all of them share micro-batches.
+
+        Args:
+            images: Array of shape (N,H,W,C), representing images where shortest edge is adjusted to base_size
+            raw_sizes: list of N (raw_h, raw_w) native image resolutions to resize predictions back to
+            stride_rate: stride rate of sliding window operation
+
+        Returns:
+            predictions: list of N Numpy arrays of shape (raw_h, raw_w, num_classes)
+        """
+        num_images, resized_h, resized_w, _ = images.shape
+        padded_images = [pad_to_crop_sz(image, self.crop_h, self.crop_w, self.mean) for image in images]
+        _, pad_h_half, pad_w_half = padded_images[0]
+        new_h, new_w, _ = padded_images[0][0].shape
         stride_h = int(np.ceil(self.crop_h * stride_rate))
         stride_w = int(np.ceil(self.crop_w * stride_rate))
         grid_h = int(np.ceil(float(new_h - self.crop_h) / stride_h) + 1)
         grid_w = int(np.ceil(float(new_w - self.crop_w) / stride_w) + 1)
 
-        prediction_crop = torch.zeros((self.num_eval_classes, new_h, new_w))
-        count_crop = torch.zeros((new_h, new_w))
-
+        # sliding window start indices; the last window in each row/column is
+        # shifted back so that it ends exactly at the image border
+        starts = []
+        for n in range(num_images):
+            for index_h in range(0, grid_h):
+                for index_w in range(0, grid_w):
+                    s_h = min(index_h * stride_h + self.crop_h, new_h) - self.crop_h
+                    s_w = min(index_w * stride_w + self.crop_w, new_w) - self.crop_w
+                    starts.append((n, s_h, s_w))
+
+        # normalize the padded images once; every crop is then a view of them
+        input = np.stack([padded_image for padded_image, _, _ in padded_images]).transpose((0, 3, 1, 2))
+        input = torch.from_numpy(np.ascontiguousarray(input)).float()
+        for image in input:
+            normalize_img(image, self.mean, self.std)
         if self.use_gpu:
-            prediction_crop = prediction_crop.cuda()
-            count_crop = count_crop.cuda()
-
-        # loop w/ sliding window, obtain start/end indices
-        for index_h in range(0, grid_h):
-            for index_w in range(0, grid_w):
-                # height indices are s_h to e_h (start h index to end h index)
-                # width indices are s_w to e_w (start w index to end w index)
-                s_h = index_h * stride_h
-                e_h = min(s_h + self.crop_h, new_h)
-                s_h = e_h - self.crop_h
-                s_w = index_w * stride_w
-                e_w = min(s_w + self.crop_w, new_w)
-                s_w = e_w - self.crop_w
-                image_crop = padded_image[s_h:e_h, s_w:e_w].copy()
-                count_crop[s_h:e_h, s_w:e_w] += 1
-                prediction_crop[:, s_h:e_h, s_w:e_w] += self.net_process(image_crop)
-
-        prediction_crop /= count_crop.unsqueeze(0)
+            input = input.cuda()
+
+        prediction_crop = torch.zeros((self.num_eval_classes, num_images * new_h * new_w), device=input.device)
+        count_crop = torch.zeros((num_images * new_h * new_w), device=input.device)
+        # flat indices of a crop's pixels, relative to its top-left corner
+        crop_offsets = (
+            torch.arange(self.crop_h, device=input.device).view(-1, 1) * new_w
+            + torch.arange(self.crop_w, device=input.device).view(1, -1)
+        ).view(1, -1)
+
+        # run the crops through the network in micro-batches, and scatter-add each
+        # micro-batch of probabilities into the full-image accumulator at once
+        for i in range(0, len(starts), self.tile_batch_size):
+            batch_starts = starts[i : i + self.tile_batch_size]
+            crops = torch.stack(
+                [input[n, :, s_h : s_h + self.crop_h, s_w : s_w + self.crop_w] for n, s_h, s_w in batch_starts]
+            )
+            probs = self.net_process_batch(crops)
+
+            crop_starts = torch.tensor(
+                [(n * new_h + s_h) * new_w + s_w for n, s_h, s_w in batch_starts], device=input.device
+            )
+            index = (crop_starts.view(-1, 1) + crop_offsets).view(-1)
+            prediction_crop.index_add_(1, index, probs.permute(1, 0, 2, 3).reshape(self.num_eval_classes, -1))
+            count_crop.index_add_(0, index, torch.ones_like(index, dtype=count_crop.dtype))
+
+        prediction_crop = prediction_crop.view(self.num_eval_classes, num_images, new_h, new_w)
+        prediction_crop /= count_crop.view(1, num_images, new_h, new_w)
         # disregard predictions from padded portion of image
-        prediction_crop = prediction_crop[:, pad_h_half : pad_h_half + resized_h, pad_w_half : pad_w_half + resized_w]
+        prediction_crop = prediction_crop[:, :, pad_h_half : pad_h_half + resized_h, pad_w_half : pad_w_half + resized_w]
 
-        # CHW -> HWC
-        prediction_crop = prediction_crop.permute(1, 2, 0)
+        # KNHW -> NHWC
+        prediction_crop = prediction_crop.permute(1, 2, 3, 0)
         prediction_crop = prediction_crop.data.cpu().numpy()
 
         # upsample or shrink predictions back down to scale=1.0
-        prediction = cv2.resize(prediction_crop, (raw_w, raw_h), interpolation=cv2.INTER_LINEAR)
-        return prediction
+        predictions = [
+            cv2.resize(prediction_crop[n], (raw_w, raw_h), interpolation=cv2.INTER_LINEAR)
+            for n, (raw_h, raw_w) in enumerate(raw_sizes)
+        ]
+        return predictions
 
     def net_process(self, image: np.ndarray, flip: bool = True) -> torch.Tensor:
-        """Feed input through the network.
+        """Feed a single crop through the network.
 
         In addition to running a crop through the network, we can flip
         the crop horizontally, run both crops through the network, and then
@@ -515,11 +940,28 @@ class InferenceTask:
 
         if self.use_gpu:
             input = input.cuda()
+        return self.net_process_batch(input, flip)[0]
+
+    def net_process_batch(self, input: torch.Tensor, flip: bool = True) -> torch.Tensor:
+        """Feed a batch of normalized crops through the network.
+
+        Args:
+            input: tensor of shape (B,C,H,W) representing normalized crops, on the model's device
+            flip: boolean, whether to average with flipped patch output
+
+        Returns:
+            probs: tensor of shape (B,num_classes,H,W) of class probabilities in the evaluation taxonomy
+        """
+        batch_size = input.shape[0]
         if flip:
-            # add another example to batch dimension, that is the flipped crop
+            # add the flipped crops to the batch dimension
             input = torch.cat([input, input.flip(3)], 0)
-        with torch.no_grad():
-            logits, _, _, _ = self.model(input)
+        # crops are stacked as NCHW; convert each micro-batch once, if the model is channels_last
+        input = input.contiguous(memory_format=self.memory_format)
+        with get_autocast(self.args, input.device.type):
+            logits = self.backend(input)
+        # upsampling, softmax and accumulation stay in float32
+        logits = logits.float()
         _, _, h_i, w_i = input.shape
         _, _, h_o, w_o = logits.shape
         if (h_o != h_i) or (w_o != w_i):
@@ -527,19 +969,11 @@ class InferenceTask:
 
         # model & eval tax match, so no conversion needed
         assert self.model_taxonomy in ["universal", "test_dataset"]
-        # todo: determine when .cuda() needed here
         probs = self.softmax(logits)
 
         if flip:
-            # take back out the flipped crop, correct its orientation, and average result
-            probs = (probs[0] + probs[1].flip(2)) / 2
-        else:
-            probs = probs[0]
-        # output = output.data.cpu().numpy()
-        # convert CHW to HWC order
-        # output = output.transpose(1, 2, 0)
-        # output = output.permute(1,2,0)
-
+            # take back out the flipped crops, correct their orientation, and average result
+            probs = (probs[:batch_size] + probs[batch_size:].flip(3)) / 2
         return probs
 
 
@@ -581,7 +1015,8 @@ def test_model(args):
     )
     itask.execute()
 
-    logger.info(">>>>>>>>> Calculating accuracy from cached results >>>>>>>>>>")
+    if itask.sam is None:
+        logger.info(">>>>>>>>> Calculating accuracy from cached results >>>>>>>>>>")
 
     excluded_ids = [] # no classes are excluded from evaluation of the test sets
     _, test_data_list = create_test_loader(args)
@@ -593,7 +1028,8 @@ def test_model(args):
         save_folder=args.save_folder,
         eval_taxonomy="test_dataset",
         num_eval_classes=num_eval_classes,
-        excluded_ids=excluded_ids
+        excluded_ids=excluded_ids,
+        sam=itask.sam
     )
     ac.compute_metrics()
 
@@ -18,12 +18,23 @@ import torch.optim
 import torch.utils.data
 import torch.distributed as dist
 
-from src.vision.utils import get_logger, save_json_dict, load_class_names
+import src.vision.cv2_transforms as transform
+from src.vision.utils import (
+    get_autocast,
+    get_imagenet_mean_std,
+    get_logger,
+    get_memory_format,
+    load_class_names,
+    save_json_dict,
+)
 from src.vision.iou import intersectionAndUnionGPU
 from src.vision.avg_meter import AverageMeter, SegmentationAverageMeter
+from src.vision.checkpoint_manager import CheckpointManager, state_dict_matches
+from src.vision.feature_cache import CachedFeatureHead, get_feature_cache
 
 from src.vision.part2_dataset import SemData, KittiData
 from src.vision.part3_training_utils import (
+    get_batch_train_transform,
     get_model_and_optimizer,
     get_train_transform,
     get_val_transform,
@@ -53,6 +64,64 @@ def poly_learning_rate(base_lr: float, curr_iter, max_iter, power: float = 0.9)
     return lr
 
 
+def compile_model(args, model: torch.nn.Module) -> None:
+    """If `args.compile` is set, compile the model's forward pass in place with `torch.compile`.
+
+    Shapes are static: the train loader drops its last incomplete batch, so apart from
+    the train/eval switch and the last val batch, a single graph is compiled. The state
+    dict keys are unchanged, so checkpoints stay loadable by eager models.
+    """
+    if getattr(args, "compile", False):
+        model.compile(dynamic=False, backend=getattr(args, "compile_backend", "inductor"))
+
+
+def make_checkpoint_manager(args) -> CheckpointManager:
+    """Checkpoint manager for `args.save_path`, with the retention policy of `args`."""
+    return CheckpointManager(
+        args.save_path,
+        keep_last=getattr(args, "keep_last_checkpoints", 2),
+        keep_best=getattr(args, "keep_best_checkpoints", 0),
+        async_save=getattr(args, "async_checkpointing", False),
+    )
+
+
+def resume_training(
+    args, checkpoint_manager: CheckpointManager, model: nn.Module, optimizer: torch.optim.Optimizer
+) -> defaultdict:
+    """If `args.auto_resume` is set, restore the model, optimizer and training history from the
+    newest complete checkpoint, and set `args.start_epoch` to continue after it. A non-zero
+    `args.start_epoch` limits the search to checkpoints of at most that many epochs. A checkpoint
+    that does not match the model (see `state_dict_matches()`) is not loaded.
+
+    Returns:
+        results_dict: per-epoch training history so far
+    """
+    results_dict = defaultdict(list)
+    if not getattr(args, "auto_resume", False):
+        return results_dict
+
+    checkpoint = checkpoint_manager.load_latest(max_epoch=args.start_epoch or None)
+    if checkpoint is None:
+        if args.start_epoch > 0:
+            logger.warning(f"No checkpoint of at most {args.start_epoch} epochs, starting from the current weights")
+        return results_dict
+    if not state_dict_matches(model, checkpoint["state_dict"]):
+        # e.g. left in `save_path` by a run with a different number of classes or architecture
+        logger.warning(
+            f"Checkpoint of epoch {checkpoint['epoch']} does not match the model, starting from the current weights"
+        )
+        return results_dict
+    if args.start_epoch > 0 and checkpoint["epoch"] != args.start_epoch:
+        logger.warning(f"No checkpoint of {args.start_epoch} epochs, resuming from epoch {checkpoint['epoch']}")
+
+    model.load_state_dict(checkpoint["state_dict"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    results_dict.update(checkpoint.get("results", {}))
+    args.start_epoch = checkpoint["epoch"]
+    logger.info(f"=> resuming training after epoch {args.start_epoch}")
+    return results_dict
+
+
 def main_worker(args, use_cuda: bool):
     """ """
     model, optimizer = get_model_and_optimizer(args)
@@ -63,6 +132,8 @@ def main_worker(args, use_cuda: bool):
 
     if use_cuda:
         model = model.cuda()
+    model = model.to(memory_format=get_memory_format(args))
+    compile_model(args, model)
 
     # if args.weight:
     #     if os.path.isfile(args.weight):
@@ -79,8 +150,13 @@ def main_worker(args, use_cuda: bool):
         train_transform = get_train_transform(args)
     else:
         train_transform = get_val_transform(args)
+    keep_uint8 = getattr(args, "uint8_pipeline", False)
     train_data = SemData(
-        split="train", data_root=args.data_root, data_list_fpath=args.train_list, transform=train_transform
+        split="train",
+        data_root=args.data_root,
+        data_list_fpath=args.train_list,
+        transform=train_transform,
+        keep_uint8=keep_uint8,
     )
 
     train_sampler = None
@@ -95,7 +171,13 @@ def main_worker(args, use_cuda: bool):
     )
 
     val_transform = get_val_transform(args)
-    val_data = SemData(split="val", data_root=args.data_root, data_list_fpath=args.val_list, transform=val_transform)
+    val_data = SemData(
+        split="val",
+        data_root=args.data_root,
+        data_list_fpath=args.val_list,
+        transform=val_transform,
+        keep_uint8=keep_uint8,
+    )
 
     val_sampler = None
     val_loader = torch.utils.data.DataLoader(
@@ -107,41 +189,39 @@ def main_worker(args, use_cuda: bool):
         sampler=val_sampler,
     )
 
-    results_dict = defaultdict(list)
-    for epoch in range(args.start_epoch, args.epochs):
-        epoch_log = epoch + 1
-        loss_train, mIoU_train, mAcc_train, allAcc_train = run_epoch(
-            args,
-            use_cuda,
-            train_loader,
-            model,
-            optimizer,
-            epoch,
-            split="train",
-        )
-        results_dict["loss_train"] += [round(float(loss_train), 3)]
-        results_dict["mIoU_train"] += [round(float(mIoU_train), 3)]
-        results_dict["mAcc_train"] += [round(float(mAcc_train), 3)]
-        results_dict["allAcc_train"] += [round(float(allAcc_train), 3)]
-
-        if epoch_log % args.save_freq == 0:
-            filename = args.save_path + "/train_epoch_" + str(epoch_log) + ".pth"
-            logger.info("Saving checkpoint to: " + filename)
-            torch.save(
-                {"epoch": epoch_log, "state_dict": model.state_dict(), "optimizer": optimizer.state_dict()}, filename
+    with make_checkpoint_manager(args) as checkpoint_manager:
+        results_dict = resume_training(args, checkpoint_manager, model, optimizer)
+        epoch = args.start_epoch - 1  # for the final evaluation, if training is already complete
+        for epoch in range(args.start_epoch, args.epochs):
+            epoch_log = epoch + 1
+            loss_train, mIoU_train, mAcc_train, allAcc_train = run_epoch(
+                args,
+                use_cuda,
+                train_loader,
+                model,
+                optimizer,
+                epoch,
+                split="train",
             )
-            if epoch_log / args.save_freq > 2:
-                deletename = args.save_path + "/train_epoch_" + str(epoch_log - args.save_freq * 2) + ".pth"
-                os.remove(deletename)
-        if args.evaluate:
-            with torch.no_grad():
-                loss_val, mIoU_val, mAcc_val, allAcc_val = run_epoch(
-                    args, use_cuda, val_loader, model, optimizer=None, epoch=epoch, split="val"
-                )
-            results_dict["loss_val"] += [round(float(loss_val), 3)]
-            results_dict["mIoU_val"] += [round(float(mIoU_val), 3)]
-            results_dict["mAcc_val"] += [round(float(mAcc_val), 3)]
-            results_dict["allAcc_val"] += [round(float(allAcc_val), 3)]
+            results_dict["loss_train"] += [round(float(loss_train), 3)]
+            results_dict["mIoU_train"] += [round(float(mIoU_train), 3)]
+            results_dict["mAcc_train"] += [round(float(mAcc_train), 3)]
+            results_dict["allAcc_train"] += [round(float(allAcc_train), 3)]
+
+            if args.evaluate:
+                with torch.no_grad():
+                    loss_val, mIoU_val, mAcc_val, allAcc_val = run_epoch(
+                        args, use_cuda, val_loader, model, optimizer=None, epoch=epoch, split="val"
+                    )
+                results_dict["loss_val"] += [round(float(loss_val), 3)]
+                results_dict["mIoU_val"] += [round(float(mIoU_val), 3)]
+                results_dict["mAcc_val"] += [round(float(mAcc_val), 3)]
+                results_dict["allAcc_val"] += [round(float(allAcc_val), 3)]
+
+            if epoch_log % args.save_freq == 0:
+                # written in the background, while the next epoch trains
+                metric = results_dict["mIoU_val" if args.evaluate else "mIoU_train"][-1]
+                checkpoint_manager.save(epoch_log, model, optimizer, metric, extra={"results": dict(results_dict)})
 
     logger.info("======> Training complete ======>")
     logger.info(">>>>>>>>>>>>>>>> Start Evaluation >>>>>>>>>>>>>>>>")
@@ -168,6 +248,7 @@ def transfer_train(args, use_cuda: bool):
 
     if use_cuda:
         model = model.cuda()
+    model = model.to(memory_format=get_memory_format(args))
 
     # if args.weight:
     #     if os.path.isfile(args.weight):
@@ -184,7 +265,17 @@ def transfer_train(args, use_cuda: bool):
         train_transform = get_train_transform(args)
     else:
         train_transform = get_val_transform(args)
-    train_data = KittiData(split="train", data_root=args.data_root, transform=train_transform)
+    keep_uint8 = getattr(args, "uint8_pipeline", False)
+    train_data = KittiData(split="train", data_root=args.data_root, transform=train_transform, keep_uint8=keep_uint8)
+
+    val_transform = get_val_transform(args)
+    val_data = KittiData(split="test", data_root=args.data_root, transform=val_transform, keep_uint8=keep_uint8)
+
+    epoch_model = model
+    if getattr(args, "feature_cache", False):
+        train_data, val_data, epoch_model = get_feature_cache_data(args, use_cuda, model, train_data, val_data)
+    # the module that runs every epoch: with the feature cache, only the heads, via `forward_from_features()`
+    compile_model(args, epoch_model)
 
     train_sampler = None
     train_loader = torch.utils.data.DataLoader(
@@ -197,9 +288,6 @@ def transfer_train(args, use_cuda: bool):
         drop_last=True,
     )
 
-    val_transform = get_val_transform(args)
-    val_data = KittiData(split="test", data_root=args.data_root, transform=val_transform)
-
     val_sampler = None
     val_loader = torch.utils.data.DataLoader(
         val_data,
@@ -210,53 +298,107 @@ def transfer_train(args, use_cuda: bool):
         sampler=val_sampler,
     )
 
-    results_dict = defaultdict(list)
-    for epoch in range(args.start_epoch, args.epochs):
-        epoch_log = epoch + 1
-        loss_train, mIoU_train, mAcc_train, allAcc_train = run_epoch(
-            args,
-            use_cuda,
-            train_loader,
-            model,
-            optimizer,
-            epoch,
-            split="train",
-        )
-        results_dict["loss_train"] += [round(float(loss_train), 3)]
-        results_dict["mIoU_train"] += [round(float(mIoU_train), 3)]
-        results_dict["mAcc_train"] += [round(float(mAcc_train), 3)]
-        results_dict["allAcc_train"] += [round(float(allAcc_train), 3)]
-
-        if epoch_log % args.save_freq == 0:
-            filename = args.save_path + "/train_epoch_" + str(epoch_log) + ".pth"
-            logger.info("Saving checkpoint to: " + filename)
-            torch.save(
-                {"epoch": epoch_log, "state_dict": model.state_dict(), "optimizer": optimizer.state_dict()}, filename
+    with make_checkpoint_manager(args) as checkpoint_manager:
+        results_dict = resume_training(args, checkpoint_manager, model, optimizer)
+        epoch = args.start_epoch - 1  # for the final evaluation, if training is already complete
+        for epoch in range(args.start_epoch, args.epochs):
+            epoch_log = epoch + 1
+            loss_train, mIoU_train, mAcc_train, allAcc_train = run_epoch(
+                args,
+                use_cuda,
+                train_loader,
+                epoch_model,
+                optimizer,
+                epoch,
+                split="train",
             )
-            if epoch_log / args.save_freq > 2:
-                deletename = args.save_path + "/train_epoch_" + str(epoch_log - args.save_freq * 2) + ".pth"
-                os.remove(deletename)
-        if args.evaluate:
-            with torch.no_grad():
-                loss_val, mIoU_val, mAcc_val, allAcc_val = run_epoch(
-                    args, use_cuda, val_loader, model, optimizer=None, epoch=epoch, split="val"
-                )
-            results_dict["loss_val"] += [round(float(loss_val), 3)]
-            results_dict["mIoU_val"] += [round(float(mIoU_val), 3)]
-            results_dict["mAcc_val"] += [round(float(mAcc_val), 3)]
-            results_dict["allAcc_val"] += [round(float(allAcc_val), 3)]
+            results_dict["loss_train"] += [round(float(loss_train), 3)]
+            results_dict["mIoU_train"] += [round(float(mIoU_train), 3)]
+            results_dict["mAcc_train"] += [round(float(mAcc_train), 3)]
+            results_dict["allAcc_train"] += [round(float(allAcc_train), 3)]
+
+            if args.evaluate:
+                with torch.no_grad():
+                    loss_val, mIoU_val, mAcc_val, allAcc_val = run_epoch(
+                        args, use_cuda, val_loader, epoch_model, optimizer=None, epoch=epoch, split="val"
+                    )
+                results_dict["loss_val"] += [round(float(loss_val), 3)]
+                results_dict["mIoU_val"] += [round(float(mIoU_val), 3)]
+                results_dict["mAcc_val"] += [round(float(mAcc_val), 3)]
+                results_dict["allAcc_val"] += [round(float(allAcc_val), 3)]
+
+            if epoch_log % args.save_freq == 0:
+                # written in the background, while the next epoch trains
+                metric = results_dict["mIoU_val" if args.evaluate else "mIoU_train"][-1]
+                checkpoint_manager.save(epoch_log, model, optimizer, metric, extra={"results": dict(results_dict)})
 
     logger.info("======> Training complete ======>")
     logger.info(">>>>>>>>>>>>>>>> Start Evaluation >>>>>>>>>>>>>>>>")
     with torch.no_grad():
         loss_val, mIoU_val, mAcc_val, allAcc_val = run_epoch(
-            args, use_cuda, val_loader, model, optimizer=None, epoch=epoch, split="val"
+            args, use_cuda, val_loader, epoch_model, optimizer=None, epoch=epoch, split="val"
         )
     logger.info("<<<<<<<<<<<<<<<<< End Evaluation <<<<<<<<<<<<<<<<<")
     print("Results Dict: ", results_dict)
     save_json_dict(os.path.join(args.save_path, "training_results_dict.json"), results_dict)
 
 
+def get_feature_cache_data(
+    args,
+    use_cuda: bool,
+    model: PSPNet,
+    train_data: torch.utils.data.Dataset,
+    val_data: torch.utils.data.Dataset,
+) -> Tuple[torch.utils.data.Dataset, torch.utils.data.Dataset, nn.Module]:
+    """Swap the train and val datasets for caches of the features of `model`'s backbone, which
+    `model_and_optimizer` froze.
+
+    The train cache holds `args.feature_cache_draws` passes over the augmented train data (a fixed
+    set of augmentation draws), or a single pass over it without augmentation if that is 0.
+
+    Returns:
+        train_data: train split feature cache
+        val_data: val split feature cache
+        head_model: runs (and trains) only the PPM, classifier and aux head of `model`, on cached features
+    """
+    cache_root = getattr(args, "feature_cache_dir", None) or os.path.join(args.save_path, "feature_cache")
+    num_draws = getattr(args, "feature_cache_draws", 0)
+    # the file's mtime and size change when a checkpoint is retrained or overwritten at the same path
+    model_stat = os.stat(args.model_path)
+    source = {
+        "model_path": args.model_path,
+        "model_mtime_ns": model_stat.st_mtime_ns,
+        "model_size": model_stat.st_size,
+        "data_root": args.data_root,
+        "crop_size": [args.train_h, args.train_w],
+        "short_size": args.short_size,
+    }
+    if num_draws > 0:
+        train_data = torch.utils.data.ConcatDataset([train_data] * num_draws)
+    else:
+        # a separate dataset, so that the caller's `train_data` keeps its augmentation
+        train_data = KittiData(
+            split="train",
+            data_root=args.data_root,
+            transform=get_val_transform(args),
+            keep_uint8=getattr(args, "uint8_pipeline", False),
+        )
+    train_data = get_feature_cache(
+        model,
+        train_data,
+        os.path.join(cache_root, "train"),
+        args.batch_size_val,
+        use_cuda,
+        {**source, "split": "train", "draws": num_draws},
+    )
+    val_data = get_feature_cache(
+        model, val_data, os.path.join(cache_root, "test"), args.batch_size_val, use_cuda, {**source, "split": "test"}
+    )
+
+    head_model = CachedFeatureHead(model, train_data.meta["layer3_channels"], train_data.meta["input_size"])
+    return train_data, val_data, head_model
+
+
 def run_epoch(
     args,
     use_cuda: bool,
@@ -278,6 +420,11 @@ def run_epoch(
     loss_meter = AverageMeter()
 
     sam = SegmentationAverageMeter()
+    mean, std = get_imagenet_mean_std()
+    memory_format = get_memory_format(args)
+    batch_transform = None
+    if split == "train" and args.data_aug and getattr(args, "batch_augmentation", False):
+        batch_transform = get_batch_train_transform(args)
 
     if split == "train":
         model.train()
@@ -288,6 +435,17 @@ def run_epoch(
     max_iter = args.epochs * len(data_loader)
     for i, (input, target) in enumerate(data_loader):
         data_time.update(time.time() - end)
+        if use_cuda:
+            input = input.cuda(non_blocking=True)
+            target = target.cuda(non_blocking=True)
+        if input.dtype == torch.uint8:
+            # uint8 pipeline: convert and normalize the whole batch once, on its device
+            input = transform.normalize_uint8(input, mean, std)
+        if batch_transform is not None:
+            input, target = batch_transform(input, target)
+        # no-op unless the model is channels_last
+        input = input.contiguous(memory_format=memory_format)
+
         if args.zoom_factor != 8:
             h = int((target.size()[1] - 1) / 8 * args.zoom_factor + 1)
             w = int((target.size()[2] - 1) / 8 * args.zoom_factor + 1)
@@ -299,18 +457,16 @@ def run_epoch(
             )
             # output = F.interpolate(output, size=target.size()[1:], mode="bilinear", align_corners=True)
 
-        if use_cuda:
-            input = input.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
-
-        _, preds, main_loss, aux_loss = model(input, target)
+        # the losses are computed in float32 by autocast; backward runs outside of it
+        with get_autocast(args, "cuda" if use_cuda else "cpu"):
+            _, preds, main_loss, aux_loss = model(input, target)
 
-        # adding aux_loss hyperparameter
-        if not args.aux_loss:
-            aux_loss = torch.Tensor([0])
+            # adding aux_loss hyperparameter
+            if not args.aux_loss:
+                aux_loss = torch.Tensor([0])
 
-        main_loss, aux_loss = torch.mean(main_loss), torch.mean(aux_loss)
-        loss = main_loss + args.aux_weight * aux_loss
+            main_loss, aux_loss = torch.mean(main_loss), torch.mean(aux_loss)
+            loss = main_loss + args.aux_weight * aux_loss
 
         if split == "train":
             optimizer.zero_grad()
@@ -321,9 +477,16 @@ def run_epoch(
 
         sam.update_metrics_gpu(preds, target, args.classes, args.ignore_label, args.multiprocessing_distributed)
 
-        main_loss_meter.update(main_loss.item(), n)
-        aux_loss_meter.update(aux_loss.item(), n)
-        loss_meter.update(loss.item(), n)
+        if getattr(args, "device_metrics", False):
+            # keep running sums on the device (in float64, so the logged values are identical
+            # to accumulating .item()), and only sync when they are printed
+            main_loss_meter.update(main_loss.detach().double(), n)
+            aux_loss_meter.update(aux_loss.detach().double(), n)
+            loss_meter.update(loss.detach().double(), n)
+        else:
+            main_loss_meter.update(main_loss.item(), n)
+            aux_loss_meter.update(aux_loss.item(), n)
+            loss_meter.update(loss.item(), n)
         batch_time.update(time.time() - end)
         end = time.time()
 
@@ -371,7 +534,7 @@ def run_epoch(
             )
         logger.info("<<<<<<<<<<<<<<<<< End Evaluation <<<<<<<<<<<<<<<<<")
 
-    return main_loss_meter.avg, mIoU, mAcc, allAcc
+    return float(main_loss_meter.avg), mIoU, mAcc, allAcc
 
 
 def main(opts):
@@ -418,6 +581,9 @@ DEFAULT_ARGS = SimpleNamespace(
         "batch_size_val": 32,
         "short_size": 240,
         "data_aug": True,
+        "fused_augmentation": False,  # flip/rotate/scale/crop as a single warp
+        "batch_augmentation": False,  # augment collated batches with tensor ops, instead of in the workers
+        "uint8_pipeline": False,  # keep images uint8 through augmentation, normalize per batch
         "train_h": 201,
         "train_w": 201,
         "init_weight": "../initmodel/resnet50_v2.pth",
@@ -433,7 +599,21 @@ DEFAULT_ARGS = SimpleNamespace(
         "weight_decay": 0.0001,
         "manual_seed": 0,
         "print_freq": 10,
+        "compile": False,  # torch.compile the model, for training and inference (warmed up at load time)
+        "compile_backend": "inductor",
+        "checkpoint_segments": 0,  # activation checkpointing of PSPNet layer3/layer4: 0 off, 1 per layer, 6 per Bottleneck
+        "frozen_layers": [],  # transfer learning: PSPNet modules to freeze, e.g. ["layer0", "layer1", "layer2"]
+        "feature_cache": False,  # transfer learning: freeze the backbone, and train the heads on its cached features
+        "feature_cache_dir": None,  # defaults to save_path/feature_cache
+        "feature_cache_draws": 0,  # augmented passes over the train data to cache, or 0 for one un-augmented pass
+        "autocast_dtype": None,  # e.g. "bfloat16", for mixed-precision training and inference
+        "memory_format": "contiguous",  # or "channels_last", for the model and all input batches
+        "device_metrics": True,  # accumulate losses & metrics on the device, only syncing at print_freq
         "save_freq": 1,
+        "keep_last_checkpoints": 2,  # most recent checkpoints to keep
+        "keep_best_checkpoints": 0,  # checkpoints with the best val mIoU (train mIoU without evaluate) to keep
+        "async_checkpointing": True,  # snapshot to CPU & write checkpoints in a background thread
+        "auto_resume": False,  # resume from the newest complete checkpoint in save_path (see start_epoch)
         "evaluate": True,  # evaluate on validation set, extra gpu memory needed and small batch_size_val is recommend
         "multiprocessing_distributed": False,
         "pretrained": True,
@@ -442,9 +622,21 @@ DEFAULT_ARGS = SimpleNamespace(
         "base_size": 720,
         "test_h": 201,
         "test_w": 201,
+        "inference_backend": "torch",  # or "onnxruntime", to run `onnx_path` from src.vision.onnx_export
+        "onnx_path": None,
+        "onnx_num_threads": 0,  # ONNX Runtime intra-op threads, 0 for its default
+        "quantized": False,  # model_path is an int8 PSPNet checkpoint from src.vision.quantization (CPU only)
+        "fast_model_init": True,  # build the model on the meta device and assign the (memory-mapped) checkpoint weights
+        "freeze_for_inference": True,  # fold BatchNorm into convs, drop dropout & the aux head
+        "test_batch_size": 1,  # images per inference batch (single-scale only), bucketed by shape
+        "tile_batch_size": 8,  # sliding window crops per forward pass (doubled by flipping)
+        "inline_metrics": False,  # score predictions as they are made, instead of re-reading them from disk
+        "writer_threads": 2,  # background threads encoding & writing predictions and visualizations
+        "writer_queue_size": 16,  # max pending writes, before the inference loop blocks
         "scales": [1.0],  # [0.5, 0.75, 1.0, 1.25, 1.5, 1.75],
         "test_list": "../dataset_lists/camvid-11/list/val.txt",
         "vis_freq": 10,
+        "eval_workers": 0,  # processes re-scoring saved predictions in AccuracyCalculator, serial if <= 1
     }
 )
 
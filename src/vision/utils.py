@@ -86,6 +86,34 @@ def get_imagenet_mean_std() -> Tuple[Tuple[float,float,float], Tuple[float,float
     return mean, std
 
 
+def get_memory_format(args) -> torch.memory_format:
+    """Memory format of the model's weights and input batches, from `args.memory_format`:
+    "channels_last" (NHWC, faster convolutions with oneDNN on CPU), or "contiguous" (NCHW)."""
+    memory_format = getattr(args, "memory_format", "contiguous")
+    if memory_format == "channels_last":
+        return torch.channels_last
+    elif memory_format == "contiguous":
+        return torch.contiguous_format
+    raise ValueError(f"Unknown memory format '{memory_format}'")
+
+
+def get_autocast(args, device_type: str) -> torch.autocast:
+    """Mixed-precision context for the forward pass, from `args.autocast_dtype`: e.g.
+    "bfloat16" (the autocast dtype supported on CPU), or None for plain float32.
+
+    Parameters stay float32, so gradients and optimizer updates do too; bfloat16 has the
+    exponent range of float32, so no gradient scaling is needed.
+
+    Args:
+        args: experiment configuration arguments
+        device_type: "cpu" or "cuda"
+    """
+    autocast_dtype = getattr(args, "autocast_dtype", None)
+    if autocast_dtype is None:
+        return torch.autocast(device_type, enabled=False)
+    return torch.autocast(device_type, dtype=getattr(torch, autocast_dtype))
+
+
 def normalize_img(
     input: torch.Tensor, 
     mean: Tuple[float,float,float], 
@@ -0,0 +1,49 @@
+import copy
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from src.vision.accuracy_calculator import AccuracyCalculator
+from src.vision.part2_dataset import make_dataset
+from src.vision.trainer import DEFAULT_ARGS
+from src.vision.utils import load_class_names
+
+
+TEST_DATA_ROOT = Path(__file__).resolve().parent / "test_data"
+
+
+def test_parallel_evaluation_matches_serial(tmp_path: Path) -> None:
+	"""Sharding data_list over worker processes must reproduce the serial statistics exactly."""
+	data_list = make_dataset(
+		"train", str(TEST_DATA_ROOT / "CamvidSubsampled"), str(TEST_DATA_ROOT / "dummy_camvid_train.txt")
+	)
+	gray_folder = tmp_path / "gray"
+	gray_folder.mkdir()
+	for image_path, target_path in data_list:
+		h, w = cv2.imread(target_path, cv2.IMREAD_GRAYSCALE).shape
+		pred = np.random.randint(0, 11, size=(h, w)).astype(np.uint8)
+		cv2.imwrite(str(gray_folder / (Path(image_path).stem + ".png")), pred)
+
+	class_names = load_class_names("camvid-11")
+	sams = []
+	for eval_workers in [0, 2]:
+		args = copy.deepcopy(DEFAULT_ARGS)
+		args.model_path = "dummy.pth"
+		args.eval_workers = eval_workers
+		ac = AccuracyCalculator(
+			args=args,
+			data_list=data_list,
+			dataset_name="camvid-11",
+			class_names=class_names,
+			save_folder=str(tmp_path),
+			eval_taxonomy="test_dataset",
+			num_eval_classes=len(class_names),
+			excluded_ids=[],
+		)
+		ac.compute_metrics(save_vis=False)
+		sams.append(ac.sam)
+
+	assert np.array_equal(sams[0].confusion_matrix(), sams[1].confusion_matrix())
+	for serial, parallel in zip(sams[0].get_metrics(), sams[1].get_metrics()):
+		assert np.array_equal(serial, parallel)
@@ -0,0 +1,37 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from src.vision.background_writer import BackgroundWriter, imwrite
+
+
+def test_background_writer_writes_all(tmp_path: Path) -> None:
+    """All queued images must be on disk, and identical, once the writer context exits."""
+    imgs = [np.random.randint(0, 11, size=(20, 30)).astype(np.uint8) for _ in range(10)]
+    with BackgroundWriter(num_threads=2, max_queue_size=2) as writer:
+        for i, img in enumerate(imgs):
+            writer.submit(imwrite, str(tmp_path / f"{i}.png"), img)
+
+    for i, img in enumerate(imgs):
+        assert np.array_equal(cv2.imread(str(tmp_path / f"{i}.png"), cv2.IMREAD_GRAYSCALE), img)
+
+
+def test_background_writer_raises_on_main_thread(tmp_path: Path) -> None:
+    """A failed write must be re-raised by the thread that submitted it."""
+    img = np.zeros((20, 30), dtype=np.uint8)
+    with pytest.raises(RuntimeError):
+        with BackgroundWriter(num_threads=2) as writer:
+            writer.submit(imwrite, str(tmp_path / "missing_dir" / "0.png"), img)
+
+
+def test_background_writer_keeps_the_original_exception(tmp_path: Path) -> None:
+    """If the `with` body raises, that exception must propagate, not a failed write's."""
+    img = np.zeros((20, 30), dtype=np.uint8)
+    with pytest.raises(KeyError):
+        with BackgroundWriter(num_threads=2) as writer:
+            writer.submit(imwrite, str(tmp_path / "missing_dir" / "0.png"), img)
+            writer.queue.join()
+            raise KeyError("epoch failed")
+    assert writer.threads == []
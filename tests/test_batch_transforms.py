@@ -0,0 +1,55 @@
+import random
+
+import cv2
+import numpy as np
+import torch
+
+import src.vision.batch_transforms as batch_transform
+import src.vision.cv2_transforms as transform
+
+
+def test_rand_rotate_scale_crop_matches_fused_affine_crop():
+    """The batched affine augmentation must reproduce FusedAffineCrop for the same random draws."""
+    mean = [123.675, 116.28, 103.53]
+    x = cv2.resize(np.random.randint(low=0, high=256, size=(24, 32, 3)).astype(np.float32), (320, 240))
+    y = np.kron(np.random.randint(low=0, high=12, size=(8, 8)), np.ones((30, 40), dtype=np.int64))
+
+    fused = transform.FusedAffineCrop(
+        short_size=240, size=(201, 201), scale=(0.5, 2.0), rotate=(-10, 10), padding=mean, rotate_p=1.0
+    )
+    batched = batch_transform.RandRotateScaleCrop(
+        size=(201, 201), scale=(0.5, 2.0), rotate=(-10, 10), padding=mean, flip_p=0.5, rotate_p=1.0
+    )
+
+    for seed in range(3):
+        random.seed(seed)
+        x_fused, y_fused = fused(x.copy(), y.copy())
+        random.seed(seed)
+        x_batch, y_batch = batched(torch.from_numpy(x).permute(2, 0, 1).unsqueeze(0), torch.from_numpy(y).unsqueeze(0))
+
+        assert x_batch.shape == (1, 3, 201, 201)
+        assert y_batch.shape == (1, 201, 201)
+        assert np.allclose(x_batch[0].permute(1, 2, 0).numpy(), x_fused, atol=1e-2)
+        assert (y_batch[0].numpy() != y_fused).mean() < 1e-3
+
+
+def test_random_gaussian_blur_matches_cv2():
+    """Blurred images in the batch must match cv2.GaussianBlur, the others must be untouched."""
+    x = np.random.randint(low=0, high=256, size=(40, 50, 3)).astype(np.float32)
+    images = torch.from_numpy(x).permute(2, 0, 1).unsqueeze(0).repeat(8, 1, 1, 1)
+    labels = torch.zeros(8, 40, 50, dtype=torch.int64)
+
+    random.seed(0)
+    blurred, _ = batch_transform.RandomGaussianBlur()(images, labels)
+    expected = torch.from_numpy(cv2.GaussianBlur(x, (5, 5), 0)).permute(2, 0, 1)
+    for i in range(8):
+        assert torch.allclose(blurred[i], expected, atol=1e-3) or torch.equal(blurred[i], images[i])
+
+
+def test_random_horizontal_flip_pairs():
+    """Images and label maps must be flipped together."""
+    images = torch.arange(2 * 3 * 4 * 5, dtype=torch.float32).view(2, 3, 4, 5)
+    labels = images[:, 0].long()
+    images, labels = batch_transform.RandomHorizontalFlip(p=1.0)(images, labels)
+    assert torch.equal(images[:, 0].long(), labels)
+    assert labels[0, 0, 0].item() == 4
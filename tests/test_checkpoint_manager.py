@@ -0,0 +1,109 @@
+import os
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+
+from src.vision.checkpoint_manager import CheckpointManager
+from src.vision.trainer import resume_training
+
+
+def make_model_and_optimizer():
+    model = nn.Conv2d(3, 2, kernel_size=1)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    return model, optimizer
+
+
+def train_step(model, optimizer):
+    optimizer.zero_grad()
+    model(torch.rand(1, 3, 4, 4)).sum().backward()
+    optimizer.step()
+
+
+def test_checkpoint_retention_and_resume(tmp_path):
+    """Checkpoints must hold the state at save() time, be pruned to the last-k and top-k,
+    and training must resume from the newest complete one."""
+    save_dir = str(tmp_path)
+    model, optimizer = make_model_and_optimizer()
+    metrics = {1: 0.5, 2: 0.9, 3: 0.4, 4: 0.6, 5: 0.3}
+    weights = {}
+    with CheckpointManager(save_dir, keep_last=2, keep_best=1, async_save=True) as checkpoint_manager:
+        for epoch, metric in metrics.items():
+            train_step(model, optimizer)
+            weights[epoch] = model.weight.detach().clone()
+            checkpoint_manager.save(epoch, model, optimizer, metric, extra={"results": {"mIoU_val": [metric]}})
+            # keeps training while the checkpoint is written
+            train_step(model, optimizer)
+
+    # the last 2 epochs, and the best one
+    assert sorted(os.listdir(save_dir)) == ["checkpoints.json", "train_epoch_2.pth", "train_epoch_4.pth", "train_epoch_5.pth"]
+    for epoch in [2, 4, 5]:
+        checkpoint = torch.load(os.path.join(save_dir, f"train_epoch_{epoch}.pth"))
+        assert torch.equal(checkpoint["state_dict"]["weight"], weights[epoch])
+
+    # a half-written checkpoint is never picked up, an unreadable one is skipped
+    with open(os.path.join(save_dir, "train_epoch_6.pth.tmp"), "wb") as f:
+        f.write(b"partial")
+    with open(os.path.join(save_dir, "train_epoch_6.pth"), "wb") as f:
+        f.write(b"corrupt")
+
+    args = SimpleNamespace(auto_resume=True, start_epoch=0)
+    model, optimizer = make_model_and_optimizer()
+    results_dict = resume_training(args, CheckpointManager(save_dir), model, optimizer)
+    assert args.start_epoch == 5
+    assert torch.equal(model.weight, weights[5])
+    assert len(optimizer.state) > 0
+    assert results_dict["mIoU_val"] == [0.3]
+
+    # start_epoch picks the newest checkpoint of at most that many epochs
+    args = SimpleNamespace(auto_resume=True, start_epoch=3)
+    model, optimizer = make_model_and_optimizer()
+    resume_training(args, CheckpointManager(save_dir), model, optimizer)
+    assert args.start_epoch == 2
+    assert torch.equal(model.weight, weights[2])
+
+    # the retention policy carries over to a new run in the same directory
+    os.remove(os.path.join(save_dir, "train_epoch_6.pth"))
+    with CheckpointManager(save_dir, keep_last=2, keep_best=1, async_save=False) as checkpoint_manager:
+        checkpoint_manager.save(6, model, optimizer, 0.1)
+    assert sorted(f for f in os.listdir(save_dir) if f.endswith(".pth")) == [
+        "train_epoch_2.pth",
+        "train_epoch_5.pth",
+        "train_epoch_6.pth",
+    ]
+
+
+def test_checkpoint_pruning_covers_files_missing_from_the_index(tmp_path):
+    """Checkpoints on disk without an index entry, e.g. from before the index existed, are pruned
+    too, by epoch only; the checkpoint just written is kept even if later epochs are on disk."""
+    save_dir = str(tmp_path)
+    model, optimizer = make_model_and_optimizer()
+    for epoch in [1, 2, 3]:
+        fpath = os.path.join(save_dir, f"train_epoch_{epoch}.pth")
+        torch.save({"epoch": epoch, "state_dict": model.state_dict()}, fpath)
+
+    with CheckpointManager(save_dir, keep_last=2, keep_best=1, async_save=False) as checkpoint_manager:
+        checkpoint_manager.save(4, model, optimizer, 0.1)
+        assert sorted(os.listdir(save_dir)) == ["checkpoints.json", "train_epoch_3.pth", "train_epoch_4.pth"]
+
+    # a new run in a directory holding later epochs of another run
+    with CheckpointManager(save_dir, keep_last=1, async_save=False) as checkpoint_manager:
+        checkpoint_manager.save(1, model, optimizer, 0.2)
+    assert sorted(f for f in os.listdir(save_dir) if f.endswith(".pth")) == ["train_epoch_1.pth", "train_epoch_4.pth"]
+
+
+def test_resume_skips_checkpoint_not_matching_the_model(tmp_path):
+    """A stale checkpoint, e.g. with a different number of classes, must not be loaded."""
+    save_dir = str(tmp_path)
+    model, optimizer = make_model_and_optimizer()
+    with CheckpointManager(save_dir, async_save=False) as checkpoint_manager:
+        checkpoint_manager.save(3, model, optimizer, 0.5)
+
+    args = SimpleNamespace(auto_resume=True, start_epoch=0)
+    model = nn.Conv2d(3, 5, kernel_size=1)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    weight = model.weight.detach().clone()
+    results_dict = resume_training(args, CheckpointManager(save_dir), model, optimizer)
+    assert args.start_epoch == 0
+    assert torch.equal(model.weight, weight)
+    assert len(results_dict) == 0
@@ -0,0 +1,83 @@
+import copy
+import os
+from types import SimpleNamespace
+
+import torch
+
+from src.vision.feature_cache import CachedFeatureHead, FeatureCacheData, get_feature_cache
+from src.vision.part5_pspnet import PSPNet
+from src.vision.trainer import get_feature_cache_data
+
+
+def test_cached_heads_match_full_forward(tmp_path):
+    """Training the heads on cached float16 features must approximate the full forward pass,
+    and the cache must only be rebuilt when its source changes."""
+    torch.manual_seed(0)
+    model = PSPNet(num_classes=2, pretrained=False)
+    model.eval()
+    dataset = [(torch.rand(3, 65, 65), torch.randint(0, 2, (65, 65))) for _ in range(5)]
+
+    cache_dir = str(tmp_path / "train")
+    cache = get_feature_cache(model, dataset, cache_dir, batch_size=2, use_cuda=False, source={"split": "train"})
+    assert isinstance(cache, FeatureCacheData)
+    assert len(cache) == 5
+    features, label = cache[3]
+    assert features.dtype == torch.float16
+    assert torch.equal(label, dataset[3][1])
+
+    head_model = CachedFeatureHead(model, cache.meta["layer3_channels"], cache.meta["input_size"])
+    head_model.eval()
+    x = torch.stack([dataset[i][0] for i in range(5)])
+    y = torch.stack([dataset[i][1] for i in range(5)])
+    features = torch.stack([cache[i][0] for i in range(5)])
+    with torch.no_grad():
+        logits, _, main_loss, aux_loss = model(x, y)
+        cached_logits, _, cached_main_loss, cached_aux_loss = head_model(features, y)
+    assert cached_logits.shape == logits.shape
+    assert torch.allclose(cached_logits, logits, atol=1e-2)
+    assert torch.isclose(cached_main_loss, main_loss, atol=1e-3)
+    assert torch.isclose(cached_aux_loss, aux_loss, atol=1e-3)
+
+    # the heads are trainable from the cache, the backbone receives no gradient
+    head_model.train()
+    _, _, main_loss, aux_loss = head_model(features, y)
+    (main_loss + 0.4 * aux_loss).backward()
+    assert model.cls[-1].weight.grad is not None
+    assert model.layer4[0].conv1.weight.grad is None
+
+    other_model = copy.deepcopy(model)
+    torch.nn.init.zeros_(other_model.layer4[-1].conv3.weight)
+    get_feature_cache(other_model, dataset, cache_dir, batch_size=2, use_cuda=False, source={"split": "train"})
+    assert torch.equal(FeatureCacheData(cache_dir)[0][0], cache[0][0]), "the cache should have been reused"
+    get_feature_cache(other_model, dataset, cache_dir, batch_size=2, use_cuda=False, source={"split": "val"})
+    assert not torch.equal(FeatureCacheData(cache_dir)[0][0], cache[0][0]), "the cache should have been rebuilt"
+
+
+def test_feature_cache_rebuilt_when_checkpoint_overwritten(tmp_path):
+    """A checkpoint retrained and saved at the same path must not reuse the old backbone's features."""
+    torch.manual_seed(0)
+    model = PSPNet(num_classes=2, pretrained=False)
+    model_path = str(tmp_path / "train_epoch_1.pth")
+    torch.save({"state_dict": model.state_dict()}, model_path)
+    args = SimpleNamespace(
+        model_path=model_path,
+        data_root=str(tmp_path),
+        save_path=str(tmp_path),
+        train_h=65,
+        train_w=65,
+        short_size=65,
+        batch_size_val=2,
+        feature_cache_draws=1,
+    )
+    dataset = [(torch.rand(3, 65, 65), torch.randint(0, 2, (65, 65))) for _ in range(2)]
+
+    train_cache, _, _ = get_feature_cache_data(args, False, model, dataset, dataset)
+    features = train_cache[0][0]
+
+    other_model = copy.deepcopy(model)
+    torch.nn.init.zeros_(other_model.layer4[-1].conv3.weight)
+    torch.save({"state_dict": other_model.state_dict(), "epoch": 1}, model_path)
+    # also when the file system's mtime granularity is too coarse to tell the two saves apart
+    os.utime(model_path, ns=(os.stat(model_path).st_atime_ns, os.stat(model_path).st_mtime_ns + 1))
+    train_cache, _, _ = get_feature_cache_data(args, False, other_model, dataset, dataset)
+    assert not torch.equal(train_cache[0][0], features), "the cache should have been rebuilt"
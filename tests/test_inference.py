@@ -0,0 +1,202 @@
+import copy
+from pathlib import Path
+
+import cv2
+import imageio
+import numpy as np
+import pytest
+import torch
+
+from src.vision.accuracy_calculator import AccuracyCalculator
+from src.vision.avg_meter import SegmentationAverageMeter
+from src.vision.part5_pspnet import PSPNet
+from src.vision.test import InferenceTask, create_test_loader
+from src.vision.trainer import DEFAULT_ARGS
+
+
+TEST_DATA_ROOT = Path(__file__).resolve().parent / "test_data"
+
+CROP_SIZE = 33
+
+
+@pytest.fixture(scope="module")
+def inference_args(tmp_path_factory):
+    """Inference configuration for a randomly initialized PSPNet, saved as a checkpoint."""
+    torch.manual_seed(0)
+    model_path = str(tmp_path_factory.mktemp("model") / "train_epoch_1.pth")
+    model = PSPNet(num_classes=11, pretrained=False)
+    torch.save({"epoch": 1, "state_dict": model.state_dict()}, model_path)
+
+    args = copy.deepcopy(DEFAULT_ARGS)
+    args.model_path = model_path
+    args.save_folder = str(tmp_path_factory.mktemp("results"))
+    args.num_model_classes = 11
+    args.base_size = 48
+    args.test_h = CROP_SIZE
+    args.test_w = CROP_SIZE
+    return args
+
+
+def make_inference_task(args, **kwargs) -> InferenceTask:
+    args = copy.deepcopy(args)
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    itask = InferenceTask(
+        args=args,
+        base_size=args.base_size,
+        crop_h=args.test_h,
+        crop_w=args.test_w,
+        input_file=None,
+        model_taxonomy="test_dataset",
+        eval_taxonomy="test_dataset",
+        scales=args.scales,
+        use_gpu=False,
+    )
+    itask.model.eval()
+    return itask
+
+
+def test_batched_sliding_window_matches_per_crop(inference_args):
+    """The batched tiling engine must match feeding one crop at a time through net_process()."""
+    itask = make_inference_task(inference_args, tile_batch_size=4)
+    image = np.random.randint(0, 256, size=(48, 64, 3)).astype(np.float32)
+    prediction = itask.scale_process_cuda(image, 48, 64)
+
+    # reference: sliding window, one crop at a time
+    crop_h = crop_w = CROP_SIZE
+    h, w, _ = image.shape
+    stride = int(np.ceil(CROP_SIZE * 2 / 3))
+    expected = torch.zeros((11, h, w))
+    count = torch.zeros((h, w))
+    for index_h in range(int(np.ceil(float(h - crop_h) / stride) + 1)):
+        for index_w in range(int(np.ceil(float(w - crop_w) / stride) + 1)):
+            s_h = min(index_h * stride + crop_h, h) - crop_h
+            s_w = min(index_w * stride + crop_w, w) - crop_w
+            count[s_h : s_h + crop_h, s_w : s_w + crop_w] += 1
+            expected[:, s_h : s_h + crop_h, s_w : s_w + crop_w] += itask.net_process(
+                image[s_h : s_h + crop_h, s_w : s_w + crop_w].copy()
+            )
+    expected = (expected / count).permute(1, 2, 0).numpy()
+
+    assert prediction.shape == (48, 64, 11)
+    assert np.allclose(prediction, expected, atol=1e-5)
+
+
+def test_batched_dataloader_matches_per_image(inference_args, tmp_path):
+    """Bucketed multi-image inference must write the same grayscale predictions as the per-image loop."""
+    data_kwargs = {
+        "split": "train",
+        "data_root": str(TEST_DATA_ROOT / "CamvidSubsampled"),
+        "test_list": str(TEST_DATA_ROOT / "dummy_camvid_train.txt"),
+        "workers": 0,
+    }
+    gray_imgs = {}
+    for test_batch_size in [1, 3]:
+        itask = make_inference_task(
+            inference_args,
+            save_folder=str(tmp_path / f"batch_{test_batch_size}"),
+            test_batch_size=test_batch_size,
+            **data_kwargs,
+        )
+        test_loader, itask.data_list = create_test_loader(itask.args, use_batched_inference=test_batch_size > 1)
+        if test_batch_size > 1:
+            itask.execute_on_batched_dataloader(test_loader)
+        else:
+            itask.execute_on_dataloader(test_loader)
+        gray_imgs[test_batch_size] = {
+            fpath.name: fpath.read_bytes() for fpath in sorted(Path(itask.gray_folder).glob("*.png"))
+        }
+
+    assert len(gray_imgs[1]) == 3
+    assert gray_imgs[1] == gray_imgs[3]
+
+
+@pytest.mark.parametrize("test_batch_size", [1, 3])
+def test_inline_metrics_match_offline(inference_args, tmp_path, test_batch_size):
+    """IoU statistics accumulated during inference must match re-scoring the saved PNGs."""
+    itask = make_inference_task(
+        inference_args,
+        save_folder=str(tmp_path),
+        split="train",
+        data_root=str(TEST_DATA_ROOT / "CamvidSubsampled"),
+        test_list=str(TEST_DATA_ROOT / "dummy_camvid_train.txt"),
+        workers=0,
+        test_batch_size=test_batch_size,
+        inline_metrics=True,
+    )
+    itask.execute()
+
+    sam = SegmentationAverageMeter()
+    for image_path, label_path in itask.data_list:
+        pred = cv2.imread(str(Path(itask.gray_folder) / (Path(image_path).stem + ".png")), cv2.IMREAD_GRAYSCALE)
+        target = imageio.imread(label_path).astype(np.int64)
+        sam.update_metrics_cpu(pred, target, itask.num_eval_classes)
+
+    assert np.array_equal(itask.sam.confusion_matrix(), sam.confusion_matrix())
+
+
+@pytest.mark.parametrize("test_batch_size", [1, 3])
+def test_inline_metrics_on_test_split_match_accuracy_calculator(inference_args, tmp_path, test_batch_size):
+    """On the test split too, inline metrics must score against the ground truth labels,
+    exactly like `AccuracyCalculator` re-scoring the saved PNGs."""
+    itask = make_inference_task(
+        inference_args,
+        save_folder=str(tmp_path),
+        split="test",
+        data_root=str(TEST_DATA_ROOT / "CamvidSubsampled"),
+        test_list=str(TEST_DATA_ROOT / "dummy_camvid_train.txt"),
+        workers=0,
+        test_batch_size=test_batch_size,
+        inline_metrics=True,
+    )
+    itask.execute()
+
+    ac = AccuracyCalculator(
+        args=itask.args,
+        data_list=itask.data_list,
+        dataset_name=itask.args.dataset,
+        class_names=[str(i) for i in range(itask.num_eval_classes)],
+        save_folder=str(tmp_path),
+        eval_taxonomy="test_dataset",
+        num_eval_classes=itask.num_eval_classes,
+        excluded_ids=[],
+    )
+    ac.compute_metrics(save_vis=False)
+
+    assert np.array_equal(itask.sam.confusion_matrix(), ac.sam.confusion_matrix())
+
+
+def test_compiled_backend_matches_eager(inference_args):
+    """Compiled inference, with batch padding to the warmed-up bucket, must match eager and not recompile."""
+    image = np.random.randint(0, 256, size=(48, 64, 3)).astype(np.float32)
+    expected = make_inference_task(inference_args, tile_batch_size=4).scale_process_cuda(image, 48, 64)
+
+    torch._dynamo.reset()
+    itask = make_inference_task(inference_args, tile_batch_size=4, compile=True, compile_backend="eager")
+    frame_count = torch._dynamo.utils.counters["stats"]["unique_graphs"]
+    # 6 crops: one full micro-batch of 4, and one of 2 that is padded to the bucket
+    prediction = itask.scale_process_cuda(image, 48, 64)
+
+    assert torch._dynamo.utils.counters["stats"]["unique_graphs"] == frame_count
+    assert np.allclose(prediction, expected, atol=1e-5)
+
+
+def test_channels_last_matches_contiguous(inference_args):
+    """Sliding-window predictions must not depend on the memory format."""
+    image = np.random.randint(0, 256, size=(48, 64, 3)).astype(np.float32)
+    expected = make_inference_task(inference_args).scale_process_cuda(image, 48, 64)
+    itask = make_inference_task(inference_args, memory_format="channels_last")
+    assert itask.model.layer1[0].conv1.weight.is_contiguous(memory_format=torch.channels_last)
+
+    prediction = itask.scale_process_cuda(image, 48, 64)
+    assert np.allclose(prediction, expected, atol=1e-5)
+
+
+def test_bfloat16_autocast_close_to_float32(inference_args):
+    """bf16 autocast inference must still return float32 probabilities, close to the float32 ones."""
+    image = np.random.randint(0, 256, size=(48, 64, 3)).astype(np.float32)
+    expected = make_inference_task(inference_args).scale_process_cuda(image, 48, 64)
+    prediction = make_inference_task(inference_args, autocast_dtype="bfloat16").scale_process_cuda(image, 48, 64)
+
+    assert prediction.dtype == np.float32
+    assert np.abs(prediction - expected).max() < 0.05
@@ -0,0 +1,52 @@
+import torch
+from torch import nn
+
+from src.vision.inference_utils import freeze_for_inference
+from src.vision.part4_segmentation_net import SimpleSegmentationNet
+from src.vision.part5_pspnet import PSPNet
+
+
+def randomize_batch_norm_statistics(model: nn.Module) -> None:
+    """Give every BatchNorm non-trivial statistics & affine parameters, so that folding is actually tested."""
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            if module.affine:
+                module.weight.data.uniform_(0.5, 1.5)
+                module.bias.data.uniform_(-0.5, 0.5)
+
+
+def test_freeze_for_inference_pspnet():
+    """Folded PSPNet logits must match those of the original network, without any BatchNorm left in the graph."""
+    torch.manual_seed(0)
+    model = PSPNet(num_classes=11, pretrained=False)
+    randomize_batch_norm_statistics(model)
+    model.eval()
+
+    x = torch.rand(2, 3, 65, 65)
+    with torch.no_grad():
+        expected = model.forward_logits(x)
+        frozen = freeze_for_inference(model)
+        logits = frozen.forward_logits(x)
+
+    assert frozen.aux is None
+    used_modules = [frozen.layer0, frozen.layer1, frozen.layer2, frozen.layer3, frozen.layer4, frozen.ppm, frozen.cls]
+    for used in used_modules:
+        assert not any(isinstance(m, (nn.BatchNorm2d, nn.Dropout2d)) for m in used.modules())
+    assert torch.allclose(logits, expected, atol=1e-4)
+
+
+def test_freeze_for_inference_simple_segmentation_net():
+    """Folded SimpleSegmentationNet logits must match those of the original network."""
+    torch.manual_seed(0)
+    model = SimpleSegmentationNet(pretrained=False, num_classes=11)
+    randomize_batch_norm_statistics(model)
+    model.eval()
+
+    x = torch.rand(2, 3, 64, 64)
+    with torch.no_grad():
+        expected = model.forward_logits(x)
+        logits = freeze_for_inference(model).forward_logits(x)
+
+    assert torch.allclose(logits, expected, atol=1e-4)
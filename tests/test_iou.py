@@ -2,9 +2,11 @@
 
 import numpy as np
 import pdb
+import pytest
 import torch
 
-from src.vision.iou import intersectionAndUnion, intersectionAndUnionGPU
+from src.vision.avg_meter import ConfusionMatrixMeter, SegmentationAverageMeter
+from src.vision.iou import confusionMatrix, intersectionAndUnion, intersectionAndUnionGPU
 
 
 def test_intersectionAndUnion_2classes():
@@ -130,3 +132,49 @@ def test_intersectionAndUnionGPU_ignore_label():
     assert torch.allclose(area_intersection, torch.tensor([1, 0]).float())
     assert torch.allclose(area_target, torch.tensor([1, 1]).float())
     assert torch.allclose(area_union, torch.tensor([2, 1]).float())
+
+
+def test_confusionMatrix_matches_intersectionAndUnion():
+    """Areas derived from the confusion matrix must equal the histogram-based ones, ignore label included."""
+    num_classes = 5
+    pred = np.random.randint(0, num_classes, size=(4, 30, 40))
+    target = np.random.randint(0, num_classes + 1, size=(4, 30, 40))
+    target[target == num_classes] = 255
+
+    meter = ConfusionMatrixMeter(num_classes, ignore_index=255)
+    meter.update(pred, target)
+    area_intersection, area_union, area_target = meter.get_areas()
+    expected = intersectionAndUnion(pred, target, K=num_classes, ignore_index=255)
+    assert np.array_equal(area_intersection, expected[0])
+    assert np.array_equal(area_union, expected[1])
+    assert np.array_equal(area_target, expected[2])
+
+    mat = confusionMatrix(torch.from_numpy(pred), torch.from_numpy(target), K=num_classes, ignore_index=255)
+    assert mat.shape == (num_classes + 1, num_classes + 1)
+    assert np.array_equal(mat.numpy(), meter.mat)
+
+
+def test_SegmentationAverageMeter_metrics():
+    """mIoU/mAcc/allAcc from the accumulated confusion matrix, over two updates."""
+    sam = SegmentationAverageMeter()
+    sam.update_metrics_gpu(torch.tensor([[2, 0], [1, 0]]), torch.tensor([[2, 0], [1, 1]]), 3, 255, False)
+    assert np.isclose(sam.accuracy, 0.75)
+    sam.update_metrics_gpu(torch.tensor([[1, 0], [1, 0]]), torch.tensor([[255, 0], [255, 1]]), 3, 255, False)
+    assert np.isclose(sam.accuracy, 0.5)
+
+    iou_class, accuracy_class, mIoU, mAcc, allAcc = sam.get_metrics()
+    # intersection [2,1,1], union [4,3,1], target [2,3,1]
+    assert np.allclose(iou_class, [2 / 4, 1 / 3, 1.0])
+    assert np.allclose(accuracy_class, [1.0, 1 / 3, 1.0])
+    assert np.isclose(mIoU, np.mean([2 / 4, 1 / 3, 1.0]))
+    assert np.isclose(allAcc, 4 / 6)
+    assert np.array_equal(sam.confusion_matrix(), np.array([[2, 0, 0], [2, 1, 0], [0, 0, 1]]))
+
+
+def test_SegmentationAverageMeter_no_updates():
+    """Before any update, there are no metrics: a clear error, rather than an AttributeError."""
+    sam = SegmentationAverageMeter()
+    assert sam.accuracy == 0
+    for get in [sam.get_metrics, sam.confusion_matrix]:
+        with pytest.raises(ValueError):
+            get()
@@ -0,0 +1,97 @@
+import copy
+import os
+
+import pytest
+import torch
+
+from src.vision.model_io import (
+    build_from_state_dict,
+    export_inference_checkpoint,
+    load_checkpoint,
+    load_state_dict_file,
+    load_tensor_file,
+)
+from src.vision.part5_pspnet import PSPNet
+from src.vision.test import InferenceTask
+from src.vision.trainer import DEFAULT_ARGS
+
+
+def test_build_from_state_dict_matches_load_state_dict(tmp_path):
+    """A network materialized from a memory-mapped checkpoint must equal one built normally,
+    and tensors missing from the checkpoint must still be materialized."""
+    torch.manual_seed(0)
+    model = PSPNet(num_classes=11, pretrained=False)
+    model.eval()
+    state_dict = {
+        name: tensor
+        for name, tensor in model.state_dict().items()
+        if not name.startswith("aux.") and not name.endswith("num_batches_tracked")
+    }
+    model_path = str(tmp_path / "train_epoch_1.pth")
+    torch.save({"epoch": 1, "state_dict": state_dict}, model_path)
+
+    checkpoint = load_checkpoint(model_path)
+    fast_model = build_from_state_dict(lambda: PSPNet(num_classes=11, pretrained=False), checkpoint["state_dict"])
+    fast_model.eval()
+
+    assert not any(t.is_meta for t in list(fast_model.parameters()) + list(fast_model.buffers()))
+    assert fast_model.aux[0].weight.abs().sum() > 0, "the missing aux head should be randomly initialized"
+    assert fast_model.layer0[1].num_batches_tracked == 0
+    assert fast_model.layer0[1].running_var.equal(model.layer0[1].running_var)
+
+    x = torch.rand(1, 3, 65, 65)
+    with torch.no_grad():
+        assert torch.equal(fast_model.forward_logits(x), model.forward_logits(x))
+
+
+@pytest.mark.parametrize("dtype", [None, torch.float16, torch.bfloat16])
+def test_inference_checkpoint_round_trip(tmp_path, dtype):
+    """An exported inference checkpoint must hold the weights without the aux head and the optimizer,
+    and InferenceTask must load it to (nearly) the same predictions as the training checkpoint."""
+    torch.manual_seed(0)
+    model = PSPNet(num_classes=11, pretrained=False)
+    model.eval()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    model(torch.rand(1, 3, 33, 33), torch.randint(0, 11, (1, 33, 33)))[2].backward()
+    optimizer.step()
+    checkpoint = {"epoch": 1, "state_dict": model.state_dict(), "optimizer": optimizer.state_dict()}
+    model_path = str(tmp_path / "train_epoch_1.pth")
+    torch.save(checkpoint, model_path)
+
+    inference_path = str(tmp_path / "train_epoch_1.safetensors")
+    export_inference_checkpoint(checkpoint, inference_path, dtype)
+    tensors, metadata = load_tensor_file(inference_path)
+    assert metadata["epoch"] == "1"
+    assert not any(name.startswith("aux.") for name in tensors)
+    assert "layer1.0.conv1.weight" in tensors and "resnet.layer1.0.conv1.weight" not in tensors
+    for name, tensor in tensors.items():
+        expected = checkpoint["state_dict"][name]
+        if dtype is not None and expected.is_floating_point():
+            expected = expected.to(dtype)
+        assert tensor.dtype == expected.dtype and torch.equal(tensor, expected)
+    if dtype is not None:
+        assert os.path.getsize(inference_path) < 0.3 * os.path.getsize(model_path)
+    assert all(t.dtype != torch.float16 for t in load_state_dict_file(inference_path).values())
+
+    args = copy.deepcopy(DEFAULT_ARGS)
+    args.model_path = inference_path
+    args.save_folder = str(tmp_path)
+    args.num_model_classes = 11
+    args.classes = 11
+    itask = InferenceTask(
+        args=args,
+        base_size=48,
+        crop_h=33,
+        crop_w=33,
+        input_file=None,
+        model_taxonomy="test_dataset",
+        eval_taxonomy="test_dataset",
+        scales=[1.0],
+        use_gpu=False,
+    )
+    x = torch.rand(1, 3, 65, 65)
+    with torch.no_grad():
+        expected = model.forward_logits(x)
+        logits = itask.model.forward_logits(x)
+    tolerance = 1e-4 if dtype is None else 0.05
+    assert (logits - expected).abs().max() < tolerance * expected.abs().max()
@@ -0,0 +1,71 @@
+import copy
+
+import numpy as np
+import pytest
+import torch
+
+from src.vision.part4_segmentation_net import SimpleSegmentationNet
+from src.vision.part5_pspnet import PSPNet
+from src.vision.test import InferenceTask, OnnxRuntimeBackend, TorchBackend
+from src.vision.trainer import DEFAULT_ARGS
+
+pytest.importorskip("onnxscript")
+pytest.importorskip("onnxruntime")
+
+from src.vision.onnx_export import export_onnx
+
+
+@pytest.mark.parametrize("arch", ["PSPNet", "SimpleSegmentationNet"])
+def test_onnxruntime_backend_matches_torch(tmp_path, arch):
+    """ONNX Runtime must reproduce the torch logits, also at resolutions other than the export example's."""
+    torch.manual_seed(0)
+    if arch == "PSPNet":
+        model = PSPNet(num_classes=11, pretrained=False)
+        shapes = [(1, 3, 65, 65), (2, 3, 33, 97)]
+    else:
+        model = SimpleSegmentationNet(pretrained=False, num_classes=11)
+        shapes = [(1, 3, 64, 64), (2, 3, 32, 96)]
+    model.eval()
+    onnx_fpath = str(tmp_path / "model.onnx")
+    export_onnx(model, onnx_fpath, example_hw=shapes[0][2:])
+
+    torch_backend = TorchBackend(model)
+    ort_backend = OnnxRuntimeBackend(onnx_fpath)
+    for shape in shapes:
+        x = torch.rand(*shape)
+        assert torch.allclose(ort_backend(x), torch_backend(x), atol=1e-4)
+
+
+def test_inference_task_onnxruntime_backend(tmp_path):
+    """The sliding window over the ONNX Runtime backend must match the torch backend."""
+    torch.manual_seed(0)
+    model = PSPNet(num_classes=11, pretrained=False)
+    model_path = str(tmp_path / "train_epoch_1.pth")
+    torch.save({"epoch": 1, "state_dict": model.state_dict()}, model_path)
+    onnx_fpath = str(tmp_path / "train_epoch_1.onnx")
+    export_onnx(model.eval(), onnx_fpath, example_hw=(33, 33))
+
+    args = copy.deepcopy(DEFAULT_ARGS)
+    args.model_path = model_path
+    args.onnx_path = onnx_fpath
+    args.save_folder = str(tmp_path)
+    args.num_model_classes = 11
+    args.classes = 11
+    image = np.random.randint(0, 256, size=(48, 64, 3)).astype(np.float32)
+    predictions = []
+    for backend in ["torch", "onnxruntime"]:
+        args.inference_backend = backend
+        itask = InferenceTask(
+            args=args,
+            base_size=48,
+            crop_h=33,
+            crop_w=33,
+            input_file=None,
+            model_taxonomy="test_dataset",
+            eval_taxonomy="test_dataset",
+            scales=[1.0],
+            use_gpu=False,
+        )
+        predictions.append(itask.scale_process_cuda(image, 48, 64))
+
+    assert np.allclose(predictions[0], predictions[1], atol=1e-5)
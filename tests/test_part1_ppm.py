@@ -75,3 +75,18 @@ def test_PPM_fullres():
     assert output.shape == (batch_size, (50*5) + 100, H, W)
     # zero'th channel is just the input
     assert torch.allclose(output[:,:100,:,:], input)
+
+
+def test_PPM_channels_last():
+    """A channels_last input must give the same, channels_last, output, without falling back to NCHW."""
+    ppm = PPM(in_dim=64, reduction_dim=16, bins=(1, 2, 3, 6))
+    ppm.eval()
+    x = torch.rand(2, 64, 9, 9)
+
+    with torch.no_grad():
+        expected = ppm(x)
+        ppm = ppm.to(memory_format=torch.channels_last)
+        output = ppm(x.contiguous(memory_format=torch.channels_last))
+
+    assert output.is_contiguous(memory_format=torch.channels_last)
+    assert torch.allclose(output, expected, atol=1e-6)
@@ -5,7 +5,7 @@ from pathlib import Path
 import numpy as np
 import torch
 
-from src.vision.part2_dataset import SemData, make_dataset
+from src.vision.part2_dataset import PackedSemData, SemData, make_dataset, pack_dataset
 from src.vision.cv2_transforms import ToTensor
 
 
@@ -69,3 +69,25 @@ def test_SemData_len() -> None:
 	dataset = SemData(split, data_root, data_list_fpath, transform=ToTensor())
 
 	assert len(dataset) == 3
+
+
+def test_PackedSemData_matches_SemData(tmp_path) -> None:
+	"""Ensure the packed, memory-mapped dataset returns exactly what SemData returns."""
+	split = "train"
+	data_root = str(TEST_DATA_ROOT / "CamvidSubsampled")
+	data_list_fpath = str(TEST_DATA_ROOT / "dummy_camvid_train.txt")
+	pack_fpath = str(tmp_path / "camvid_train.bin")
+	pack_dataset(split, data_root, data_list_fpath, pack_fpath)
+
+	dataset = SemData(split, data_root, data_list_fpath, transform=ToTensor())
+	packed_dataset = PackedSemData(split, pack_fpath, transform=ToTensor())
+
+	assert len(packed_dataset) == len(dataset)
+	assert packed_dataset.data_list == dataset.data_list
+	for i in range(len(dataset)):
+		image, label = dataset[i]
+		packed_image, packed_label = packed_dataset[i]
+		assert packed_image.dtype == torch.float32
+		assert packed_label.dtype == torch.int64
+		assert torch.equal(image, packed_image)
+		assert torch.equal(label, packed_label)
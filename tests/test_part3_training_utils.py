@@ -97,3 +97,101 @@ def test_get_val_transform():
     assert torch.allclose(x[1,:,:], torch.Tensor([expected_g]), atol=1e-2)
     assert torch.allclose(x[2,:,:], torch.Tensor([expected_b]), atol=1e-2)
     assert torch.allclose(y, expected_y)
+
+
+def test_get_val_transform_uint8_pipeline():
+    """Ensure the uint8 pipeline matches the float pipeline once the batch is normalized."""
+    args = SimpleNamespace(
+        **{
+            "short_size": 240,
+            "train_h": 201,
+            "train_w": 201,
+            "ignore_label": 255,
+            "uint8_pipeline": True,
+        }
+    )
+    H = 720
+    W = 960
+    x = np.full((H, W, 3), 15, dtype=np.uint8)
+    y = np.full((H, W), 5, dtype=np.uint8)
+
+    x_uint8, y_uint8 = get_val_transform(args)(x, y)
+    assert x_uint8.dtype == torch.uint8
+    assert y_uint8.dtype == torch.int64
+
+    args.uint8_pipeline = False
+    x_float, y_float = get_val_transform(args)(x.astype(np.float32), y.astype(np.int64))
+
+    mean = [123.675, 116.28, 103.53]
+    std = [58.395, 57.120000000000005, 57.375]
+    x_batch = transform.normalize_uint8(x_uint8.unsqueeze(0), mean, std)
+    assert x_batch.dtype == torch.float32
+    assert torch.allclose(x_batch[0], x_float, atol=1e-5)
+    assert torch.equal(y_uint8, y_float)
+
+
+def test_get_train_transform_fused_augmentation():
+    """Ensure the fused single-warp augmentation returns the proper crop size and types."""
+    args = SimpleNamespace(
+        **{
+            "short_size": 240,
+            "train_h": 201,
+            "train_w": 201,
+            "scale_min": 0.5,  # minimum random scale
+            "scale_max": 2.0,  # maximum random scale
+            "rotate_min": -10,  # minimum random rotate
+            "rotate_max": 10,  # maximum random rotate
+            "ignore_label": 255,
+            "fused_augmentation": True,
+        }
+    )
+    train_transform = get_train_transform(args)
+    assert isinstance(train_transform.segtransform[0], transform.FusedAffineCrop)
+
+    H = 720
+    W = 960
+    x = np.random.randint(low=0, high=256, size=(H, W, 3)).astype(np.float32)
+    y = np.random.randint(low=0, high=12, size=(H, W)).astype(np.int64)
+    x, y = train_transform(x, y)
+
+    assert x.shape == (3, args.train_h, args.train_w)
+    assert y.shape == (args.train_h, args.train_w)
+    assert set(torch.unique(y).tolist()) <= set(range(12)) | {args.ignore_label}
+
+
+def test_fused_affine_crop_matches_sequential():
+    """Without flip/rotation, a fused center crop must equal ResizeShort followed by Crop."""
+    mean = [123.675, 116.28, 103.53]
+    x = np.random.randint(low=0, high=256, size=(720, 960, 3)).astype(np.float32)
+    y = np.kron(np.random.randint(low=0, high=12, size=(24, 32)), np.ones((30, 30), dtype=np.int64))
+
+    fused = transform.FusedAffineCrop(
+        short_size=240, size=(201, 201), scale=(1.0, 1.0 + 1e-12), rotate=(-10, 10), padding=mean,
+        crop_type="center", flip_p=0.0, rotate_p=0.0
+    )
+    sequential = transform.Compose([transform.ResizeShort(240), transform.Crop((201, 201), padding=mean)])
+
+    x_fused, y_fused = fused(x, y)
+    x_seq, y_seq = sequential(x, y)
+    assert np.allclose(x_fused, x_seq, atol=1e-3)
+    assert np.array_equal(y_fused, y_seq)
+
+
+def test_fused_affine_crop_uint8_padding_matches_sequential():
+    """On uint8 images, the fused and sequential pipelines must fill padding with the same rounded mean."""
+    mean = [123.675, 116.28, 103.53]
+    x = np.random.randint(low=0, high=256, size=(120, 160, 3)).astype(np.uint8)
+    y = np.random.randint(low=0, high=12, size=(120, 160)).astype(np.int64)
+
+    fused = transform.FusedAffineCrop(
+        short_size=120, size=(201, 201), scale=(1.0, 1.0 + 1e-12), rotate=(-10, 10), padding=mean,
+        crop_type="center", flip_p=0.0, rotate_p=0.0
+    )
+    sequential = transform.Crop((201, 201), padding=mean)
+
+    x_fused, _ = fused(x, y)
+    x_seq, _ = sequential(x, y)
+    assert x_fused.dtype == np.uint8
+    assert np.array_equal(x_fused[0, 0], [124, 116, 104])
+    assert np.array_equal(x_fused[0, 0], x_seq[0, 0])
+    assert np.array_equal(x_fused[-1, -1], x_seq[-1, -1])
@@ -89,3 +89,16 @@ def test_check_output_shapes_testtime():
     assert aux_loss is None
 
 
+
+
+def test_forward_logits_matches_forward():
+    """The lean inference entry point must return the same logits as forward()."""
+    model = SimpleSegmentationNet(pretrained=False, num_classes=11)
+    model.eval()
+
+    x = torch.rand(2, 3, 64, 80)
+    with torch.no_grad():
+        logits, _, _, _ = model(x)
+        lean_logits = model.forward_logits(x)
+
+    assert torch.allclose(logits, lean_logits)
@@ -3,6 +3,7 @@ from types import SimpleNamespace
 
 import torch
 from torch import nn
+import copy
 import math
 
 from src.vision.part3_training_utils import get_model_and_optimizer
@@ -161,3 +162,45 @@ def test_pspnet_output_with_zoom_factor():
         assert yhat.shape == (batch_size, h_scaled, w_scaled)
 
 
+
+
+def test_pspnet_forward_logits_matches_forward():
+    """The lean inference entry point must return the same logits as forward()."""
+    torch.manual_seed(0)
+    model = PSPNet(num_classes=11, zoom_factor=8, use_ppm=True, pretrained=False)
+    model.eval()
+
+    x = torch.rand(2, 3, 65, 81)
+    with torch.no_grad():
+        logits, _, _, _ = model(x)
+        lean_logits = model.forward_logits(x)
+
+    assert torch.allclose(logits, lean_logits)
+
+
+def test_pspnet_checkpointing_matches_plain_training_step():
+    """Activation checkpointing of layer3/layer4 must not change the losses, gradients or BatchNorm statistics."""
+    torch.manual_seed(0)
+    model = PSPNet(num_classes=11, zoom_factor=8, use_ppm=True, pretrained=False)
+    x = torch.rand(2, 3, 65, 65)
+    y = torch.randint(0, 11, (2, 65, 65))
+
+    results = []
+    for checkpoint_segments in [0, 1, 6]:
+        m = copy.deepcopy(model)
+        m.checkpoint_segments = checkpoint_segments
+        m.train()
+        torch.manual_seed(1)  # same dropout masks
+        _, _, main_loss, aux_loss = m(x, y)
+        (main_loss + 0.4 * aux_loss).backward()
+        results.append((main_loss.item(), aux_loss.item(), m))
+
+    main_loss, aux_loss, reference = results[0]
+    for ckpt_main_loss, ckpt_aux_loss, m in results[1:]:
+        assert ckpt_main_loss == main_loss and ckpt_aux_loss == aux_loss
+        for p, q in zip(reference.parameters(), m.parameters()):
+            assert (p.grad is None) == (q.grad is None)
+            if p.grad is not None:
+                assert torch.allclose(p.grad, q.grad, atol=1e-6)
+        for b1, b2 in zip(reference.buffers(), m.buffers()):
+            assert torch.equal(b1, b2)
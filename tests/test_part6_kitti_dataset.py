@@ -3,10 +3,11 @@ import pdb
 from pathlib import Path
 import os
 
+import cv2
 import numpy as np
 import torch
 
-from src.vision.part2_dataset import KittiData
+from src.vision.part2_dataset import KittiData, load_kitti_index
 from src.vision.cv2_transforms import ToTensor
 from src.vision.part6_transfer_learning import model_and_optimizer
 from src.vision.part5_pspnet import PSPNet
@@ -83,3 +84,125 @@ def test_model_kitti() -> None:
 	assert isinstance(main_loss, torch.Tensor)
 	assert isinstance(aux_loss, torch.Tensor)
 
+
+def test_load_kitti_index_manifest(tmp_path) -> None:
+	"""Ensure the KITTI sample index is sorted, persisted, and rebuilt when the label directory changes."""
+	train_path = tmp_path / "training" / "image_2"
+	label_path = tmp_path / "training" / "gt_image_2"
+	train_path.mkdir(parents=True)
+	label_path.mkdir(parents=True)
+	for name in ["uu_000002.png", "um_000001.png"]:
+		(train_path / name).touch()
+		(label_path / name.replace("_", "_road_")).touch()
+	(label_path / "um_lane_000001.png").touch()
+
+	manifest_fpath = str(tmp_path / "index.json")
+	samples = load_kitti_index(str(train_path), str(label_path), manifest_fpath)
+	assert [image_name for image_name, _ in samples] == ["um_000001.png", "uu_000002.png"]
+	assert samples[0][1] == "um_road_000001.png"
+	assert os.path.isfile(manifest_fpath)
+
+	# unchanged directories -> index is served from the manifest
+	assert load_kitti_index(str(train_path), str(label_path), manifest_fpath) == samples
+
+	(train_path / "umm_000003.png").touch()
+	(label_path / "umm_road_000003.png").touch()
+	samples = load_kitti_index(str(train_path), str(label_path), manifest_fpath)
+	assert len(samples) == 3
+	assert samples[1][0] == "umm_000003.png"
+
+
+def test_KittiData_reopened_through_another_relative_root(tmp_path, monkeypatch) -> None:
+	"""Ensure the manifest written through one relative data root still works through another"""
+	data_root = tmp_path / "a" / "kitti"
+	(data_root / "training" / "image_2").mkdir(parents=True)
+	(data_root / "training" / "gt_image_2").mkdir(parents=True)
+	cv2.imwrite(str(data_root / "training" / "image_2" / "um_000001.png"), np.zeros((8, 8, 3), dtype=np.uint8))
+	cv2.imwrite(str(data_root / "training" / "gt_image_2" / "um_road_000001.png"), np.zeros((8, 8, 3), dtype=np.uint8))
+
+	monkeypatch.chdir(tmp_path)
+	assert len(KittiData("train", "a/kitti")) == 1
+	assert os.path.isfile(data_root / ".kitti_train_index.json")
+
+	monkeypatch.chdir(tmp_path / "a")
+	kitti = KittiData("train", "kitti")
+	image, label = kitti[0]
+	assert image.shape == (256, 256, 3)
+	assert label.shape == (256, 256)
+
+
+def test_model_kitti_reuses_model_and_freezes_layers() -> None:
+	""" Ensure model_and_optimizer() transplants the Camvid weights, and excludes frozen layers from training """
+	psp_model = PSPNet(num_classes=11, pretrained=False)
+	layer4_weight = psp_model.layer4[0].conv1.weight
+	cls_weight = psp_model.cls[0].weight
+
+	args = SimpleNamespace(
+		**{
+			"classes": 2,
+			"zoom_factor": 8,
+			"base_lr": 1e-3,
+			"momentum": 0.99,
+			"weight_decay": 1e-5,
+			"frozen_layers": ["layer0", "layer1", "layer2"]
+		}
+	)
+	model, optimizer = model_and_optimizer(args, psp_model)
+
+	# same model, only the final 1x1 convs are new
+	assert model is psp_model
+	assert model.layer4[0].conv1.weight is layer4_weight
+	assert model.cls[0].weight is cls_weight
+	assert model.cls[-1].out_channels == 2
+	assert model.aux[-1].out_channels == 2
+
+	optimized = {id(p) for group in optimizer.param_groups for p in group["params"]}
+	for name in ["layer0", "layer1", "layer2"]:
+		for param in getattr(model, name).parameters():
+			assert not param.requires_grad
+			assert id(param) not in optimized
+	for name in ["layer3", "layer4", "ppm", "cls", "aux"]:
+		for param in getattr(model, name).parameters():
+			assert param.requires_grad
+			assert id(param) in optimized
+
+	# the heads keep their 10x learning rate
+	assert len(optimizer.param_groups) == 8
+	assert [group["lr"] for group in optimizer.param_groups] == [1e-3] * 5 + [1e-2] * 3
+
+
+def test_model_kitti_frozen_layers_keep_batch_norm_stats() -> None:
+	""" Ensure the BatchNorm running statistics of frozen layers are unchanged by a training step """
+	torch.manual_seed(0)
+	psp_model = PSPNet(num_classes=11, pretrained=False)
+	args = SimpleNamespace(
+		**{
+			"classes": 2,
+			"zoom_factor": 8,
+			"base_lr": 1e-3,
+			"momentum": 0.99,
+			"weight_decay": 1e-5,
+			"frozen_layers": ["layer0", "layer1"]
+		}
+	)
+	model, optimizer = model_and_optimizer(args, psp_model)
+	frozen_buffers = {
+		(layer, name): buffer.clone()
+		for layer in ["layer0", "layer1"]
+		for name, buffer in getattr(model, layer).named_buffers()
+	}
+	assert len(frozen_buffers) > 0
+	layer2_buffers = {name: buffer.clone() for name, buffer in model.layer2.named_buffers()}
+
+	model.train()
+	x = torch.rand(2, 3, 65, 65)
+	y = torch.randint(0, 2, (2, 65, 65))
+	_, _, main_loss, aux_loss = model(x, y)
+	optimizer.zero_grad()
+	(main_loss + 0.4 * aux_loss).backward()
+	optimizer.step()
+
+	for (layer, name), buffer in frozen_buffers.items():
+		assert torch.equal(dict(getattr(model, layer).named_buffers())[name], buffer), (layer, name)
+	# the layers being trained still update theirs
+	assert not torch.equal(model.layer2[0].bn1.running_mean, layer2_buffers["0.bn1.running_mean"])
@@ -0,0 +1,46 @@
+import copy
+
+import torch
+
+from src.vision.part5_pspnet import PSPNet
+from src.vision.quantization import quantize_pspnet
+from src.vision.test import InferenceTask
+from src.vision.trainer import DEFAULT_ARGS
+
+
+def test_quantized_pspnet_close_to_float(tmp_path):
+    """The int8 PSPNet must approximate the float logits, and InferenceTask must load it back exactly."""
+    torch.manual_seed(0)
+    model = PSPNet(num_classes=11, pretrained=False)
+    model.eval()
+    calibration_loader = [(torch.rand(2, 3, 65, 65), None) for _ in range(4)]
+    quantized_model = quantize_pspnet(model, calibration_loader)
+
+    x = torch.rand(1, 3, 65, 97)
+    with torch.no_grad():
+        expected = model.forward_logits(x)
+        logits = quantized_model.forward_logits(x)
+    assert logits.shape == expected.shape
+    assert (logits - expected).abs().mean() < 0.1 * expected.abs().mean()
+
+    model_path = str(tmp_path / "train_epoch_1_int8.pth")
+    torch.save({"epoch": 1, "state_dict": quantized_model.state_dict()}, model_path)
+    args = copy.deepcopy(DEFAULT_ARGS)
+    args.model_path = model_path
+    args.save_folder = str(tmp_path)
+    args.num_model_classes = 11
+    args.classes = 11
+    args.quantized = True
+    itask = InferenceTask(
+        args=args,
+        base_size=48,
+        crop_h=33,
+        crop_w=33,
+        input_file=None,
+        model_taxonomy="test_dataset",
+        eval_taxonomy="test_dataset",
+        scales=[1.0],
+        use_gpu=False,
+    )
+    with torch.no_grad():
+        assert torch.equal(itask.model.forward_logits(x), logits)